@@ -1,14 +1,20 @@
 import os
 import json
+import time
+import threading
 import streamlit as st
-import pandas as pd
 from dotenv import load_dotenv
 
-from utils.mongo_connection import mongo_connection
-from utils.schema_detection import detect_collection_schema
-from models.query_parser import query_parser
-from models.aggregation_builder import AggregationBuilder
-from visualizations.chart_generator import ChartGenerator
+from utils.mongo_connection import MongoDBConnection
+from utils.schema_detection import get_collection_profile, discover_schema_catalog
+from models.intent_cache import intent_cache
+from models.query_parser import query_parser, MongoQueryIntent
+from utils.tracing import tracer
+from utils.rollups import rollup_manager
+
+# pandas, plotly and langchain are imported once a collection is open (see the
+# main content below), so the connection form renders without waiting on them.
+# Streamlit keeps imported modules across reruns; only the first import costs time.
 
 load_dotenv()
 
@@ -19,18 +25,71 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Each browser session gets its own connection object; the underlying
+# MongoClient (and its pool) is shared through the client registry
+if "mongo_connection" not in st.session_state:
+    st.session_state.mongo_connection = MongoDBConnection()
+mongo_connection = st.session_state.mongo_connection
+
 if "connected" not in st.session_state:
     st.session_state.connected = False
 if "collection" not in st.session_state:
     st.session_state.collection = None
 if "schema" not in st.session_state:
     st.session_state.schema = {}
-if "query_history" not in st.session_state:
-    st.session_state.query_history = []
+if "schema_stats" not in st.session_state:
+    st.session_state.schema_stats = {}
+if "schema_catalog" not in st.session_state:
+    st.session_state.schema_catalog = None
+if "active_request" not in st.session_state:
+    st.session_state.active_request = None
 if "last_query" not in st.session_state:
     st.session_state.last_query = None
 if "last_pipeline" not in st.session_state:
     st.session_state.last_pipeline = None
+if "last_intent" not in st.session_state:
+    st.session_state.last_intent = None
+if "live_chart" not in st.session_state:
+    st.session_state.live_chart = None
+if "approximate_query" not in st.session_state:
+    st.session_state.approximate_query = None
+    # (query, version, exact rendering, figure) of the last approximate chart drawn
+    st.session_state.approximate_figure = None
+
+def stop_live_chart():
+    """Stop auto-refreshing the current chart, closing its change stream"""
+    if st.session_state.live_chart is not None:
+        st.session_state.live_chart.stop()
+        st.session_state.live_chart = None
+
+def stop_approximate_query():
+    """Stop refining the current approximate chart"""
+    if st.session_state.approximate_query is not None:
+        st.session_state.approximate_query.stop()
+        st.session_state.approximate_query = None
+        st.session_state.approximate_figure = None
+
+def describe_estimate(estimate: dict) -> str:
+    """One line saying how an approximate result was computed"""
+    if estimate["exact"]:
+        return f"Exact result ({estimate['seconds']:.2f}s)"
+    share = estimate["sampled"] / estimate["population"] if estimate["population"] else 1.0
+    return (
+        f"Estimated from a random sample of {estimate['sampled']:,} of ~{estimate['population']:,} documents "
+        f"({share:.2%}, {estimate['seconds']:.2f}s); error bars show {estimate['confidence']:.0%} confidence intervals"
+    )
+
+@st.cache_data(ttl=30, show_spinner=False)
+def list_collections(client_id: int, db_name: str, _connection) -> list:
+    """Collection names, cached briefly so reruns don't each cost a server round trip"""
+    return _connection.get_collections()
+
+@st.cache_resource(show_spinner=False)
+def warm_up_query_parser() -> threading.Thread:
+    """Import langchain and build the prompt templates in the background, once per process"""
+    thread = threading.Thread(target=query_parser.warm_up, name="query-parser-warm-up", daemon=True)
+    thread.start()
+    return thread
 
 st.title("📊 MongoDB Chart Generator")
 st.markdown("""
@@ -64,19 +123,42 @@ with st.sidebar:
     # Collection selection if connected
     if st.session_state.connected:
         st.subheader("Collections")
-        collections = mongo_connection.get_collections()
+        collections = list_collections(id(mongo_connection.client), mongo_connection.db.name, mongo_connection)
         
         if collections:
             selected_collection = st.selectbox("Select a collection", collections)
             
             if selected_collection != st.session_state.collection:
+                stop_live_chart()
+                stop_approximate_query()
                 st.session_state.collection = selected_collection
+                # The last chart came from the old collection; it can't become a panel here
+                st.session_state.last_intent = None
                 with st.spinner("Analyzing collection schema..."):
-                    st.session_state.schema = detect_collection_schema(selected_collection)
+                    profile = get_collection_profile(selected_collection, connection=mongo_connection)
+                    has_documents = profile is not None and profile.documents > 0
+                    st.session_state.schema = profile.schema() if has_documents else {}
+                    st.session_state.schema_stats = profile.field_summaries() if has_documents else {}
                     if st.session_state.schema:
                         st.success(f"Schema detected for {selected_collection}!")
                     else:
                         st.warning(f"No schema could be detected for {selected_collection}.")
+            
+            # Database-wide catalog for cross-collection ($lookup) questions
+            if st.button("Discover All Collections"):
+                progress = st.progress(0.0, text="Discovering collection schemas...")
+                catalog = discover_schema_catalog(
+                    connection=mongo_connection,
+                    progress_callback=lambda done, total, name: progress.progress(
+                        done / total, text=f"Profiled {name} ({done}/{total})"
+                    )
+                )
+                progress.empty()
+                st.session_state.schema_catalog = catalog
+                st.success(f"Discovered schemas for {len(catalog.schemas)} collections.")
+                if catalog.errors:
+                    with st.expander(f"{len(catalog.errors)} collections failed"):
+                        st.json(catalog.errors)
         else:
             st.warning("No collections found in the database.")
     
@@ -84,6 +166,43 @@ with st.sidebar:
     if st.session_state.connected and st.session_state.schema:
         with st.expander("Collection Schema"):
             st.json(st.session_state.schema)
+        if st.session_state.schema_stats:
+            with st.expander("Field Statistics"):
+                st.dataframe(
+                    [{"field": field, **{k: v for k, v in stats.items() if k != "types"}}
+                     for field, stats in st.session_state.schema_stats.items()],
+                    hide_index=True
+                )
+    
+    # Connection pool metrics
+    if st.session_state.connected:
+        with st.expander("Connection Pool"):
+            st.dataframe(mongo_connection.pool_metrics(), hide_index=True)
+        
+        # Query budget and recent violations
+        with st.expander("Query Budget"):
+            if st.session_state.collection:
+                st.json(mongo_connection.query_guard.budget_for(st.session_state.collection).to_dict())
+            violations = list(mongo_connection.query_guard.recent_violations)
+            if violations:
+                st.dataframe(violations[::-1], hide_index=True)
+            else:
+                st.caption("No budget violations yet.")
+        
+        # Indexes that would have helped the most queries so far
+        recommendations = mongo_connection.index_recommendations(limit=10)
+        if recommendations:
+            with st.expander("Index Recommendations"):
+                st.dataframe(recommendations, hide_index=True)
+        
+        # Materialized rollups of the most frequently run grouped queries
+        if rollup_manager.enabled:
+            rollups = rollup_manager.report(mongo_connection.cluster_namespace(""))
+            with st.expander("Rollups"):
+                if rollups:
+                    st.dataframe(rollups, hide_index=True)
+                else:
+                    st.caption(f"Grouped queries run {rollup_manager.min_runs} times are materialized here.")
     
     # Google API Key
     st.subheader("LLM Settings")
@@ -92,77 +211,434 @@ with st.sidebar:
         os.environ["GOOGLE_API_KEY"] = google_key
         st.success("Google API Key set!")
     else:
-        st.warning("Google API Key is required for natural language queries.")
+        st.info("Without a Google API Key only common question shapes (e.g. 'count of X by Y') can be answered.")
+    
+    cache_stats = intent_cache.stats()
+    st.caption(
+        f"Intent cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+        f"({cache_stats['hit_rate']:.0%} hit rate)"
+    )
+    source_counts = query_parser.source_counts
+    st.caption(
+        f"Served by: {source_counts['cache']} cache / {source_counts['rules']} rules / {source_counts['llm']} LLM"
+    )
 
 # Main content
 if st.session_state.connected and st.session_state.collection:
+    from models.live_chart import LiveChart, LIVE_REFRESH_INTERVAL
+    from models.request_pipeline import RequestPipeline, CancelToken, RequestCancelled
+    from visualizations.figure_cache import figure_cache
+    from models.dashboard import Dashboard, DashboardExecutor, dashboard_store
+    from visualizations.chart_generator import ChartGenerator
+    from models.history_store import history_store
+    
+    # A question is likely next; load the LLM stack while it's being typed
+    warm_up_query_parser()
+    request_pipeline = RequestPipeline(connection=mongo_connection)
+    
     # Query input
     st.subheader("Ask a Question About Your Data")
     query = st.text_area("Enter your query (e.g., 'Show number of documents by category')", height=100, 
                           help="Describe what data you want to see and how you want it visualized.")
     
+    exact_rendering = st.checkbox(
+        "Exact rendering", value=False,
+        help="Plot every point instead of binning/downsampling large line and scatter charts."
+    )
+    allow_expensive = st.checkbox(
+        "Run expensive queries in full", value=False,
+        help="Skip the sampled preview for queries estimated to scan more documents than the collection's budget."
+    )
+    approximate = st.checkbox(
+        "Approximate (fast estimates)", value=False,
+        help="Answer grouped questions from a small random sample first, with error bars, then refine "
+             "with larger samples and the exact result in the background."
+    )
+    auto_refresh = st.checkbox(
+        "Auto-refresh", value=False,
+        help="Keep the chart up to date as documents are added, aggregating only the new ones where possible."
+    )
+    refresh_interval = LIVE_REFRESH_INTERVAL
+    if auto_refresh:
+        refresh_interval = st.number_input(
+            "Refresh every (seconds)", min_value=1.0, value=LIVE_REFRESH_INTERVAL, step=1.0
+        )
+    
+    # Editing the query cancels a request that is still running for the old text
+    active_request = st.session_state.active_request
+    if active_request is not None and active_request["query"] != query:
+        active_request["token"].cancel()
+    
+    generate_col, cancel_col = st.columns([1, 1])
+    generate = generate_col.button("Generate Chart")
+    # Clicking reruns the script, which interrupts the waiting request (see on_poll below);
+    # the request's server-side operation is killed with it
+    if cancel_col.button("Cancel Query") and active_request is not None:
+        active_request["token"].cancel()
+    
     # Process query button
-    if st.button("Generate Chart"):
+    if generate:
         if not query:
             st.error("Please enter a query.")
         elif not st.session_state.schema:
             st.error("Schema information is not available. Please select a valid collection.")
-        elif not os.getenv("GOOGLE_API_KEY") and not google_key:
-            st.error("Google API Key is required for natural language queries.")
         else:
-            with st.spinner("Processing your query..."):
-                # Parse the query
-                intent = query_parser.parse_query(
-                    query, 
-                    st.session_state.collection, 
-                    st.session_state.schema
-                )
+            stop_live_chart()
+            stop_approximate_query()
+            # Cancel a previous request that is still running for an older query
+            if st.session_state.active_request is not None:
+                st.session_state.active_request["token"].cancel()
+            token = CancelToken()
+            st.session_state.active_request = {"query": query, "token": token}
+            
+            stage_labels = {
+                "parse": "Interpreting query",
+                "prewarm": "Warming connection and schema",
+                "build": "Building aggregation pipeline",
+                "preflight": "Estimating query cost",
+                "execute": "Running aggregation",
+                "chart": "Rendering chart",
+            }
+            with st.status("Processing your query...", expanded=False) as status:
+                running = {"label": "Processing your query", "since": time.perf_counter()}
                 
-                if intent:
-                    # Create a safe aggregation pipeline
-                    pipeline = AggregationBuilder.create_safe_aggregation_from_intent(intent)
-                    
-                    # Execute the query
-                    results = mongo_connection.execute_query(st.session_state.collection, pipeline)
-                    
-                    # Save to session state
-                    st.session_state.last_query = query
-                    st.session_state.last_pipeline = pipeline
-                    
-                    # Add to query history
-                    st.session_state.query_history.append({
-                        "query": query,
-                        "pipeline": pipeline,
-                        "intent": intent.dict() if intent else None
-                    })
-                    
-                    # Display results
-                    st.subheader("Generated Chart")
-                    
-                    # Show the MongoDB query
-                    with st.expander("MongoDB Aggregation Pipeline"):
-                        st.code(json.dumps(pipeline, indent=2), language="json")
-                    
-                    # Generate visualization
-                    fig = ChartGenerator.generate_chart(results, intent)
-                    if fig:
+                def on_stage(stage, state, seconds):
+                    if state == "running":
+                        running.update(label=stage_labels.get(stage, stage), since=time.perf_counter())
+                        status.update(label=f"{running['label']}...")
+                    elif state == "done":
+                        st.write(f"✓ {stage_labels.get(stage, stage)} ({seconds:.2f}s)")
+                
+                def on_poll():
+                    # Each update is a point where Streamlit can stop this run for a Cancel Query click
+                    status.update(label=f"{running['label']}... ({time.perf_counter() - running['since']:.0f}s)")
+                
+                try:
+                    result = request_pipeline.run_sync(
+                        query,
+                        st.session_state.collection,
+                        st.session_state.schema,
+                        st.session_state.schema_catalog,
+                        exact=exact_rendering,
+                        on_stage=on_stage,
+                        token=token,
+                        allow_expensive=allow_expensive,
+                        approximate=approximate and not auto_refresh,
+                        on_poll=on_poll
+                    )
+                except RequestCancelled:
+                    result = None
+                    status.update(label="Cancelled", state="error")
+                finally:
+                    st.session_state.active_request = None
+                if result is not None:
+                    status.update(label="Done", state="complete")
+            
+            intent = result["intent"] if result else None
+            if result is None:
+                st.info("The request was cancelled.")
+            elif intent:
+                pipeline = result["pipeline"]
+                df = result["df"]
+                fig = result["fig"]
+                
+                # Save to session state
+                st.session_state.last_query = query
+                st.session_state.last_pipeline = pipeline
+                st.session_state.last_intent = intent
+                
+                # Add to the shared query history, with a snapshot of the result for replaying
+                with tracer.span("history.save", trace_id=result["trace_id"]):
+                    history_store.record(
+                        mongo_connection.namespace(st.session_state.collection), query, intent.dict(), pipeline,
+                        df, result["timings"], source=intent.source, exact=exact_rendering,
+                        approximate=result["approximate"] is not None, truncated=result["truncated"],
+                        preview=result["preview"] is not None
+                    )
+                
+                # Display results
+                st.subheader("Generated Chart")
+                
+                # Show the MongoDB query
+                with st.expander("MongoDB Aggregation Pipeline"):
+                    st.caption(f"Interpreted by: {intent.source}")
+                    st.code(json.dumps(pipeline, indent=2), language="json")
+                    if result["optimizer_notes"]:
+                        st.markdown("**Optimizations applied**")
+                        st.markdown("\n".join(f"- {note}" for note in result["optimizer_notes"]))
+                        st.caption("Pipeline as generated:")
+                        st.code(json.dumps(result["original_pipeline"], indent=2), language="json")
+                
+                # Query plan and index advice
+                plan = result["plan"]
+                if plan is not None:
+                    with st.expander("Query Plan"):
+                        if plan["docs_examined"] is not None:
+                            st.write(
+                                f"Examined {plan['docs_examined']:,} documents and {plan['keys_examined']:,} "
+                                f"index keys to return {plan['returned']:,} ({plan['execution_ms']} ms)"
+                            )
+                        st.write(f"Indexes used: {', '.join(plan['indexes_used']) or 'none'}")
+                        if plan["collscan"]:
+                            st.warning("This query scans the whole collection.")
+                        if plan["in_memory_sort"]:
+                            st.warning("This query sorts documents in memory.")
+                        if plan["suggested_index"]:
+                            st.markdown("**Suggested index**")
+                            st.code(
+                                f"db.{st.session_state.collection}.createIndex({plan['suggested_index']})",
+                                language="javascript"
+                            )
+                
+                if result["preview"]:
+                    preview = result["preview"]
+                    st.warning(
+                        f"This query {preview['reason']}, so the chart shows a preview computed on a random "
+                        f"sample of {preview['sample_size']:,} documents. Tick 'Run expensive queries in full' "
+                        "to run it on the whole collection."
+                    )
+                
+                if result["truncated"]:
+                    st.warning(f"Results were truncated to {len(df):,} rows to stay within the memory limits.")
+                
+                # Live charts re-run the query on their own and render below
+                if fig and auto_refresh and not result["preview"]:
+                    live = LiveChart(request_pipeline, st.session_state.collection, intent,
+                                     st.session_state.schema, exact=exact_rendering,
+                                     allow_expensive=allow_expensive)
+                    try:
+                        live.start()
+                        st.session_state.live_chart = live
+                    except Exception as e:
+                        live.stop()
+                        st.error(f"Could not start auto-refresh: {str(e)}")
+                
+                # Approximate charts are refined in the background and render below
+                approximate_query = result["approximate"]
+                if fig and approximate_query is not None and approximate_query.latest is not None:
+                    approximate_query.refine()
+                    st.session_state.approximate_query = approximate_query
+                
+                # Generate visualization
+                if fig and st.session_state.live_chart is None and st.session_state.approximate_query is None:
+                    # Serialization and rendering happen here, after the request's own spans
+                    with tracer.span("chart.render", trace_id=result["trace_id"]):
                         st.plotly_chart(fig, use_container_width=True)
-                        
-                        # Show data table
-                        with st.expander("Raw Data"):
-                            df = pd.DataFrame(results)
-                            st.dataframe(df)
+                    
+                    # Show data table
+                    with st.expander("Raw Data"):
+                        st.dataframe(df)
+                elif not fig:
+                    st.error("Failed to generate chart from the results.")
+            else:
+                st.error("Failed to interpret your query. Please try rewording it.")
+    
+    # Auto-refreshing chart: only this fragment reruns on each tick
+    if st.session_state.live_chart is not None:
+        @st.fragment(run_every=f"{refresh_interval}s" if auto_refresh else None)
+        def live_chart_panel():
+            live = st.session_state.live_chart
+            if live is None:
+                return
+            try:
+                update = live.refresh()
+            except Exception as e:
+                st.error(f"Error refreshing chart: {str(e)}")
+                return
+            if live.figure is not None:
+                st.plotly_chart(live.figure, use_container_width=True, key="live_chart")
+            st.caption(
+                f"Live ({live.mode}) · refresh {live.refreshes}: {update['new_documents']:,} new documents, "
+                f"{update['changed_groups']:,} groups updated in {update['seconds']:.2f}s"
+            )
+            if live.preview is not None:
+                st.caption(f"Computed on a random sample of {live.preview['sample_size']:,} documents "
+                           f"because the query {live.preview['reason']}.")
+            elif live.truncated:
+                st.caption(f"Results were truncated to {len(live.df):,} rows to stay within the memory limits.")
+            with st.expander("Raw Data"):
+                st.dataframe(live.df)
+        
+        st.subheader(f"Live Chart: {st.session_state.last_query}")
+        live_chart_panel()
+        if not auto_refresh:
+            st.caption("Auto-refresh is paused.")
+        if st.button("Stop Live Chart"):
+            stop_live_chart()
+            st.rerun()
+    
+    # Approximate chart: only this fragment reruns while larger samples come in
+    if st.session_state.approximate_query is not None:
+        refining = st.session_state.approximate_query
+        was_refining = refining.refining
+        
+        @st.fragment(run_every="1s" if was_refining else None)
+        def approximate_chart_panel():
+            version, estimate = refining.current()
+            # Only rebuild the figure when a more refined result has been published
+            cached = st.session_state.approximate_figure
+            if cached is not None and cached[0] is refining and cached[1:3] == (version, exact_rendering):
+                fig = cached[3]
+            else:
+                fig = ChartGenerator.generate_chart(estimate["df"], st.session_state.last_intent,
+                                                    exact=exact_rendering)
+                st.session_state.approximate_figure = (refining, version, exact_rendering, fig)
+            if fig is not None:
+                st.plotly_chart(fig, use_container_width=True, key="approximate_chart")
+            st.caption(describe_estimate(estimate) + (" · refining..." if refining.refining else ""))
+            with st.expander("Raw Data"):
+                st.dataframe(estimate["df"])
+            if was_refining and not refining.refining:
+                # Finished: rerun once more so the panel stops polling
+                st.rerun()
+        
+        st.subheader(f"Approximate Chart: {st.session_state.last_query}")
+        approximate_chart_panel()
+        if refining.refining and st.button("Stop Refining"):
+            refining.stop()
+            st.rerun()
+    
+    # Dashboards: saved sets of charts rendered together, sharing collection scans where possible
+    st.subheader("Dashboards")
+    database = mongo_connection.db.name
+    saved_dashboards = dashboard_store.list(database, st.session_state.collection)
+    name_col, new_col = st.columns([1, 1])
+    dashboard_name = name_col.selectbox("Dashboard", saved_dashboards) if saved_dashboards else None
+    new_name = new_col.text_input("New dashboard name")
+    add_col, open_col, delete_col = st.columns([1, 1, 1])
+    
+    if add_col.button("Add Last Chart", disabled=st.session_state.last_intent is None,
+                      help="Add the most recently generated chart as a panel"):
+        target = new_name.strip() or dashboard_name
+        if not target:
+            st.error("Enter a name for the new dashboard.")
+        else:
+            dashboard = dashboard_store.load(database, target) or Dashboard(
+                target, database, st.session_state.collection
+            )
+            # Panels run against the dashboard's collection, so they must come from it
+            if dashboard.collection != st.session_state.collection:
+                st.error(f"Dashboard {target} shows {dashboard.collection}; choose another name for "
+                         f"a {st.session_state.collection} dashboard.")
+            else:
+                dashboard.add_panel(st.session_state.last_query, st.session_state.last_intent)
+                dashboard_store.save(dashboard)
+                st.success(f"Added to {target} ({len(dashboard.panels)} panels).")
+    
+    if delete_col.button("Delete Dashboard", disabled=dashboard_name is None):
+        dashboard_store.delete(database, dashboard_name)
+        st.rerun()
+    
+    if open_col.button("Open Dashboard", disabled=dashboard_name is None):
+        dashboard = dashboard_store.load(database, dashboard_name)
+        if dashboard is None or not dashboard.panels:
+            st.info("This dashboard has no panels yet.")
+        else:
+            with st.spinner(f"Loading {len(dashboard.panels)} panels..."):
+                panels = DashboardExecutor(request_pipeline).run(
+                    dashboard, st.session_state.schema, exact=exact_rendering, allow_expensive=allow_expensive
+                )
+            shared = sum(panel["shared"] for panel in panels)
+            st.caption(f"{len(panels)} panels, {shared} served by shared scans")
+            columns = st.columns(2)
+            for i, panel in enumerate(panels):
+                with columns[i % 2]:
+                    st.markdown(f"**{panel['intent'].title or panel['query']}**")
+                    if panel["preview"]:
+                        st.caption(f"Preview on a sample of {panel['preview']['sample_size']:,} documents")
+                    if panel["truncated"]:
+                        st.caption(f"Truncated to {len(panel['df']):,} rows")
+                    if panel["fig"] is not None:
+                        st.plotly_chart(panel["fig"], use_container_width=True, key=f"dashboard_panel_{i}")
                     else:
-                        st.error("Failed to generate chart from the results.")
-                else:
-                    st.error("Failed to interpret your query. Please try rewording it.")
-    
-    # Query history
-    if st.session_state.query_history:
-        st.subheader("Query History")
-        for i, history_item in enumerate(reversed(st.session_state.query_history)):
-            with st.expander(f"Query {len(st.session_state.query_history) - i}: {history_item['query'][:50]}..."):
-                st.code(json.dumps(history_item['pipeline'], indent=2), language="json")
+                        st.info("No data for this panel.")
+    
+    # Where the time went in recent requests
+    recent_traces = tracer.traces(root="request", limit=1)
+    if recent_traces:
+        with st.expander("Performance"):
+            last_n = st.slider("Requests", min_value=1, max_value=tracer.history, value=min(20, tracer.history))
+            st.markdown("**Per-stage percentiles (self time)**")
+            st.dataframe(tracer.percentiles(last_n, root="request"), hide_index=True)
+            figure_stats = figure_cache.stats()
+            st.caption(
+                f"Figure cache: {figure_stats['hits']} hits / {figure_stats['misses']} misses, "
+                f"{figure_stats['entries']} figures ({figure_stats['bytes'] / 1024 / 1024:.1f} MB)"
+            )
+            st.markdown("**Breakdown per request (ms)**")
+            st.dataframe(tracer.stage_breakdown(last_n, root="request"), hide_index=True)
+            st.markdown("**Last request spans**")
+            st.dataframe(
+                [{"span": span["name"], "ms": round(span["duration_ms"], 2), "status": span["status"],
+                  **span["attributes"]} for span in recent_traces[0]["spans"]],
+                hide_index=True
+            )
+    
+    # Query history, shared by every session: replay from the saved result or refresh against the collection
+    st.subheader("Query History")
+    namespace = mongo_connection.namespace(st.session_state.collection)
+    search_col, order_col = st.columns([3, 1])
+    history_search = search_col.text_input("Search past questions")
+    history_order = order_col.selectbox("Sort by", ["recent", "popular"], format_func=str.title)
+    if history_search.strip():
+        history_entries = history_store.search(history_search, namespace)
+    else:
+        history_entries = history_store.list(namespace, order=history_order)
+    if not history_entries:
+        st.caption("No matching questions yet." if history_search.strip() else "Questions you ask are saved here.")
+    
+    for entry in history_entries:
+        popularity = f"{entry['runs']} runs, {entry['replays']} replays"
+        with st.expander(f"{entry['query'][:80]} ({popularity})"):
+            timings = entry["timings"] or {}
+            st.caption(
+                f"Interpreted by: {entry['source'] or 'unknown'} · {entry['rows'] or 0:,} rows · "
+                f"{sum(timings.values()):.2f}s to answer · "
+                f"last used {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used']))}"
+            )
+            st.code(json.dumps(entry["pipeline"], indent=2), language="json")
+            replay_col, refresh_col = st.columns([1, 1])
+            replay = replay_col.button("Replay", key=f"history_replay_{entry['id']}",
+                                       disabled=not entry["snapshot_bytes"],
+                                       help="Show the saved result without querying the collection")
+            refresh = refresh_col.button("Refresh", key=f"history_refresh_{entry['id']}",
+                                         help="Run the saved pipeline again (no LLM call) and update the snapshot")
+            if not replay and not refresh:
+                continue
+            
+            intent = MongoQueryIntent(**entry["intent"])
+            if replay:
+                replayed = history_store.replay(entry["id"])
+                history_df = replayed[1] if replayed else None
+                if history_df is None:
+                    st.error("The saved result could not be read; refresh it instead.")
+                    continue
+                estimated = " (estimate)" if entry["meta"].get("approximate") else ""
+                st.caption(f"Saved result{estimated}, computed "
+                           f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['computed_at']))}")
+            else:
+                with st.spinner("Running the saved query..."):
+                    refresh_started = time.perf_counter()
+                    history_pipeline, _, _ = request_pipeline.build_pipeline(
+                        intent, st.session_state.collection, st.session_state.schema, exact_rendering
+                    )
+                    run_pipeline, preview = request_pipeline.guard_pipeline(
+                        st.session_state.collection, history_pipeline, allow_expensive
+                    )
+                    history_df, truncated = request_pipeline.execute(st.session_state.collection, run_pipeline)
+                    history_store.record(
+                        namespace, entry["query"], entry["intent"], history_pipeline, history_df,
+                        {"execute": time.perf_counter() - refresh_started}, source=entry["source"],
+                        exact=exact_rendering, approximate=False, truncated=truncated, preview=preview is not None
+                    )
+                if preview:
+                    st.caption(f"Preview on a sample of {preview['sample_size']:,} documents")
+            if history_df.empty:
+                st.info("No data for this question.")
+                continue
+            history_fig = ChartGenerator.generate_chart(history_df, intent, exact=exact_rendering)
+            if history_fig is not None:
+                st.plotly_chart(history_fig, use_container_width=True, key=f"history_chart_{entry['id']}")
 
 else:
     # Not connected or no collection selected
@@ -0,0 +1,225 @@
+"""Generate charts for a file of (collection, question) pairs without the Streamlit UI.
+
+Usage:
+    python batch.py questions.jsonl --output-dir charts --formats html,json --workers 8
+
+Each input line (JSONL) or list item (YAML) looks like:
+    {"collection": "orders", "question": "Number of orders per region", "name": "orders_by_region"}
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Any, Optional
+
+from dotenv import load_dotenv
+
+from utils.mongo_connection import MongoDBConnection
+from utils.schema_detection import build_collection_profile
+from models.intent_cache import normalize_query
+from models.query_parser import query_parser
+from models.request_pipeline import RequestPipeline
+from visualizations.chart_generator import ChartGenerator
+
+load_dotenv()
+
+def load_requests(path: str) -> List[Dict[str, Any]]:
+    """Read chart requests from a JSONL or YAML file"""
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("PyYAML is required for YAML input (pip install pyyaml)")
+            items = yaml.safe_load(f) or []
+        else:
+            items = [json.loads(line) for line in f if line.strip()]
+
+    for item in items:
+        if not item.get("collection") or not item.get("question"):
+            raise SystemExit(f"Each request needs a collection and a question: {item}")
+    return items
+
+def output_name(item: Dict[str, Any]) -> str:
+    """File name stem for a request's outputs"""
+    if item.get("name"):
+        return re.sub(r"[^\w.-]+", "_", item["name"])
+    slug = re.sub(r"[^\w]+", "_", item["question"].lower()).strip("_")[:60]
+    digest = hashlib.sha1(f"{item['collection']}:{item['question']}".encode("utf-8")).hexdigest()[:8]
+    return f"{item['collection']}_{slug}_{digest}"
+
+class BatchRunner:
+    """Parse, execute and render many chart requests, reporting per-stage timings"""
+
+    def __init__(self, connection: MongoDBConnection, output_dir: str, formats: List[str], workers: int = 4,
+                 questions_per_call: int = 10):
+        self.connection = connection
+        self.questions_per_call = questions_per_call
+        self.output_dir = output_dir
+        self.formats = formats
+        self.workers = workers
+        self.pipeline = RequestPipeline(connection=connection, parser=query_parser)
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+
+    def _timed(self, stage: str, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[stage].append(time.perf_counter() - start)
+
+    def run(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        # Identical questions (after normalization) are only parsed and run once
+        unique: Dict[tuple, Dict[str, Any]] = {}
+        aliases: Dict[tuple, List[Dict[str, Any]]] = defaultdict(list)
+        for item in items:
+            key = (item["collection"], normalize_query(item["question"]))
+            unique.setdefault(key, item)
+            aliases[key].append(item)
+
+        # Group by collection so each schema is profiled once and reused for every prompt
+        by_collection: Dict[str, List[tuple]] = defaultdict(list)
+        for key in unique:
+            by_collection[key[0]].append(key)
+
+        intents = {}
+        schemas = {}
+        for collection_name, keys in by_collection.items():
+            profile = self._timed("schema", build_collection_profile, collection_name, connection=self.connection)
+            schemas[collection_name] = profile.schema() if profile is not None else {}
+            # Several questions share one LLM call (and one copy of the schema context)
+            for start in range(0, len(keys), self.questions_per_call):
+                chunk = keys[start:start + self.questions_per_call]
+                parsed = self._timed(
+                    "parse", query_parser.parse_queries,
+                    [unique[key]["question"] for key in chunk], collection_name, schemas[collection_name],
+                    namespace=self.connection.namespace(collection_name)
+                )
+                intents.update(zip(chunk, parsed))
+
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as executor:
+            futures = {
+                executor.submit(self._render, unique[key], intents[key], schemas[key[0]], aliases[key]): key
+                for key in unique
+            }
+            for future in as_completed(futures):
+                results.extend(future.result())
+        return results
+
+    def _render(self, item: Dict[str, Any], intent, schema: Dict[str, str],
+                aliases: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Execute one unique request and write outputs for it and its duplicates"""
+        collection_name = item["collection"]
+        if intent is None:
+            return [{"name": output_name(a), "status": "failed", "error": "could not parse question"} for a in aliases]
+
+        try:
+            pipeline, _, _ = self._timed("build", self.pipeline.build_pipeline, intent, collection_name, schema)
+            df, truncated = self._timed("execute", self.pipeline.execute, collection_name, pipeline)
+            fig = self._timed("chart", ChartGenerator.generate_chart, df, intent)
+            if fig is None:
+                raise RuntimeError("no chart could be generated from the results")
+
+            outputs = []
+            for alias in aliases:
+                stem = os.path.join(self.output_dir, output_name(alias))
+                written = self._timed("write", self._write, fig, stem)
+                outputs.append({
+                    "name": output_name(alias),
+                    "status": "ok",
+                    "source": intent.source,
+                    "rows": len(df),
+                    "truncated": truncated,
+                    "files": written,
+                    "pipeline": pipeline,
+                })
+            return outputs
+        except Exception as e:
+            return [{"name": output_name(a), "status": "failed", "error": str(e)} for a in aliases]
+
+    def _write(self, fig, stem: str) -> List[str]:
+        written = []
+        for fmt in self.formats:
+            path = f"{stem}.{fmt}"
+            if fmt == "html":
+                fig.write_html(path, include_plotlyjs="cdn")
+            elif fmt == "json":
+                with open(path, "w") as f:
+                    f.write(fig.to_json())
+            elif fmt == "png":
+                # Requires kaleido
+                fig.write_image(path)
+            else:
+                raise ValueError(f"Unsupported output format: {fmt}")
+            written.append(path)
+        return written
+
+    def timing_summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, total and mean seconds per stage"""
+        return {
+            stage: {
+                "count": len(values),
+                "total_s": round(sum(values), 4),
+                "mean_s": round(sum(values) / len(values), 4),
+            }
+            for stage, values in self.timings.items() if values
+        }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Generate charts from a file of questions")
+    parser.add_argument("input", help="JSONL or YAML file of {collection, question[, name]} entries")
+    parser.add_argument("--uri", default=os.getenv("MONGO_URI", ""), help="MongoDB URI (default: $MONGO_URI)")
+    parser.add_argument("--db", default=os.getenv("MONGO_DB_NAME", ""), help="Database name (default: $MONGO_DB_NAME)")
+    parser.add_argument("--output-dir", default="charts")
+    parser.add_argument("--formats", default="html,json", help="Comma-separated: png,html,json")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent aggregations")
+    parser.add_argument("--questions-per-call", type=int, default=10, help="Questions sent in one LLM call")
+    args = parser.parse_args(argv)
+
+    if not args.uri or not args.db:
+        print("A MongoDB URI and database name are required (--uri/--db or MONGO_URI/MONGO_DB_NAME).", file=sys.stderr)
+        return 2
+
+    items = load_requests(args.input)
+    connection = MongoDBConnection()
+    if not connection.connect(args.uri, args.db):
+        print("Failed to connect to MongoDB.", file=sys.stderr)
+        return 1
+
+    runner = BatchRunner(connection, args.output_dir, [f.strip() for f in args.formats.split(",") if f.strip()],
+                         args.workers, args.questions_per_call)
+    start = time.perf_counter()
+    results = runner.run(items)
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "requests": len(items),
+        "succeeded": sum(1 for r in results if r["status"] == "ok"),
+        "failed": sum(1 for r in results if r["status"] != "ok"),
+        "elapsed_s": round(elapsed, 3),
+        "stages": runner.timing_summary(),
+        "results": results,
+    }
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+
+    print(f"{summary['succeeded']}/{summary['requests']} charts generated in {elapsed:.1f}s")
+    for stage, stats in summary["stages"].items():
+        print(f"  {stage:<8} {stats['count']:>5} calls  {stats['total_s']:>9.3f}s total  {stats['mean_s']:>8.4f}s mean")
+    for result in results:
+        if result["status"] != "ok":
+            print(f"  FAILED {result['name']}: {result['error']}", file=sys.stderr)
+
+    connection.disconnect()
+    return 0 if summary["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
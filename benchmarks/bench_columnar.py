@@ -0,0 +1,160 @@
+"""Compare result decoding paths: list-of-dicts vs streamed columns vs Arrow.
+
+Usage:
+    python -m benchmarks.bench_columnar                 # offline, decodes pre-encoded BSON batches
+    python -m benchmarks.bench_columnar --uri mongodb://localhost:27017 --db bench
+
+Each (path, size) case runs in a fresh process so peak RSS is not polluted by
+earlier cases. Offline mode simulates the cursor by decoding BSON batches the
+way the driver would; the Arrow path needs a live server and pymongoarrow.
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Dict, List, Any, Iterator
+
+import bson
+import pandas as pd
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+BATCH_SIZE = 1000
+
+def make_document(i: int) -> Dict[str, Any]:
+    """A grouped-result shaped document with a compound _id"""
+    return {
+        "_id": {"region": f"region_{i % 17}", "day": i % 365},
+        "count": i % 1000,
+        "total": i * 0.5,
+        "label": f"item_{i % 5000}",
+    }
+
+def encoded_batches(rows: int) -> List[bytes]:
+    """Pre-encode documents into BSON batches, as a cursor would receive them"""
+    batches = []
+    for start in range(0, rows, BATCH_SIZE):
+        end = min(start + BATCH_SIZE, rows)
+        batches.append(b"".join(bson.encode(make_document(i)) for i in range(start, end)))
+    return batches
+
+def legacy_convert(data: List[Dict[str, Any]]) -> pd.DataFrame:
+    """The original per-row _id flattening, kept as the baseline"""
+    for item in data:
+        if '_id' in item and isinstance(item['_id'], (dict, list)):
+            for key, value in item['_id'].items() if isinstance(item['_id'], dict) else enumerate(item['_id']):
+                item[f"_id_{key}"] = value
+            del item['_id']
+    return pd.DataFrame(data)
+
+def _peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_case(path: str, rows: int, uri: str, db_name: str, queue):
+    """Run one case in a child process and report timing and memory"""
+    from visualizations.chart_generator import ChartGenerator
+
+    if uri:
+        from pymongo import MongoClient
+        collection = MongoClient(uri)[db_name]["bench_columnar"]
+        pipeline = [
+            {"$limit": rows},
+            {"$project": {"_id": "$key", "count": 1, "total": 1, "label": 1}},
+        ]
+    else:
+        batches = encoded_batches(rows)
+    baseline = _peak_rss_kb()
+
+    start = time.perf_counter()
+    if path == "list_of_dicts":
+        if uri:
+            docs = list(collection.aggregate(pipeline, batchSize=BATCH_SIZE))
+        else:
+            docs = [doc for batch in batches for doc in bson.decode_all(batch)]
+        df = legacy_convert(docs)
+    elif path == "streamed_columns":
+        if uri:
+            stream = _cursor_batches(collection.aggregate(pipeline, batchSize=BATCH_SIZE))
+        else:
+            stream = (bson.decode_all(batch) for batch in batches)
+        df = ChartGenerator.batches_to_dataframe(stream)
+    elif path == "arrow":
+        from pymongoarrow.api import aggregate_arrow_all
+        df = ChartGenerator.columnar_to_dataframe(aggregate_arrow_all(collection, pipeline))
+    else:
+        raise ValueError(f"Unknown path {path}")
+    elapsed = time.perf_counter() - start
+
+    queue.put({
+        "path": path,
+        "rows": rows,
+        "result_rows": len(df),
+        "seconds": round(elapsed, 4),
+        "rows_per_sec": round(rows / elapsed) if elapsed else None,
+        "peak_rss_delta_mb": round((_peak_rss_kb() - baseline) / 1024, 1),
+    })
+
+def _cursor_batches(cursor) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def seed(uri: str, db_name: str, rows: int):
+    """Insert the synthetic documents into a live server"""
+    from pymongo import MongoClient
+    collection = MongoClient(uri)[db_name]["bench_columnar"]
+    if collection.estimated_document_count() >= rows:
+        return
+    collection.drop()
+    for start in range(0, rows, 10_000):
+        docs = [make_document(i) for i in range(start, min(start + 10_000, rows))]
+        for offset, doc in enumerate(docs):
+            # Seeded documents need a unique _id; keep the compound key under "key"
+            doc["key"] = doc.pop("_id")
+            doc["_id"] = start + offset
+        collection.insert_many(docs)
+
+def main(argv=None) -> List[Dict[str, Any]]:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--uri", default="")
+    parser.add_argument("--db", default="mongochart_bench")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    paths = ["list_of_dicts", "streamed_columns"]
+    if args.uri:
+        seed(args.uri, args.db, max(args.sizes))
+        # Checked without importing it, so the parent process stays light for the spawned children
+        if importlib.util.find_spec("pymongoarrow") is not None:
+            paths.append("arrow")
+        else:
+            print("pymongoarrow not installed; skipping the arrow path", file=sys.stderr)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for rows in args.sizes:
+        for path in paths:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_case, args=(path, rows, args.uri, args.db, queue))
+            proc.start()
+            result = queue.get()
+            proc.join()
+            results.append(result)
+            print(f"{path:>18} {rows:>9,} rows  {result['seconds']:>8.3f}s  "
+                  f"{result['rows_per_sec'] or 0:>10,} rows/s  +{result['peak_rss_delta_mb']} MB peak RSS")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""End-to-end and per-stage benchmarks on synthetic collections.
+
+Usage:
+    python -m benchmarks.bench_suite                       # in-process mongomock, 1k and 10k docs
+    python -m benchmarks.bench_suite --uri mongodb://localhost:27017 --sizes 1000 100000 10000000
+    python -m benchmarks.bench_suite --output current.json --compare baseline.json
+
+Every collection size/shape/cardinality combination is seeded once (and
+reused on later runs against a live server), then each benchmark runs
+`--repeat` times after `--warmup` untimed runs. The LLM is replaced by a
+deterministic fake returning canned intents, and the rule-based fast path
+and intent cache are bypassed so the full parse path is measured.
+
+Results are written as JSON ({"meta": ..., "results": [...]}) with one row
+per (benchmark, case, query); `benchmarks.compare` diffs two such files.
+mongomock is pure Python, so use a live mongod for anything above ~100k docs.
+"""
+import os
+
+# Keep benchmark runs away from the app's on-disk caches and logs; set before the app modules load
+for _name in ("INTENT_CACHE_PATH", "SCHEMA_CACHE_PATH", "QUERY_VIOLATION_LOG", "TRACE_JSONL_PATH"):
+    os.environ[_name] = ""
+os.environ.setdefault("TRACE_HISTORY", "1000")
+
+import argparse
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Callable, Optional, Tuple
+
+import pandas as pd
+import plotly
+import pymongo
+
+from benchmarks import datasets
+from benchmarks.fake_llm import install as install_fake_llm
+from models.intent_cache import intent_cache
+from models.query_parser import MongoQueryIntent, query_parser
+from models.request_pipeline import RequestPipeline
+from models.rule_parser import rule_parser
+from utils.mongo_connection import MongoDBConnection
+from utils.result_cache import result_cache
+from utils.schema_detection import detect_collection_schema
+from utils.tracing import tracer
+from visualizations.chart_generator import ChartGenerator
+from visualizations.chart_selector import ChartSelector
+
+DEFAULT_SIZES = [1_000, 10_000]
+
+def timed(func: Callable, repeat: int, warmup: int = 1,
+          setup: Optional[Callable] = None) -> Tuple[List[float], Any]:
+    """Seconds per call over `repeat` runs (after `warmup` untimed ones) and the last result"""
+    result = None
+    timings = []
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            timings.append(elapsed)
+    return timings, result
+
+def summarize(timings: List[float], items: Optional[int] = None) -> Dict[str, Any]:
+    """min/median/p95 in ms and, given the number of items processed, items per second"""
+    ordered = sorted(timings)
+    median = statistics.median(ordered)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    return {
+        "repeat": len(ordered),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "median_ms": round(median * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "items_per_sec": round(items / median) if items and median else None,
+    }
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def connect(uri: str, db_name: str) -> Tuple[MongoDBConnection, str]:
+    """Connection to a live server, or to an in-process mongomock database"""
+    connection = MongoDBConnection()
+    if uri:
+        if not connection.connect(uri, db_name):
+            sys.exit(f"Could not connect to {uri}")
+        version = connection.client.server_info().get("version", "unknown")
+        return connection, f"mongod {version}"
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is not installed (pip install mongomock), or pass --uri for a live server")
+    connection.client = mongomock.MongoClient()
+    connection.db = connection.client[db_name]
+    return connection, f"mongomock {mongomock.__version__}"
+
+class Suite:
+    """Runs the benchmarks for each seeded collection and collects result rows"""
+
+    def __init__(self, connection: MongoDBConnection, repeat: int, warmup: int):
+        self.connection = connection
+        self.repeat = repeat
+        self.warmup = warmup
+        self.pipeline = RequestPipeline(connection=connection, parser=query_parser)
+        self.results: List[Dict[str, Any]] = []
+
+    def add(self, benchmark: str, case: Dict[str, Any], timings: List[float], items: Optional[int] = None,
+            query: Optional[str] = None, **extra):
+        row = {"benchmark": benchmark, **case, "query": query, **summarize(timings, items), **extra}
+        self.results.append(row)
+        label = f"{benchmark} [{case['case']}]" + (f" {query[:40]}" if query else "")
+        print(f"{label:<90} median {row['median_ms']:>10.2f} ms  p95 {row['p95_ms']:>10.2f} ms", flush=True)
+
+    def run_collection(self, shape: str, cardinality: str, docs: int):
+        start = time.perf_counter()
+        name = datasets.seed_collection(self.connection.db, shape, cardinality, docs)
+        case = {"case": name, "shape": shape, "cardinality": cardinality, "docs": docs}
+        print(f"-- {name} (seeded in {time.perf_counter() - start:.1f}s)", flush=True)
+        self.bench_schema(name, case)
+        schema = detect_collection_schema(name, connection=self.connection)
+        for entry in datasets.QUESTIONS[shape]:
+            intent = MongoQueryIntent(collection=name, **entry["intent"])
+            self.bench_stages(name, case, entry["query"], intent)
+            self.bench_end_to_end(name, case, entry["query"], schema)
+
+    def bench_schema(self, name: str, case: Dict[str, Any]):
+        cache_key = (self.connection.db.name, name)
+
+        def forget():
+            self.connection.collection_schemas.pop(cache_key, None)
+
+        timings, _ = timed(lambda: detect_collection_schema(name, connection=self.connection),
+                           self.repeat, self.warmup, setup=forget)
+        self.add("detect_collection_schema.cold", case, timings)
+        timings, _ = timed(lambda: detect_collection_schema(name, connection=self.connection),
+                           self.repeat, self.warmup)
+        self.add("detect_collection_schema.warm", case, timings)
+
+    def bench_stages(self, name: str, case: Dict[str, Any], query: str, intent: MongoQueryIntent):
+        pipeline = intent.aggregation_pipeline
+        timings, rows = timed(lambda: self.connection.execute_query(name, pipeline, use_cache=False),
+                              self.repeat, self.warmup)
+        self.add("execute_query", case, timings, case["docs"], query, rows=len(rows))
+        timings, _ = timed(lambda: self.connection.execute_query(name, pipeline), self.repeat, self.warmup)
+        self.add("execute_query.cached", case, timings, len(rows), query, rows=len(rows))
+
+        timings, df = timed(lambda: ChartGenerator.convert_to_dataframe(rows), self.repeat, self.warmup)
+        self.add("convert_to_dataframe", case, timings, len(rows), query, rows=len(rows))
+        timings, suggested = timed(
+            lambda: ChartSelector.suggest_chart_type(rows, intent.x_axis, intent.y_axis), self.repeat, self.warmup
+        )
+        self.add("ChartSelector.suggest_chart_type", case, timings, len(rows), query, suggested=suggested)
+        timings, _ = timed(lambda: ChartGenerator.generate_chart(df, intent, use_cache=False),
+                           self.repeat, self.warmup)
+        self.add("generate_chart", case, timings, len(rows), query, rows=len(rows))
+        timings, _ = timed(lambda: ChartGenerator.generate_chart(df, intent), self.repeat, self.warmup)
+        self.add("generate_chart.cached", case, timings, len(rows), query, rows=len(rows))
+
+    def bench_end_to_end(self, name: str, case: Dict[str, Any], query: str, schema: Dict[str, str]):
+        tracer.clear()
+        timings, result = timed(
+            lambda: self.pipeline.run_sync(query, name, schema, allow_expensive=True),
+            self.repeat, self.warmup,
+            setup=lambda: (intent_cache.clear(), result_cache.clear())
+        )
+        if result.get("intent") is None:
+            print(f"   end-to-end request for {query!r} produced no intent", file=sys.stderr)
+        rows = len(result["df"]) if result.get("df") is not None else 0
+        self.add("end_to_end", case, timings, case["docs"], query, rows=rows)
+        # Per-stage self time from the request traces (warm-up runs excluded)
+        for stage in tracer.percentiles(limit=self.repeat, root="request"):
+            if stage["stage"] == "total_ms":
+                continue
+            self.results.append({
+                "benchmark": f"stage.{stage['stage']}", **case, "query": query,
+                "repeat": stage["count"], "median_ms": stage["p50_ms"], "p95_ms": stage["p95_ms"],
+            })
+
+def main(argv=None) -> List[Dict[str, Any]]:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--shapes", nargs="+", choices=datasets.SHAPES, default=list(datasets.SHAPES))
+    parser.add_argument("--cardinalities", nargs="+", choices=datasets.CARDINALITIES,
+                        default=list(datasets.CARDINALITIES))
+    parser.add_argument("--uri", default="", help="Live MongoDB server (default: in-process mongomock)")
+    parser.add_argument("--db", default="mongochart_bench")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0,
+                        help="Simulated LLM round trip for the end-to-end benchmark")
+    parser.add_argument("--columnar", action="store_true", help="Also run bench_columnar at the same sizes")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=None, help="Allowed slowdown for --compare")
+    args = parser.parse_args(argv)
+
+    # Streamlit warns about the missing script context on every st.* call outside the app
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    # pandas' date-format inference warnings are per call and would drown the report
+    warnings.filterwarnings("ignore", category=UserWarning)
+    connection, backend = connect(args.uri, args.db)
+    install_fake_llm(query_parser, datasets.canned_intents(args.shapes), args.llm_latency_ms / 1000)
+    # Measure the full parse path rather than the rule-based shortcut
+    rule_parser.min_confidence = float("inf")
+
+    suite = Suite(connection, args.repeat, args.warmup)
+    for docs in args.sizes:
+        for shape in args.shapes:
+            for cardinality in args.cardinalities:
+                suite.run_collection(shape, cardinality, docs)
+
+    if args.columnar:
+        from benchmarks import bench_columnar
+        for row in bench_columnar.main(["--sizes", *map(str, args.sizes)] + (["--uri", args.uri] if args.uri else [])):
+            suite.results.append({
+                "benchmark": f"columnar.{row['path']}", "case": str(row["rows"]), "docs": row["rows"],
+                "query": None, "repeat": 1, "median_ms": round(row["seconds"] * 1000, 3),
+                "items_per_sec": row["rows_per_sec"], "peak_rss_delta_mb": row["peak_rss_delta_mb"],
+            })
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "backend": backend,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pandas": pd.__version__,
+            "pymongo": pymongo.version,
+            "plotly": plotly.__version__,
+            "args": vars(args),
+        },
+        "results": suite.results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+    if args.compare:
+        from benchmarks import compare
+        rows = compare.compare(compare.load_results(args.compare), suite.results,
+                               args.threshold if args.threshold is not None else compare.DEFAULT_THRESHOLD)
+        compare.print_report(rows)
+        if any(row["regressed"] for row in rows):
+            sys.exit(1)
+    return suite.results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Compare two benchmark result files and flag regressions.
+
+Usage:
+    python -m benchmarks.compare baseline.json current.json [--threshold 0.15] [--min-ms 1]
+
+Cases are matched on (benchmark, case, query). A case regresses when its
+median is more than `threshold` slower than the baseline and the difference
+exceeds `min-ms` (so sub-millisecond noise never fails a run). Exits with
+status 1 if anything regressed.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List, Any, Tuple
+
+DEFAULT_THRESHOLD = 0.15
+DEFAULT_MIN_MS = 1.0
+
+def load_results(path: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        data = json.load(f)
+    # Older files (e.g. from bench_columnar) are a bare list
+    return data["results"] if isinstance(data, dict) else data
+
+def case_key(result: Dict[str, Any]) -> Tuple[str, str, str]:
+    return result.get("benchmark", ""), str(result.get("case", "")), result.get("query") or ""
+
+def compare(baseline: List[Dict[str, Any]], current: List[Dict[str, Any]],
+            threshold: float = DEFAULT_THRESHOLD, min_ms: float = DEFAULT_MIN_MS) -> List[Dict[str, Any]]:
+    """One row per case present in both runs, with its relative change"""
+    previous = {case_key(r): r for r in baseline if r.get("median_ms") is not None}
+    rows = []
+    for result in current:
+        key = case_key(result)
+        before = previous.get(key)
+        if before is None or result.get("median_ms") is None:
+            continue
+        base_ms, now_ms = before["median_ms"], result["median_ms"]
+        change = (now_ms - base_ms) / base_ms if base_ms else 0.0
+        rows.append({
+            "benchmark": key[0], "case": key[1], "query": key[2],
+            "baseline_ms": base_ms, "current_ms": now_ms, "change": round(change, 3),
+            "regressed": change > threshold and now_ms - base_ms > min_ms,
+        })
+    return rows
+
+def print_report(rows: List[Dict[str, Any]]):
+    for row in rows:
+        flag = "REGRESSED" if row["regressed"] else ""
+        label = f"{row['benchmark']} [{row['case']}]" + (f" {row['query'][:40]}" if row["query"] else "")
+        print(f"{label:<90} {row['baseline_ms']:>10.2f} -> {row['current_ms']:>10.2f} ms "
+              f"{row['change']:>+8.1%} {flag}")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--min-ms", type=float, default=DEFAULT_MIN_MS)
+    args = parser.parse_args(argv)
+
+    rows = compare(load_results(args.baseline), load_results(args.current), args.threshold, args.min_ms)
+    print_report(rows)
+    regressions = sum(row["regressed"] for row in rows)
+    print(f"{len(rows)} cases compared, {regressions} regressed")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""Deterministic synthetic collections for the benchmarks.
+
+Documents come in two shapes: "flat" (scalar fields only) and "nested"
+(sub-documents and an array of line items). Cardinality controls how many
+distinct values the grouping fields take: "low" keeps them small enough for
+pie/bar charts, "high" scales them with the collection size.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Any, Iterator, Optional
+
+SHAPES = ("flat", "nested")
+CARDINALITIES = ("low", "high")
+INSERT_BATCH = 10_000
+SEED = 42
+
+_EPOCH = datetime(2023, 1, 1)
+_STATUSES = ["pending", "paid", "shipped", "delivered", "returned"]
+_TIERS = ["bronze", "silver", "gold", "platinum"]
+_COUNTRIES = ["US", "DE", "FR", "IN", "BR", "JP", "GB", "CA", "AU", "MX", "ES", "IT"]
+
+def collection_name(shape: str, cardinality: str, docs: int) -> str:
+    return f"{shape}_{cardinality}_{docs}"
+
+def _distinct(cardinality: str, docs: int, low: int) -> int:
+    """Number of distinct values for a grouping field"""
+    return low if cardinality == "low" else max(low, docs // 10)
+
+def make_documents(docs: int, shape: str = "flat", cardinality: str = "low",
+                   start: int = 0, seed: int = SEED) -> Iterator[Dict[str, Any]]:
+    """Documents start..docs-1; the same arguments always produce the same documents"""
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown shape {shape}")
+    regions = _distinct(cardinality, docs, 8)
+    categories = _distinct(cardinality, docs, 12)
+    customers = _distinct(cardinality, docs, 200)
+    for i in range(start, docs):
+        # Seed per document so any slice can be generated on its own
+        rng = random.Random(seed * 1_000_003 + i)
+        created_at = _EPOCH + timedelta(minutes=i * 525_600 // max(docs, 1) + rng.randrange(60))
+        price = round(rng.lognormvariate(3, 0.8), 2)
+        quantity = rng.randint(1, 20)
+        if shape == "flat":
+            yield {
+                "_id": i,
+                "region": f"region_{rng.randrange(regions)}",
+                "category": f"category_{rng.randrange(categories)}",
+                "status": rng.choice(_STATUSES),
+                "customer_id": f"customer_{rng.randrange(customers)}",
+                "price": price,
+                "quantity": quantity,
+                "revenue": round(price * quantity, 2),
+                "created_at": created_at,
+            }
+        else:
+            items = [
+                {"sku": f"sku_{rng.randrange(categories * 10)}", "qty": rng.randint(1, 5),
+                 "price": round(rng.lognormvariate(2.5, 0.7), 2)}
+                for _ in range(rng.randint(1, 4))
+            ]
+            yield {
+                "_id": i,
+                "customer": {
+                    "id": f"customer_{rng.randrange(customers)}",
+                    "tier": rng.choice(_TIERS),
+                    "address": {
+                        "country": _COUNTRIES[rng.randrange(min(regions, len(_COUNTRIES)))],
+                        "city": f"city_{rng.randrange(regions * 5)}",
+                    },
+                },
+                "status": rng.choice(_STATUSES),
+                "items": items,
+                "totals": {
+                    "quantity": sum(item["qty"] for item in items),
+                    "amount": round(sum(item["qty"] * item["price"] for item in items), 2),
+                },
+                "created_at": created_at,
+            }
+
+def seed_collection(db, shape: str, cardinality: str, docs: int) -> str:
+    """Create (or reuse, if already complete) a synthetic collection; returns its name"""
+    name = collection_name(shape, cardinality, docs)
+    collection = db[name]
+    existing = collection.estimated_document_count()
+    if existing == docs:
+        return name
+    if existing:
+        collection.drop()
+    batch: List[Dict[str, Any]] = []
+    for doc in make_documents(docs, shape, cardinality):
+        batch.append(doc)
+        if len(batch) >= INSERT_BATCH:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    return name
+
+# Questions per shape with the intent a well-behaved LLM would return for them.
+# The collection is filled in from the prompt. Date buckets use $dateToString
+# rather than $dateTrunc so mongomock can run every pipeline.
+QUESTIONS: Dict[str, List[Dict[str, Any]]] = {
+    "flat": [
+        {
+            "query": "Which regions bring in the most revenue on average?",
+            "intent": {
+                "operation_type": "aggregate",
+                "aggregation_pipeline": [
+                    {"$group": {"_id": "$region", "avg_revenue": {"$avg": "$revenue"}}},
+                    {"$sort": {"avg_revenue": -1}},
+                ],
+                "chart_type": "bar", "x_axis": "_id", "y_axis": "avg_revenue",
+                "title": "Average revenue by region",
+            },
+        },
+        {
+            "query": "How has the number of paid orders changed day to day?",
+            "intent": {
+                "operation_type": "aggregate",
+                "aggregation_pipeline": [
+                    {"$match": {"status": "paid"}},
+                    {"$group": {"_id": {"$dateToString": {"date": "$created_at", "format": "%Y-%m-%d"}},
+                                "orders": {"$sum": 1}}},
+                    {"$sort": {"_id": 1}},
+                ],
+                "chart_type": "line", "x_axis": "_id", "y_axis": "orders",
+                "title": "Paid orders per day",
+            },
+        },
+        {
+            "query": "Is there a relationship between price and quantity?",
+            "intent": {
+                "operation_type": "aggregate",
+                "aggregation_pipeline": [
+                    {"$project": {"_id": 0, "price": 1, "quantity": 1}},
+                ],
+                "chart_type": "scatter", "x_axis": "price", "y_axis": "quantity",
+                "title": "Price vs quantity",
+            },
+        },
+        {
+            "query": "Which customers spent the most?",
+            "intent": {
+                "operation_type": "aggregate",
+                "aggregation_pipeline": [
+                    {"$group": {"_id": "$customer_id", "revenue": {"$sum": "$revenue"}}},
+                    {"$sort": {"revenue": -1}},
+                    {"$limit": 10},
+                ],
+                "chart_type": "bar", "x_axis": "_id", "y_axis": "revenue",
+                "title": "Top 10 customers by revenue",
+            },
+        },
+    ],
+    "nested": [
+        {
+            "query": "How many units were sold in each country?",
+            "intent": {
+                "operation_type": "aggregate",
+                "aggregation_pipeline": [
+                    {"$unwind": "$items"},
+                    {"$group": {"_id": "$customer.address.country", "units": {"$sum": "$items.qty"}}},
+                    {"$sort": {"units": -1}},
+                ],
+                "chart_type": "bar", "x_axis": "_id", "y_axis": "units",
+                "title": "Units sold by country",
+            },
+        },
+        {
+            "query": "What share of orders comes from each customer tier?",
+            "intent": {
+                "operation_type": "aggregate",
+                "aggregation_pipeline": [
+                    {"$group": {"_id": "$customer.tier", "orders": {"$sum": 1}}},
+                ],
+                "chart_type": "pie", "x_axis": "_id", "y_axis": "orders",
+                "title": "Orders by customer tier",
+            },
+        },
+        {
+            "query": "How did order value develop month by month?",
+            "intent": {
+                "operation_type": "aggregate",
+                "aggregation_pipeline": [
+                    {"$group": {"_id": {"$dateToString": {"date": "$created_at", "format": "%Y-%m"}},
+                                "amount": {"$sum": "$totals.amount"}}},
+                    {"$sort": {"_id": 1}},
+                ],
+                "chart_type": "line", "x_axis": "_id", "y_axis": "amount",
+                "title": "Order value per month",
+            },
+        },
+    ],
+}
+
+def canned_intents(shapes: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """Question -> intent (without collection) for the fake LLM"""
+    return {
+        entry["query"]: entry["intent"]
+        for shape in (shapes or SHAPES)
+        for entry in QUESTIONS[shape]
+    }
@@ -0,0 +1,63 @@
+"""Deterministic stand-in for ChatGoogleGenerativeAI.
+
+Answers single and batch prompts with canned intents, so the parse stage can
+be benchmarked (and the rest of the pipeline exercised) without network
+access or API quota. An optional fixed latency approximates the real round
+trip.
+"""
+import asyncio
+import json
+import re
+import time
+from typing import Dict, Any
+
+_COLLECTION = re.compile(r"^Collection name: (?P<name>.+)$", re.M)
+_QUERY = re.compile(r"^User query: (?P<query>.+)$", re.M)
+_NUMBERED = re.compile(r"^\d+\. (?P<query>.+)$", re.M)
+
+class FakeResponse:
+    def __init__(self, content: str):
+        self.content = content
+
+class FakeLLM:
+    """Replies with the canned intent for each question in the prompt"""
+
+    def __init__(self, intents: Dict[str, Dict[str, Any]], latency_s: float = 0.0):
+        self.intents = intents
+        self.latency_s = latency_s
+        self.calls = 0
+
+    def _intent(self, query: str, collection_name: str) -> Dict[str, Any]:
+        query = query.strip()
+        if query not in self.intents:
+            raise ValueError(f"No canned intent for {query!r}")
+        return {"collection": collection_name, **self.intents[query]}
+
+    def _respond(self, prompt: str) -> FakeResponse:
+        self.calls += 1
+        collection = _COLLECTION.search(prompt)
+        collection_name = collection.group("name").strip() if collection else ""
+        single = _QUERY.search(prompt)
+        if single:
+            payload: Any = self._intent(single.group("query"), collection_name)
+        else:
+            block = prompt.split("User queries:", 1)[-1].split("For each query", 1)[0]
+            payload = {"intents": [self._intent(m.group("query"), collection_name)
+                                   for m in _NUMBERED.finditer(block)]}
+        return FakeResponse(json.dumps(payload))
+
+    def invoke(self, prompt: str) -> FakeResponse:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return self._respond(str(prompt))
+
+    async def ainvoke(self, prompt: str) -> FakeResponse:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        return self._respond(str(prompt))
+
+def install(parser, intents: Dict[str, Dict[str, Any]], latency_s: float = 0.0) -> FakeLLM:
+    """Swap a QueryParser's LLM for the fake"""
+    fake = FakeLLM(intents, latency_s)
+    parser.llm = fake
+    return fake
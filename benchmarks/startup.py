@@ -0,0 +1,159 @@
+"""Cold-start and rerun budget check for the Streamlit app.
+
+Usage:
+    python -m benchmarks.startup                    # check against the default budgets
+    python -m benchmarks.startup --profile 20       # also list the 20 slowest imports
+    python -m benchmarks.startup --output startup.json
+
+app.py is run in a fresh interpreter under `python -X importtime` through
+streamlit's AppTest (no server or browser needed), first cold and then
+`--reruns` more times, the way Streamlit re-executes the script on every
+interaction. Only imports triggered by the app itself are counted, since
+the server has streamlit loaded before the script first runs.
+
+Exits 1 when the app's imports, the first run or the median rerun exceed
+their budget, or when a module that should only load once a question needs
+it (see DEFERRED_MODULES) is imported at startup.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Any, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(REPO_ROOT, "app.py")
+
+# Heavy dependencies that must not be imported before the first question reaches the LLM
+DEFERRED_MODULES = ("langchain", "langchain_core", "langchain_google_genai", "google.generativeai")
+
+# Budgets in ms, with headroom over a typical laptop run; override per flag (or env) on slower CI machines
+DEFAULT_MAX_IMPORT_MS = float(os.getenv("STARTUP_MAX_IMPORT_MS", "1000"))
+DEFAULT_MAX_FIRST_RUN_MS = float(os.getenv("STARTUP_MAX_FIRST_RUN_MS", "1500"))
+DEFAULT_MAX_RERUN_MS = float(os.getenv("STARTUP_MAX_RERUN_MS", "150"))
+
+_MARKER = "--- mongochart app start ---"
+
+# Runs in the child interpreter: argv = [app path, reruns]
+_CHILD = f"""
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+
+path, reruns = sys.argv[1], int(sys.argv[2])
+before = set(sys.modules)
+sys.stderr.write({_MARKER!r} + "\\n")
+sys.stderr.flush()
+at = AppTest.from_file(path, default_timeout=120)
+start = time.perf_counter()
+at.run()
+first = time.perf_counter() - start
+loaded = sorted(set(sys.modules) - before)
+timings = []
+for _ in range(reruns):
+    start = time.perf_counter()
+    at.run()
+    timings.append(time.perf_counter() - start)
+print(json.dumps({{
+    "first_run_s": first,
+    "rerun_s": timings,
+    "modules": loaded,
+    "exceptions": [str(e.message) for e in at.exception],
+}}))
+"""
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """Rows of `-X importtime` output printed after the app started: self/cumulative us, depth, module"""
+    rows = []
+    started = False
+    for line in stderr.splitlines():
+        if line.strip() == _MARKER:
+            started = True
+            continue
+        if not started or not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+        })
+    return rows
+
+def profile_app(app_path: str = APP_PATH, reruns: int = 5) -> Dict[str, Any]:
+    """Import profile and run timings of the app in a fresh interpreter"""
+    env = {**os.environ, "PYTHONPATH": REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD, app_path, str(reruns)],
+        capture_output=True, text=True, cwd=REPO_ROOT, env=env
+    )
+    if completed.returncode != 0:
+        sys.exit(f"Running {app_path} failed:\n{completed.stderr[-2000:]}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    imports = parse_importtime(completed.stderr)
+    result["imports"] = imports
+    result["import_ms"] = round(sum(row["self_ms"] for row in imports), 1)
+    result["first_run_ms"] = round(result.pop("first_run_s") * 1000, 1)
+    reruns_s = result.pop("rerun_s")
+    result["rerun_ms"] = round(statistics.median(reruns_s) * 1000, 1) if reruns_s else None
+    return result
+
+def check(result: Dict[str, Any], max_import_ms: float, max_first_run_ms: float,
+          max_rerun_ms: float) -> List[str]:
+    """Budget violations, one message each"""
+    failures = []
+    if result["import_ms"] > max_import_ms:
+        failures.append(f"app imports took {result['import_ms']:.0f} ms (budget {max_import_ms:.0f} ms)")
+    if result["first_run_ms"] > max_first_run_ms:
+        failures.append(f"first run took {result['first_run_ms']:.0f} ms (budget {max_first_run_ms:.0f} ms)")
+    if result["rerun_ms"] is not None and result["rerun_ms"] > max_rerun_ms:
+        failures.append(f"median rerun took {result['rerun_ms']:.0f} ms (budget {max_rerun_ms:.0f} ms)")
+    eager = sorted({
+        module for module in result["modules"]
+        if any(module == name or module.startswith(name + ".") for name in DEFERRED_MODULES)
+    })
+    if eager:
+        roots = sorted({module.split(".")[0] for module in eager})
+        failures.append(f"imported at startup but should be deferred: {', '.join(roots)}")
+    failures.extend(f"app raised: {message}" for message in result["exceptions"])
+    return failures
+
+def print_profile(imports: List[Dict[str, Any]], top: int):
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for row in sorted(imports, key=lambda row: row["cumulative_ms"], reverse=True)[:top]:
+        print(f"{row['cumulative_ms']:>14.1f} {row['self_ms']:>9.1f}  {'  ' * row['depth']}{row['module']}")
+
+def main(argv=None) -> Optional[Dict[str, Any]]:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default=APP_PATH)
+    parser.add_argument("--reruns", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=DEFAULT_MAX_IMPORT_MS)
+    parser.add_argument("--max-first-run-ms", type=float, default=DEFAULT_MAX_FIRST_RUN_MS)
+    parser.add_argument("--max-rerun-ms", type=float, default=DEFAULT_MAX_RERUN_MS)
+    parser.add_argument("--profile", type=int, default=0, metavar="N", help="List the N slowest imports")
+    parser.add_argument("--output", help="Write the profile as JSON to this file")
+    args = parser.parse_args(argv)
+
+    result = profile_app(args.app, args.reruns)
+    print(f"app imports   {result['import_ms']:>8.1f} ms  ({len(result['modules'])} modules)")
+    print(f"first run     {result['first_run_ms']:>8.1f} ms")
+    if result["rerun_ms"] is not None:
+        print(f"median rerun  {result['rerun_ms']:>8.1f} ms")
+    if args.profile:
+        print()
+        print_profile(result["imports"], args.profile)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    failures = check(result, args.max_import_ms, args.max_first_run_ms, args.max_rerun_ms)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+    return result
+
+if __name__ == "__main__":
+    main()
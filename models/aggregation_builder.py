@@ -1,6 +1,9 @@
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 import streamlit as st
 from .query_parser import MongoQueryIntent
+from .pipeline_optimizer import optimize_pipeline
+from utils.tracing import traced, set_attributes
+from utils.rollups import rollup_manager
 
 class AggregationBuilder:
     """Helper class to build and validate MongoDB aggregation pipelines"""
@@ -29,6 +32,7 @@ class AggregationBuilder:
         return True
     
     @staticmethod
+    @traced("build.validate")
     def create_safe_aggregation_from_intent(intent: MongoQueryIntent) -> List[Dict[str, Any]]:
         """Create a safe version of the aggregation pipeline from intent"""
         pipeline = intent.aggregation_pipeline
@@ -40,6 +44,120 @@ class AggregationBuilder:
             
         return pipeline
     
+    @staticmethod
+    @traced("build.optimize")
+    def optimize_pipeline(pipeline: List[Dict[str, Any]], schema: Optional[Dict[str, str]] = None,
+                          intent: Optional[MongoQueryIntent] = None) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """Rewrite a pipeline into a cheaper equivalent; returns the new pipeline and a note per rewrite"""
+        optimized, notes = optimize_pipeline(pipeline, schema, intent)
+        set_attributes(stages=len(optimized), rewrites=len(notes))
+        return optimized, notes
+    
+    @staticmethod
+    @traced("build.rollup")
+    def apply_rollup(pipeline: List[Dict[str, Any]], namespace: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Read the pipeline's $match/$group head from a fresh rollup when one exists.
+        
+        The run is also counted towards materializing a rollup for it. Returns
+        the (possibly rewritten) pipeline and a note when it was rewritten.
+        """
+        rollup_manager.record(namespace, pipeline)
+        rewritten, note = rollup_manager.rewrite(namespace, pipeline)
+        set_attributes(rollup=note is not None)
+        return rewritten, note
+    
+    @staticmethod
+    def apply_row_ceiling(pipeline: List[Dict[str, Any]], max_rows: int,
+                          strategy: str = "$limit") -> List[Dict[str, Any]]:
+        """Cap unbounded pipelines so they can't return the whole collection.
+        
+        Pipelines that already reduce their output ($group, $bucket, $count,
+        $limit, $sample, ...) are returned unchanged. Otherwise a `$limit` is
+        appended, or a `$sample` when strategy is "$sample" and the pipeline
+        doesn't sort (a random sample is more representative than the first N).
+        """
+        if not max_rows:
+            return pipeline
+        
+        reducing_stages = {'$group', '$bucket', '$bucketAuto', '$count', '$limit', '$sample', '$sortByCount'}
+        stage_names = {op for stage in pipeline for op in stage.keys()}
+        if stage_names & reducing_stages:
+            return pipeline
+        
+        if strategy == "$sample" and '$sort' not in stage_names:
+            return pipeline + [{"$sample": {"size": max_rows}}]
+        return pipeline + [{"$limit": max_rows}]
+    
+    @staticmethod
+    def choose_date_unit(span_seconds: float, budget: int) -> str:
+        """Smallest $dateTrunc unit that keeps the number of bins within budget"""
+        units = [
+            ("second", 1), ("minute", 60), ("hour", 3600), ("day", 86400),
+            ("week", 7 * 86400), ("month", 30 * 86400), ("quarter", 91 * 86400), ("year", 365 * 86400)
+        ]
+        for unit, seconds in units:
+            if span_seconds / seconds <= budget:
+                return unit
+        return "year"
+    
+    @staticmethod
+    @traced("build.budget")
+    def apply_point_budget(pipeline: List[Dict[str, Any]], intent: MongoQueryIntent, schema: Dict[str, str],
+                           budget: Optional[int], time_span_seconds: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Rewrite raw-point line/scatter pipelines so the server returns at most ~budget points.
+        
+        Line charts are binned on the x field ($dateTrunc for dates when the time
+        span is known, $bucketAuto otherwise) with y averaged per bin. Scatter
+        charts get a random $sample, since averaging would hide the spread.
+        Pipelines that already group or reshape documents are left alone.
+        Dotted axis paths come back under flat names ("a.b" -> "a_b"), which
+        ChartGenerator.resolve_axes maps the intent's axes to.
+        """
+        if not budget or intent.chart_type not in ('line', 'scatter'):
+            return pipeline
+        
+        x_field, y_field = intent.x_axis, intent.y_axis
+        if not x_field or not y_field or x_field not in schema or y_field not in schema:
+            return pipeline
+        
+        reshaping_stages = {
+            '$group', '$bucket', '$bucketAuto', '$project', '$count', '$sortByCount',
+            '$limit', '$sample', '$replaceRoot', '$addFields', '$set', '$unset', '$facet'
+        }
+        if any(op in reshaping_stages for stage in pipeline for op in stage.keys()):
+            return pipeline
+        
+        # Output field names can't contain dots
+        x_name, y_name = x_field.replace('.', '_'), y_field.replace('.', '_')
+        if intent.chart_type == 'scatter':
+            sampled = pipeline + [{"$sample": {"size": budget}}]
+            if x_name != x_field or y_name != y_field:
+                sampled.append({"$project": {"_id": 0, x_name: f"${x_field}", y_name: f"${y_field}"}})
+            return sampled
+        
+        # Drop a trailing sort; the binned output is re-sorted on x
+        base = [stage for stage in pipeline if '$sort' not in stage]
+        if schema.get(x_field) == 'date' and time_span_seconds:
+            unit = AggregationBuilder.choose_date_unit(time_span_seconds, budget)
+            return base + [
+                {"$group": {
+                    "_id": {"$dateTrunc": {"date": f"${x_field}", "unit": unit}},
+                    y_name: {"$avg": f"${y_field}"}
+                }},
+                {"$project": {"_id": 0, x_name: "$_id", y_name: 1}},
+                {"$sort": {x_name: 1}}
+            ]
+        
+        return base + [
+            {"$bucketAuto": {
+                "groupBy": f"${x_field}",
+                "buckets": budget,
+                "output": {y_name: {"$avg": f"${y_field}"}}
+            }},
+            {"$project": {"_id": 0, x_name: "$_id.min", y_name: 1}},
+            {"$sort": {x_name: 1}}
+        ]
+    
     @staticmethod
     def create_fallback_pipeline(intent: MongoQueryIntent) -> List[Dict[str, Any]]:
         """Create a fallback pipeline if the generated one is invalid"""
@@ -0,0 +1,280 @@
+import os
+import math
+import time
+import logging
+import threading
+from statistics import NormalDist
+from typing import Dict, List, Optional, Any, Tuple
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from .live_chart import apply_tail, _simple_tail
+from utils.rollups import split_rollup_pipeline
+from utils.tracing import tracer
+from visualizations.chart_generator import ChartGenerator, ERROR_SUFFIX
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Sample sizes tried in turn, smallest (the first paint) first
+APPROX_SAMPLE_SIZES = [int(size) for size in os.getenv("APPROX_SAMPLE_SIZES", "10000,100000,1000000").split(",")
+                       if size.strip()]
+# Confidence level of the error bars
+APPROX_CONFIDENCE = float(os.getenv("APPROX_CONFIDENCE", "0.95"))
+# Finish refining with the exact pipeline (when it fits the collection's query budget)
+APPROX_REFINE_EXACT = os.getenv("APPROX_REFINE_EXACT", "1") == "1"
+
+# MongoDB only serves a leading $sample from a random cursor (no collection scan and
+# in-memory shuffle) while the sample is under 5% of the collection
+MAX_SAMPLE_FRACTION = 0.05
+
+def approximate_plan(pipeline: List[Dict[str, Any]]) -> Optional[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """The pipeline's $match/$group head and locally applicable tail, or None if it can't be estimated"""
+    split = split_rollup_pipeline(pipeline)
+    if split is None or not _simple_tail(split[1]):
+        return None
+    return split
+
+def _squared(expression: Any) -> Any:
+    if isinstance(expression, (int, float)) and not isinstance(expression, bool):
+        return expression * expression
+    # $multiply fails on strings, where $sum would just skip the value
+    return {'$cond': [{'$isNumber': expression}, {'$multiply': [expression, expression]}, 0]}
+
+def sample_group(group: Dict[str, Any]) -> Dict[str, Any]:
+    """$group spec that also keeps what the confidence intervals need (sums of squares, value counts)"""
+    stats: Dict[str, Any] = {'_id': group['_id']}
+    for name, accumulator in group.items():
+        if name == '_id':
+            continue
+        operator, expression = next(iter(accumulator.items()))
+        if operator == '$count':
+            operator, expression = '$sum', 1
+        if operator == '$sum':
+            stats[name] = {'$sum': expression}
+            stats[f"{name}__sq"] = {'$sum': _squared(expression)}
+        elif operator == '$avg':
+            stats[f"{name}__sum"] = {'$sum': expression}
+            stats[f"{name}__sq"] = {'$sum': _squared(expression)}
+            stats[f"{name}__n"] = {'$sum': {'$cond': [{'$isNumber': expression}, 1, 0]}}
+        else:
+            stats[name] = {operator: expression}
+    return stats
+
+def sample_pipeline(head: List[Dict[str, Any]], size: int) -> List[Dict[str, Any]]:
+    """The head run over a random sample of `size` documents, keeping per-group statistics"""
+    return [{'$sample': {'size': size}}] + head[:-1] + [{'$group': sample_group(head[-1]['$group'])}]
+
+def estimate_rows(docs: List[Dict[str, Any]], group: Dict[str, Any], sampled: int, population: int,
+                  confidence: float = APPROX_CONFIDENCE) -> List[Dict[str, Any]]:
+    """Turn sampled group statistics into estimates, with `<name>__error` confidence interval half-widths.
+
+    $sum/$count are scaled up by population / sampled, with the variance of
+    the per-document contributions over the whole sample (a document outside
+    the group contributes 0). $avg is the group's sample mean with its
+    standard error. Both use the finite population correction, so a sample
+    of the whole collection has no error. $min/$max are the sample's
+    extremes and get no interval.
+    """
+    scale = population / sampled if sampled else 0.0
+    correction = max(0.0, 1.0 - sampled / population) if population else 0.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    rows = []
+    for doc in docs:
+        row = {'_id': doc['_id']}
+        for name, accumulator in group.items():
+            if name == '_id':
+                continue
+            operator, expression = next(iter(accumulator.items()))
+            if operator in ('$sum', '$count'):
+                total, squares = doc.get(name) or 0, doc.get(f"{name}__sq") or 0
+                counting = operator == '$count' or (isinstance(expression, int) and not isinstance(expression, bool))
+                row[name] = round(total * scale) if counting else total * scale
+                variance = (squares - total * total / sampled) / (sampled - 1) if sampled > 1 else 0.0
+                row[f"{name}{ERROR_SUFFIX}"] = z * population * math.sqrt(max(variance, 0.0) * correction / sampled) \
+                    if sampled else None
+            elif operator == '$avg':
+                total, squares = doc.get(f"{name}__sum") or 0, doc.get(f"{name}__sq") or 0
+                count = doc.get(f"{name}__n") or 0
+                row[name] = total / count if count else None
+                if count > 1:
+                    variance = (squares - total * total / count) / (count - 1)
+                    row[f"{name}{ERROR_SUFFIX}"] = z * math.sqrt(max(variance, 0.0) * correction / count)
+                else:
+                    row[f"{name}{ERROR_SUFFIX}"] = None
+            else:
+                row[name] = doc.get(name)
+        rows.append(row)
+    return rows
+
+def carry_errors(tail: List[Dict[str, Any]], group: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Tail stages whose inclusion $projects keep each estimate's error column next to it"""
+    accumulators = {name for name in group if name != '_id'}
+    carried = []
+    for stage in tail:
+        operator, spec = next(iter(stage.items()))
+        if operator == '$project' and any(value not in (0, False) for value in spec.values()):
+            spec = dict(spec)
+            for name, value in list(spec.items()):
+                source = value[1:] if isinstance(value, str) else name
+                if source in accumulators and value not in (0, False):
+                    spec[f"{name}{ERROR_SUFFIX}"] = f"${source}{ERROR_SUFFIX}"
+            stage = {'$project': spec}
+        carried.append(stage)
+    return carried
+
+class ApproximateQuery:
+    """Estimates of a grouped pipeline from growing random samples, refined towards the exact answer.
+
+    The pipeline's $match/$group head runs behind a leading $sample sized
+    well under the collection, which MongoDB serves from a random cursor, so
+    the first estimate costs about the same on any collection size. The
+    trailing $sort/$limit/$project stages are applied locally, as for live
+    charts. See `estimate_rows` for how each accumulator is estimated.
+
+    `first()` returns the smallest sample's estimate; `refine()` then runs
+    the larger samples and finally the exact pipeline (when its pre-flight
+    estimate fits the collection's query budget) on a background thread,
+    publishing each result in `latest`. Pipelines that aren't a $match/$group
+    head with $sum/$count/$avg/$min/$max accumulators aren't `supported`.
+    """
+
+    def __init__(self, connection, collection_name: str, pipeline: List[Dict[str, Any]],
+                 sample_sizes: Optional[List[int]] = None, confidence: float = APPROX_CONFIDENCE,
+                 refine_exact: bool = APPROX_REFINE_EXACT, allow_expensive: bool = False):
+        self.connection = connection
+        self.collection_name = collection_name
+        self.pipeline = pipeline
+        self.sample_sizes = sorted(sample_sizes or APPROX_SAMPLE_SIZES)
+        self.confidence = confidence
+        self.refine_exact = refine_exact
+        self.allow_expensive = allow_expensive
+        plan = approximate_plan(pipeline)
+        self.head, self.tail = plan if plan is not None else (None, None)
+        self.population = 0
+        # {"df", "sampled", "population", "confidence", "exact", "seconds"} of the most refined result so far
+        self.latest: Optional[Dict[str, Any]] = None
+        self.version = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._op_id: Optional[str] = None
+
+    @property
+    def supported(self) -> bool:
+        return self.head is not None
+
+    @property
+    def refining(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _sizes(self) -> List[int]:
+        """Sample sizes that are still cheap to draw from this collection"""
+        return [size for size in self.sample_sizes if size < self.population * MAX_SAMPLE_FRACTION]
+
+    def _run(self, pipeline: List[Dict[str, Any]], report_errors: bool) -> Optional[List[Dict[str, Any]]]:
+        self._op_id = self.connection.new_operation_id()
+        docs = [doc for batch in self.connection.iter_query_batches(self.collection_name, pipeline,
+                                                                    op_id=self._op_id, report_errors=report_errors)
+                for doc in batch]
+        self._op_id = None
+        # Per-thread, so the refining thread and the script thread don't see each other's failures.
+        # A result cut off by the row/byte ceiling would pass for the exact answer (or a full estimate)
+        if self.connection.last_query_error is not None or self.connection.last_query_truncated:
+            return None
+        return docs
+
+    def estimate(self, size: int, report_errors: bool = True) -> Optional[Dict[str, Any]]:
+        """Estimate from one random sample of `size` documents"""
+        started = time.perf_counter()
+        group = self.head[-1]['$group']
+        sampled = min(size, self.population)
+        with tracer.span("approximate.sample", collection=self.collection_name, size=size) as span:
+            docs = self._run(sample_pipeline(self.head, size), report_errors)
+            if docs is None:
+                return None
+            rows = estimate_rows(docs, group, sampled, self.population, self.confidence)
+            df = ChartGenerator.flatten_id_columns(apply_tail(pd.DataFrame(rows), carry_errors(self.tail, group)))
+            span.set(groups=len(rows))
+        return {"df": df, "sampled": sampled, "population": self.population, "confidence": self.confidence,
+                "exact": False, "seconds": round(time.perf_counter() - started, 3)}
+
+    def exact(self, report_errors: bool = True) -> Optional[Dict[str, Any]]:
+        """The pipeline run in full, or None if its pre-flight estimate is over budget or the result was cut off"""
+        started = time.perf_counter()
+        if not self.allow_expensive and self.connection.preflight(self.collection_name, self.pipeline)["over_budget"]:
+            return None
+        with tracer.span("approximate.exact", collection=self.collection_name) as span:
+            docs = self._run(self.pipeline, report_errors)
+            if docs is None:
+                return None
+            df = ChartGenerator.convert_to_dataframe(docs)
+            span.set(rows=len(df))
+        return {"df": df, "sampled": self.population, "population": self.population, "confidence": None,
+                "exact": True, "seconds": round(time.perf_counter() - started, 3)}
+
+    def _publish(self, result: Dict[str, Any]):
+        with self._lock:
+            self.latest = result
+            self.version += 1
+
+    def current(self) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """(version, latest) read together, so a result isn't paired with another's version"""
+        with self._lock:
+            return self.version, self.latest
+
+    def first(self) -> Optional[Dict[str, Any]]:
+        """The first (fastest) result: the smallest cheap sample, or the exact result on small collections"""
+        state = self.connection.get_collection_state(self.collection_name)
+        self.population = state[0] if state else 0
+        sizes = self._sizes()
+        result = self.estimate(sizes[0]) if sizes else self.exact()
+        if result is None and not sizes:
+            # Too expensive to run in full even though it's small; settle for a sample
+            result = self.estimate(self.sample_sizes[0])
+        if result is not None:
+            self._publish(result)
+        return result
+
+    def _refine(self):
+        with tracer.span("approximate.refine", collection=self.collection_name) as span:
+            steps = 0
+            try:
+                for size in self._sizes():
+                    if self._stopped.is_set():
+                        return
+                    if size <= self.latest["sampled"]:
+                        continue
+                    result = self.estimate(size, report_errors=False)
+                    if result is None:
+                        return
+                    self._publish(result)
+                    steps += 1
+                if self.refine_exact and not self._stopped.is_set():
+                    result = self.exact(report_errors=False)
+                    if result is not None and not self._stopped.is_set():
+                        self._publish(result)
+                        steps += 1
+            except Exception:
+                logger.exception("Refining the estimate for %s failed", self.collection_name)
+            finally:
+                span.set(steps=steps)
+
+    def refine(self):
+        """Keep refining `latest` with larger samples (and the exact result) in the background"""
+        if self.latest is None or self.latest["exact"] or self.refining:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refine, name=f"approximate-{self.collection_name}",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop refining, killing the sample or exact query that is running"""
+        self._stopped.set()
+        op_id = self._op_id
+        if op_id is not None:
+            self.connection.cancel_operation(op_id)
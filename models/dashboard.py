@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Any, Tuple
+from dotenv import load_dotenv
+
+from .query_parser import MongoQueryIntent
+from .request_pipeline import RequestPipeline, request_pipeline
+from utils.result_cache import canonicalize_pipeline
+from utils.tracing import tracer
+from visualizations.chart_generator import ChartGenerator, CHART_TYPES
+
+# Load environment variables
+load_dotenv()
+
+# Merge panels that share a $match prefix into one $facet aggregation
+SHARED_SCAN = os.getenv("DASHBOARD_SHARED_SCAN", "1") == "1"
+# Ungrouped panels are only merged when a $limit keeps them this small: the $facet result is a single
+# document and must stay under MongoDB's 16 MB limit
+FACET_MAX_ROWS = int(os.getenv("DASHBOARD_FACET_MAX_ROWS", "5000"))
+
+# Stages that aren't allowed (or would lose their optimizations) inside a $facet sub-pipeline
+_FACET_EXCLUDED = {'$facet', '$out', '$merge', '$collStats', '$indexStats', '$geoNear', '$search',
+                   '$searchMeta', '$planCacheStats', '$unionWith', '$changeStream', '$currentOp'}
+# Stages whose output size doesn't grow with the collection
+_REDUCING_STAGES = {'$group', '$count', '$bucket', '$bucketAuto', '$sortByCount'}
+
+def split_match_prefix(pipeline: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Leading $match stages (the part a shared scan can run once) and the rest"""
+    position = 0
+    while position < len(pipeline) and set(pipeline[position]) == {'$match'}:
+        position += 1
+    return pipeline[:position], pipeline[position:]
+
+def shareable(pipeline: List[Dict[str, Any]]) -> bool:
+    """Whether a pipeline can run as one branch of a $facet without risking the 16 MB result limit"""
+    _, rest = split_match_prefix(pipeline)
+    if not rest or set(rest[0]) == {'$sample'}:
+        # A leading $sample reads random documents instead of scanning; keep it on its own
+        return False
+    operators = [next(iter(stage)) for stage in rest]
+    if any(operator in _FACET_EXCLUDED for operator in operators):
+        return False
+    if any(operator in _REDUCING_STAGES for operator in operators):
+        return True
+    return any(operator == '$limit' and stage['$limit'] <= FACET_MAX_ROWS
+               for operator, stage in zip(operators, rest))
+
+def plan_shared_scans(pipelines: List[List[Dict[str, Any]]]) -> List[List[int]]:
+    """Group pipeline indices that can share one scan; every other pipeline is a group of its own"""
+    groups: Dict[str, List[int]] = {}
+    plan: List[List[int]] = []
+    for index, pipeline in enumerate(pipelines):
+        if not shareable(pipeline):
+            plan.append([index])
+            continue
+        prefix, _ = split_match_prefix(pipeline)
+        key = canonicalize_pipeline(prefix)
+        if key not in groups:
+            groups[key] = []
+            plan.append(groups[key])
+        groups[key].append(index)
+    return plan
+
+def facet_pipeline(pipelines: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """One aggregation running each pipeline (which must share a $match prefix) as a $facet branch"""
+    prefix = None
+    branches = {}
+    for name, pipeline in pipelines.items():
+        prefix, branches[name] = split_match_prefix(pipeline)
+    # The shared $match runs before the $facet, where it can still use an index
+    return list(prefix or []) + [{'$facet': branches}]
+
+class Dashboard:
+    """A saved set of chart intents for one collection of a database, rendered together"""
+
+    def __init__(self, name: str, database: str, collection: str, panels: Optional[List[Dict[str, Any]]] = None,
+                 updated_at: Optional[float] = None):
+        self.name = name
+        self.database = database
+        self.collection = collection
+        # Each panel: {"query": question text, "intent": MongoQueryIntent fields}
+        self.panels = list(panels or [])
+        self.updated_at = updated_at or time.time()
+
+    def add_panel(self, query: str, intent: MongoQueryIntent):
+        self.panels.append({"query": query, "intent": intent.dict()})
+        self.updated_at = time.time()
+
+    def remove_panel(self, index: int):
+        del self.panels[index]
+        self.updated_at = time.time()
+
+    def intents(self) -> List[MongoQueryIntent]:
+        return [MongoQueryIntent(**panel["intent"]) for panel in self.panels]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "database": self.database, "collection": self.collection,
+                "panels": self.panels, "updated_at": self.updated_at}
+
+class DashboardStore:
+    """Saved dashboards, kept in SQLite (or in memory without a path).
+
+    Names are unique per database, and every lookup is scoped to one, so a
+    dashboard saved against db1.orders is neither listed, run nor replaced
+    from db2.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path
+        self._memory: Dict[Tuple[str, str], Dashboard] = {}
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if db_path:
+            try:
+                directory = os.path.dirname(db_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._conn = sqlite3.connect(db_path, check_same_thread=False)
+                # Replaces the dashboards table, whose names were global and didn't record the database
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS saved_dashboards ("
+                    "database TEXT NOT NULL, name TEXT NOT NULL, collection TEXT NOT NULL, panels TEXT NOT NULL, "
+                    "updated_at REAL, PRIMARY KEY (database, name))"
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                # Fall back to an in-memory store if the database can't be opened
+                self._conn = None
+
+    def save(self, dashboard: Dashboard):
+        dashboard.updated_at = time.time()
+        with self._lock:
+            self._memory[(dashboard.database, dashboard.name)] = dashboard
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO saved_dashboards (database, name, collection, panels, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (dashboard.database, dashboard.name, dashboard.collection,
+                     json.dumps(dashboard.panels, default=str), dashboard.updated_at)
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def load(self, database: str, name: str) -> Optional[Dashboard]:
+        with self._lock:
+            if self._conn is None:
+                return self._memory.get((database, name))
+            try:
+                row = self._conn.execute(
+                    "SELECT name, database, collection, panels, updated_at FROM saved_dashboards "
+                    "WHERE database = ? AND name = ?", (database, name)
+                ).fetchone()
+            except sqlite3.Error:
+                return self._memory.get((database, name))
+        if row is None:
+            return None
+        return Dashboard(row[0], row[1], row[2], json.loads(row[3]), row[4])
+
+    def list(self, database: str, collection: Optional[str] = None) -> List[str]:
+        """A database's dashboard names (optionally for one collection), most recently updated first"""
+        with self._lock:
+            if self._conn is None:
+                dashboards = sorted(self._memory.values(), key=lambda d: d.updated_at, reverse=True)
+                return [d.name for d in dashboards
+                        if d.database == database and (collection is None or d.collection == collection)]
+            try:
+                if collection is None:
+                    rows = self._conn.execute(
+                        "SELECT name FROM saved_dashboards WHERE database = ? ORDER BY updated_at DESC", (database,)
+                    ).fetchall()
+                else:
+                    rows = self._conn.execute(
+                        "SELECT name FROM saved_dashboards WHERE database = ? AND collection = ? "
+                        "ORDER BY updated_at DESC", (database, collection)
+                    ).fetchall()
+            except sqlite3.Error:
+                return []
+        return [row[0] for row in rows]
+
+    def delete(self, database: str, name: str):
+        with self._lock:
+            self._memory.pop((database, name), None)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute("DELETE FROM saved_dashboards WHERE database = ? AND name = ?", (database, name))
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+class DashboardExecutor:
+    """Render every panel of a dashboard, scanning the collection once per shared $match prefix.
+
+    Panels are built exactly like single requests (optimizer, point budget,
+    row ceiling, rollups). Pipelines that start with the same $match and
+    produce bounded results are run as branches of one $facet aggregation,
+    so N such panels cost one scan; the single result document is then
+    split back into a DataFrame and chart per panel. If the combined
+    aggregation fails (e.g. its result exceeds 16 MB), its panels are run
+    one by one instead.
+    """
+
+    def __init__(self, pipeline: Optional[RequestPipeline] = None, shared_scan: bool = SHARED_SCAN):
+        self.pipeline = pipeline or request_pipeline
+        self.connection = self.pipeline.connection
+        self.shared_scan = shared_scan
+
+    def _run_shared(self, collection_name: str, pipelines: Dict[str, List[Dict[str, Any]]],
+                    allow_expensive: bool) -> Optional[Tuple[Dict[str, List[Dict[str, Any]]], Optional[Dict]]]:
+        """Branch name -> result rows from one $facet aggregation, or None if it failed"""
+        combined = facet_pipeline(pipelines)
+        run_pipeline, preview = self.pipeline.guard_pipeline(collection_name, combined, allow_expensive)
+        with tracer.span("dashboard.scan", collection=collection_name, panels=len(pipelines), shared=True):
+            docs = [doc for batch in self.connection.iter_query_batches(collection_name, run_pipeline,
+                                                                        report_errors=False)
+                    for doc in batch]
+        if len(docs) != 1 or self.connection.last_query_truncated:
+            return None
+        return {name: docs[0].get(name, []) for name in pipelines}, preview
+
+    def run(self, dashboard: Dashboard, schema: Dict[str, str], exact: bool = False,
+            allow_expensive: bool = False) -> List[Dict[str, Any]]:
+        """One result per panel: {"query", "intent", "pipeline", "df", "fig", "truncated", "preview", "shared"}"""
+        collection_name = dashboard.collection
+        with tracer.span("dashboard", dashboard=dashboard.name, panels=len(dashboard.panels)) as root:
+            intents = dashboard.intents()
+            results: List[Dict[str, Any]] = []
+            pipelines = []
+            for panel, intent in zip(dashboard.panels, intents):
+                pipeline, ceiling_injected, _ = self.pipeline.build_pipeline(intent, collection_name, schema, exact)
+                pipelines.append(pipeline)
+                results.append({
+                    "query": panel.get("query"), "intent": intent, "pipeline": pipeline, "df": None,
+                    "fig": None, "truncated": False, "preview": None, "shared": False,
+                    "ceiling_injected": ceiling_injected,
+                })
+
+            plan = plan_shared_scans(pipelines) if self.shared_scan else [[i] for i in range(len(pipelines))]
+            for group in plan:
+                rows = None
+                if len(group) > 1:
+                    shared = self._run_shared(
+                        collection_name, {f"panel_{i}": pipelines[i] for i in group}, allow_expensive
+                    )
+                    if shared is not None:
+                        rows, preview = shared
+                        for i in group:
+                            results[i].update(df=ChartGenerator.convert_to_dataframe(rows[f"panel_{i}"]),
+                                              preview=preview, shared=True)
+                if rows is None:
+                    for i in group:
+                        run_pipeline, preview = self.pipeline.guard_pipeline(
+                            collection_name, pipelines[i], allow_expensive
+                        )
+                        df, truncated = self.pipeline.execute(collection_name, run_pipeline)
+                        results[i].update(df=df, truncated=truncated, preview=preview)
+
+            # Fan the results out to one chart per panel
+            for result in results:
+                df, intent = result["df"], result["intent"]
+                result["truncated"] = result["truncated"] or (
+                    result.pop("ceiling_injected") and len(df) >= self.connection.max_rows
+                )
+                field_stats = self.pipeline.field_stats(collection_name, result["pipeline"]) \
+                    if intent.chart_type not in CHART_TYPES else None
+                result["fig"] = ChartGenerator.generate_chart(df, intent, exact=exact, field_stats=field_stats) \
+                    if not df.empty else None
+            root.set(scans=len(plan))
+        return results
+
+# Create singleton instance
+dashboard_store = DashboardStore(os.getenv("DASHBOARD_PATH", ".cache/dashboards.sqlite3") or None)
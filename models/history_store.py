@@ -0,0 +1,488 @@
+import os
+import json
+import math
+import time
+import logging
+import sqlite3
+import importlib
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Any, Tuple
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from .intent_cache import normalize_query
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Results whose snapshot would be larger than this are saved without one (replaying re-runs them)
+HISTORY_MAX_SNAPSHOT_MB = float(os.getenv("HISTORY_MAX_SNAPSHOT_MB", "16"))
+# "arrow" (Arrow IPC stream, fastest to read back) or "parquet" (smaller)
+HISTORY_SNAPSHOT_FORMAT = os.getenv("HISTORY_SNAPSHOT_FORMAT", "arrow")
+
+def _compression(pa) -> Optional[str]:
+    for codec in ("zstd", "lz4"):
+        if pa.Codec.is_available(codec):
+            return codec
+    return None
+
+def _arrow_table(df: pd.DataFrame):
+    """Arrow table of a result; columns Arrow can't type (ObjectIds, mixed values) are kept as text"""
+    import pyarrow as pa
+
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        pass
+    columns = {}
+    for name in df.columns:
+        try:
+            columns[str(name)] = pa.array(df[name], from_pandas=True)
+        except (pa.ArrowException, TypeError, ValueError):
+            columns[str(name)] = pa.array(
+                [None if value is None or (isinstance(value, float) and math.isnan(value)) else str(value)
+                 for value in df[name]],
+                type=pa.string()
+            )
+    return pa.table(columns)
+
+def encode_snapshot(df: pd.DataFrame, fmt: str = HISTORY_SNAPSHOT_FORMAT) -> Optional[bytes]:
+    """Compressed columnar snapshot of a result DataFrame, or None without pyarrow"""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+
+    table = _arrow_table(df)
+    sink = pa.BufferOutputStream()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, sink, compression=_compression(pa) or "none")
+    else:
+        options = pa.ipc.IpcWriteOptions(compression=_compression(pa))
+        with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def decode_snapshot(data: bytes, fmt: str) -> Optional[pd.DataFrame]:
+    """DataFrame back from encode_snapshot, or None if it can't be read here"""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+
+    try:
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            table = pq.read_table(pa.BufferReader(data))
+        else:
+            table = pa.ipc.open_stream(data).read_all()
+    except (pa.ArrowException, OSError):
+        return None
+    return table.to_pandas()
+
+class HistoryBackend(ABC):
+    """Where history entries are kept; subclass to share history some other way.
+
+    An entry is a dict with "id", "namespace", "query", "normalized",
+    "intent", "pipeline", "source", "timings", "meta", "rows",
+    "snapshot_format", "snapshot_bytes", "computed_at", "last_used", "runs"
+    and "replays". There is one entry per question (normalized text) and
+    collection; recording it again replaces its contents and counts a run.
+    """
+
+    @abstractmethod
+    def upsert(self, entry: Dict[str, Any], snapshot: Optional[bytes]) -> Optional[int]:
+        """Insert or replace the entry for (namespace, normalized); returns its id"""
+
+    @abstractmethod
+    def get(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    def snapshot(self, entry_id: int) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def touch(self, entry_id: int):
+        """Count a replay"""
+
+    @abstractmethod
+    def list(self, namespace: Optional[str], order: str = "recent", limit: int = 20) -> List[Dict[str, Any]]:
+        """Entries by last use ("recent") or by runs plus replays ("popular")"""
+
+    @abstractmethod
+    def search(self, text: str, namespace: Optional[str], limit: int = 20) -> List[Dict[str, Any]]:
+        """Entries whose question contains every word of `text` (as a prefix), most popular first"""
+
+    @abstractmethod
+    def delete(self, entry_id: int):
+        pass
+
+    @abstractmethod
+    def trim(self, max_entries: int):
+        """Drop the least recently used entries beyond max_entries"""
+
+def _popularity(entry: Dict[str, Any]) -> int:
+    return entry["runs"] + entry["replays"]
+
+class MemoryHistoryBackend(HistoryBackend):
+    """History kept in this process only"""
+
+    def __init__(self):
+        self._entries: Dict[int, Dict[str, Any]] = {}
+        self._snapshots: Dict[int, bytes] = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def upsert(self, entry: Dict[str, Any], snapshot: Optional[bytes]) -> Optional[int]:
+        with self._lock:
+            existing = next((e for e in self._entries.values()
+                             if e["namespace"] == entry["namespace"] and e["normalized"] == entry["normalized"]), None)
+            if existing is not None:
+                entry = {**entry, "id": existing["id"], "runs": existing["runs"] + 1, "replays": existing["replays"]}
+            else:
+                entry = {**entry, "id": self._next_id, "runs": 1, "replays": 0}
+                self._next_id += 1
+            self._entries[entry["id"]] = entry
+            if snapshot is None:
+                self._snapshots.pop(entry["id"], None)
+            else:
+                self._snapshots[entry["id"]] = snapshot
+            return entry["id"]
+
+    def get(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            return dict(entry) if entry is not None else None
+
+    def snapshot(self, entry_id: int) -> Optional[bytes]:
+        with self._lock:
+            return self._snapshots.get(entry_id)
+
+    def touch(self, entry_id: int):
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is not None:
+                entry["replays"] += 1
+                entry["last_used"] = time.time()
+
+    def _scoped(self, namespace: Optional[str]) -> List[Dict[str, Any]]:
+        return [dict(e) for e in self._entries.values() if namespace is None or e["namespace"] == namespace]
+
+    def list(self, namespace: Optional[str], order: str = "recent", limit: int = 20) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = self._scoped(namespace)
+        key = (lambda e: (_popularity(e), e["last_used"])) if order == "popular" else (lambda e: e["last_used"])
+        return sorted(entries, key=key, reverse=True)[:limit]
+
+    def search(self, text: str, namespace: Optional[str], limit: int = 20) -> List[Dict[str, Any]]:
+        words = normalize_query(text).split()
+        with self._lock:
+            entries = self._scoped(namespace)
+        matches = [
+            e for e in entries
+            if all(any(token.startswith(word) for token in e["normalized"].split()) for word in words)
+        ]
+        return sorted(matches, key=lambda e: (_popularity(e), e["last_used"]), reverse=True)[:limit]
+
+    def delete(self, entry_id: int):
+        with self._lock:
+            self._entries.pop(entry_id, None)
+            self._snapshots.pop(entry_id, None)
+
+    def trim(self, max_entries: int):
+        with self._lock:
+            ordered = sorted(self._entries.values(), key=lambda e: e["last_used"], reverse=True)
+            for entry in ordered[max_entries:]:
+                self._entries.pop(entry["id"], None)
+                self._snapshots.pop(entry["id"], None)
+
+_COLUMNS = ("id", "namespace", "query", "normalized", "intent", "pipeline", "source", "timings", "meta", "rows",
+            "snapshot_format", "snapshot_bytes", "computed_at", "last_used", "runs", "replays")
+_JSON_COLUMNS = ("intent", "pipeline", "timings", "meta")
+
+class SQLiteHistoryBackend(HistoryBackend):
+    """History in a SQLite file, shared by every session of every app process using it.
+
+    Questions are indexed with FTS5 for search (plain LIKE matching where
+    SQLite is built without it); snapshots are stored as BLOBs next to
+    their entry and only read when replayed.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+        self.full_text = False
+
+        try:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            # Other processes may be writing to the same file
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    namespace TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    normalized TEXT NOT NULL,
+                    intent TEXT NOT NULL,
+                    pipeline TEXT NOT NULL,
+                    source TEXT,
+                    timings TEXT,
+                    meta TEXT,
+                    rows INTEGER,
+                    snapshot_format TEXT,
+                    snapshot_bytes INTEGER NOT NULL DEFAULT 0,
+                    computed_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    runs INTEGER NOT NULL DEFAULT 1,
+                    replays INTEGER NOT NULL DEFAULT 0,
+                    snapshot BLOB,
+                    UNIQUE (namespace, normalized)
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_recent ON history (namespace, last_used)")
+            self._conn.commit()
+        except sqlite3.Error:
+            # Callers fall back to an in-memory history
+            self._conn = None
+            return
+
+        try:
+            created = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_fts'").fetchone() is None
+            self._conn.executescript(
+                """CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                       normalized, content='history', content_rowid='id');
+                   CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                       INSERT INTO history_fts (rowid, normalized) VALUES (new.id, new.normalized);
+                   END;
+                   CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                       INSERT INTO history_fts (history_fts, rowid, normalized) VALUES ('delete', old.id, old.normalized);
+                   END;"""
+            )
+            if created:
+                # Index entries recorded before full-text search was available
+                self._conn.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+                self._conn.commit()
+            self.full_text = True
+        except sqlite3.Error:
+            pass
+
+    @property
+    def available(self) -> bool:
+        return self._conn is not None
+
+    @staticmethod
+    def _entry(row: Tuple) -> Dict[str, Any]:
+        entry = dict(zip(_COLUMNS, row))
+        for name in _JSON_COLUMNS:
+            entry[name] = json.loads(entry[name]) if entry[name] else None
+        return entry
+
+    def _select(self, where: str, params: Tuple, order: str, limit: int, join: str = "") -> List[Dict[str, Any]]:
+        columns = ", ".join(f"history.{name}" for name in _COLUMNS)
+        rows = self._conn.execute(
+            f"SELECT {columns} FROM history {join} WHERE {where} ORDER BY {order} LIMIT ?", params + (limit,)
+        ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def upsert(self, entry: Dict[str, Any], snapshot: Optional[bytes]) -> Optional[int]:
+        values = {name: json.dumps(entry[name], default=str) if name in _JSON_COLUMNS else entry[name]
+                  for name in _COLUMNS if name not in ("id", "runs", "replays")}
+        values["snapshot"] = snapshot
+        names = list(values)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in names if name not in ("namespace", "normalized"))
+        with self._lock:
+            try:
+                self._conn.execute(
+                    f"INSERT INTO history ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)}) "
+                    f"ON CONFLICT (namespace, normalized) DO UPDATE SET {updates}, runs = runs + 1",
+                    tuple(values[name] for name in names)
+                )
+                row = self._conn.execute(
+                    "SELECT id FROM history WHERE namespace = ? AND normalized = ?",
+                    (entry["namespace"], entry["normalized"])
+                ).fetchone()
+                self._conn.commit()
+                return row[0] if row else None
+            except sqlite3.Error:
+                logger.exception("Could not save a history entry")
+                return None
+
+    def get(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            try:
+                entries = self._select("history.id = ?", (entry_id,), "history.id", 1)
+            except (sqlite3.Error, ValueError):
+                return None
+        return entries[0] if entries else None
+
+    def snapshot(self, entry_id: int) -> Optional[bytes]:
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT snapshot FROM history WHERE id = ?", (entry_id,)).fetchone()
+            except sqlite3.Error:
+                return None
+        return row[0] if row else None
+
+    def touch(self, entry_id: int):
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "UPDATE history SET replays = replays + 1, last_used = ? WHERE id = ?", (time.time(), entry_id)
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def list(self, namespace: Optional[str], order: str = "recent", limit: int = 20) -> List[Dict[str, Any]]:
+        where, params = ("history.namespace = ?", (namespace,)) if namespace else ("1 = 1", ())
+        ordering = "history.runs + history.replays DESC, history.last_used DESC" if order == "popular" \
+            else "history.last_used DESC"
+        with self._lock:
+            try:
+                return self._select(where, params, ordering, limit)
+            except (sqlite3.Error, ValueError):
+                return []
+
+    def search(self, text: str, namespace: Optional[str], limit: int = 20) -> List[Dict[str, Any]]:
+        words = normalize_query(text).split()
+        if not words:
+            return self.list(namespace, "popular", limit)
+        scope, params = ("history.namespace = ?", (namespace,)) if namespace else ("1 = 1", ())
+        ordering = "history.runs + history.replays DESC, history.last_used DESC"
+        with self._lock:
+            try:
+                if self.full_text:
+                    # Every word as a prefix, quoted so FTS5 doesn't read it as syntax
+                    match = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+                    return self._select(
+                        f"history_fts MATCH ? AND {scope}", (match,) + params, ordering, limit,
+                        join="JOIN history_fts ON history_fts.rowid = history.id"
+                    )
+                likes = " AND ".join("(' ' || history.normalized) LIKE ?" for _ in words)
+                return self._select(f"{likes} AND {scope}", tuple(f"% {word}%" for word in words) + params,
+                                    ordering, limit)
+            except (sqlite3.Error, ValueError):
+                return []
+
+    def delete(self, entry_id: int):
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM history WHERE id = ?", (entry_id,))
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def trim(self, max_entries: int):
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "DELETE FROM history WHERE id NOT IN (SELECT id FROM history ORDER BY last_used DESC LIMIT ?)",
+                    (max_entries,)
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+def create_backend(spec: str, db_path: Optional[str] = None) -> HistoryBackend:
+    """Backend from HISTORY_BACKEND: "sqlite", "memory" or "package.module:ClassName" (built with no arguments)"""
+    if spec == "sqlite" and db_path:
+        backend = SQLiteHistoryBackend(db_path)
+        if backend.available:
+            return backend
+    elif spec not in ("sqlite", "memory"):
+        module_name, _, class_name = spec.partition(":")
+        try:
+            return getattr(importlib.import_module(module_name), class_name)()
+        except (ImportError, AttributeError, TypeError):
+            logger.exception("Could not load history backend %s; keeping history in memory", spec)
+    return MemoryHistoryBackend()
+
+class HistoryStore:
+    """Question history shared by every session, with result snapshots for instant replay.
+
+    Each question is saved per collection with its intent, optimized
+    pipeline, stage timings and a compressed columnar snapshot of the result,
+    so replaying it needs neither the LLM nor the cluster. Re-asking (or
+    refreshing) a question replaces its entry and counts towards its
+    popularity.
+    """
+
+    def __init__(self, backend: HistoryBackend, max_entries: int = 1000,
+                 max_snapshot_bytes: int = 16 * 1024 * 1024, snapshot_format: str = HISTORY_SNAPSHOT_FORMAT):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.snapshot_format = snapshot_format
+
+    def record(self, namespace: str, query: str, intent: Dict[str, Any], pipeline: List[Dict[str, Any]],
+               df: Optional[pd.DataFrame], timings: Optional[Dict[str, float]] = None, source: Optional[str] = None,
+               **meta: Any) -> Optional[int]:
+        """Save a question and its result; returns the entry id (None if it couldn't be saved)"""
+        snapshot = None
+        # Don't spend time encoding results far too large to be kept
+        if df is not None and not df.empty and df.memory_usage(deep=False).sum() <= self.max_snapshot_bytes * 4:
+            try:
+                snapshot = encode_snapshot(df, self.snapshot_format)
+            except Exception:
+                logger.exception("Could not snapshot the result of %r", query)
+            if snapshot is not None and len(snapshot) > self.max_snapshot_bytes:
+                snapshot = None
+        now = time.time()
+        entry = {
+            "namespace": namespace,
+            "query": query,
+            "normalized": normalize_query(query),
+            "intent": intent,
+            "pipeline": pipeline,
+            "source": source,
+            "timings": {stage: round(seconds, 4) for stage, seconds in (timings or {}).items()},
+            "meta": meta,
+            "rows": len(df) if df is not None else None,
+            "snapshot_format": self.snapshot_format if snapshot is not None else None,
+            "snapshot_bytes": len(snapshot) if snapshot is not None else 0,
+            "computed_at": now,
+            "last_used": now,
+        }
+        entry_id = self.backend.upsert(entry, snapshot)
+        if self.max_entries:
+            self.backend.trim(self.max_entries)
+        return entry_id
+
+    def replay(self, entry_id: int) -> Optional[Tuple[Dict[str, Any], Optional[pd.DataFrame]]]:
+        """An entry and its result snapshot (None when it has none), counting the replay"""
+        entry = self.backend.get(entry_id)
+        if entry is None:
+            return None
+        df = None
+        if entry["snapshot_format"]:
+            data = self.backend.snapshot(entry_id)
+            df = decode_snapshot(data, entry["snapshot_format"]) if data else None
+        self.backend.touch(entry_id)
+        return entry, df
+
+    def list(self, namespace: Optional[str] = None, order: str = "recent", limit: int = 20) -> List[Dict[str, Any]]:
+        return self.backend.list(namespace, order, limit)
+
+    def search(self, text: str, namespace: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        return self.backend.search(text, namespace, limit)
+
+    def delete(self, entry_id: int):
+        self.backend.delete(entry_id)
+
+# Create singleton instance
+history_store = HistoryStore(
+    create_backend(os.getenv("HISTORY_BACKEND", "sqlite"), os.getenv("HISTORY_PATH", ".cache/history.sqlite3") or None),
+    max_entries=int(os.getenv("HISTORY_MAX_ENTRIES", "1000")),
+    max_snapshot_bytes=int(HISTORY_MAX_SNAPSHOT_MB * 1024 * 1024),
+)
@@ -0,0 +1,291 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Any, Tuple, FrozenSet
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+_NUMBER = re.compile(r"^\d+(\.\d+)?$")
+# Words that change the answer however similar the rest of the phrasing is
+_MEANINGFUL_WORDS = frozenset({
+    "not", "no", "without", "except", "excluding", "never", "non",
+    "bar", "line", "pie", "scatter", "histogram", "chart", "graph", "plot", "table", "map",
+    "top", "bottom", "first", "last", "most", "least", "highest", "lowest", "ascending", "descending",
+})
+
+def normalize_query(query: str) -> str:
+    """Normalize query text so trivially different phrasings share a key"""
+    text = _NON_WORD.sub(" ", query.lower())
+    return _WHITESPACE.sub(" ", text).strip()
+
+def schema_hash(schema: Dict[str, Any]) -> str:
+    """Stable hash of a detected collection schema"""
+    payload = json.dumps(schema, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def token_set_similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """Jaccard similarity of two token sets"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class IntentCache:
+    """Two-tier (in-memory LRU + SQLite) cache of parsed query intents.
+
+    Entries are scoped to a collection (callers pass the database-qualified
+    namespace, so same-named collections in other databases don't share
+    intents) and the hash of its schema. Only exact (normalized) repeats are reused by default. A `fuzzy_threshold`
+    below 1 also reuses the closest cached phrasing by token similarity, as
+    long as it has the same numbers, negations and chart/ordering words; any
+    other differing word (a field or a filter value) can still change the
+    answer, so fuzzy matching is opt-in.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_entries: int = 256,
+                 max_disk_entries: int = 5000, ttl_seconds: float = 86400,
+                 fuzzy_threshold: float = 1.0):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self.fuzzy_threshold = fuzzy_threshold
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if db_path:
+            try:
+                directory = os.path.dirname(db_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._conn = sqlite3.connect(db_path, check_same_thread=False)
+                self._conn.execute(
+                    """CREATE TABLE IF NOT EXISTS intents (
+                        key TEXT PRIMARY KEY,
+                        collection TEXT NOT NULL,
+                        schema_hash TEXT NOT NULL,
+                        normalized TEXT NOT NULL,
+                        intent TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_access REAL NOT NULL
+                    )"""
+                )
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_intents_scope ON intents (collection, schema_hash)"
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                # Fall back to a memory-only cache if the file can't be opened
+                self._conn = None
+
+    @staticmethod
+    def make_key(normalized: str, collection_name: str, schema_digest: str) -> str:
+        """Build the exact-match cache key"""
+        raw = f"{collection_name}\x00{schema_digest}\x00{normalized}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _tokens(normalized: str) -> FrozenSet[str]:
+        return frozenset(normalized.split())
+
+    @staticmethod
+    def _numbers(tokens: FrozenSet[str]) -> FrozenSet[str]:
+        return frozenset(t for t in tokens if _NUMBER.match(t))
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, entry: Dict[str, Any]):
+        """Insert into the memory tier, evicting least recently used entries"""
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, query: str, collection_name: str, schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Look up a cached intent, trying exact then fuzzy matches"""
+        normalized = normalize_query(query)
+        digest = schema_hash(schema)
+        key = self.make_key(normalized, collection_name, digest)
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._expired(entry["created_at"]):
+                    del self._memory[key]
+                else:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry["intent"]
+
+            entry = self._load_from_disk(key)
+            if entry is not None:
+                self._remember(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry["intent"]
+
+            if self.fuzzy_threshold < 1:
+                entry = self._fuzzy_lookup(normalized, collection_name, digest)
+                if entry is not None:
+                    self.hits += 1
+                    self.fuzzy_hits += 1
+                    return entry["intent"]
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, collection_name: str, schema: Dict[str, Any], intent: Dict[str, Any]):
+        """Store a parsed intent in both tiers"""
+        normalized = normalize_query(query)
+        digest = schema_hash(schema)
+        key = self.make_key(normalized, collection_name, digest)
+        now = time.time()
+        entry = {
+            "collection": collection_name,
+            "schema_hash": digest,
+            "normalized": normalized,
+            "tokens": self._tokens(normalized),
+            "intent": intent,
+            "created_at": now,
+        }
+
+        with self._lock:
+            self._remember(key, entry)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO intents VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, collection_name, digest, normalized, json.dumps(intent, default=str), now, now)
+                )
+                self._evict_disk()
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def _load_from_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if self._conn is None:
+            return None
+        try:
+            row = self._conn.execute(
+                "SELECT collection, schema_hash, normalized, intent, created_at FROM intents WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self._expired(row[4]):
+                self._conn.execute("DELETE FROM intents WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE intents SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return {
+                "collection": row[0],
+                "schema_hash": row[1],
+                "normalized": row[2],
+                "tokens": self._tokens(row[2]),
+                "intent": json.loads(row[3]),
+                "created_at": row[4],
+            }
+        except (sqlite3.Error, ValueError):
+            return None
+
+    def _fuzzy_lookup(self, normalized: str, collection_name: str, digest: str) -> Optional[Dict[str, Any]]:
+        """Find the closest cached phrasing for the same collection and schema"""
+        tokens = self._tokens(normalized)
+        numbers = self._numbers(tokens)
+        meaningful = tokens & _MEANINGFUL_WORDS
+        best: Tuple[float, Optional[Dict[str, Any]]] = (0.0, None)
+
+        candidates = [
+            e for e in self._memory.values()
+            if e["collection"] == collection_name and e["schema_hash"] == digest
+        ]
+        if self._conn is not None:
+            try:
+                rows = self._conn.execute(
+                    "SELECT normalized, intent, created_at FROM intents "
+                    "WHERE collection = ? AND schema_hash = ? ORDER BY last_access DESC LIMIT 500",
+                    (collection_name, digest)
+                ).fetchall()
+                for row in rows:
+                    candidates.append({
+                        "collection": collection_name,
+                        "schema_hash": digest,
+                        "normalized": row[0],
+                        "tokens": self._tokens(row[0]),
+                        "intent": json.loads(row[1]),
+                        "created_at": row[2],
+                    })
+            except (sqlite3.Error, ValueError):
+                pass
+
+        for entry in candidates:
+            if self._expired(entry["created_at"]):
+                continue
+            # Never reuse an intent when the numbers differ ("top 5" vs "top 10")
+            if self._numbers(entry["tokens"]) != numbers:
+                continue
+            # Nor when it drops or adds a negation, chart type or ordering ("not shipped", "pie")
+            if entry["tokens"] & _MEANINGFUL_WORDS != meaningful:
+                continue
+            score = token_set_similarity(tokens, entry["tokens"])
+            if score >= self.fuzzy_threshold and score > best[0]:
+                best = (score, entry)
+
+        return best[1]
+
+    def _evict_disk(self):
+        """Drop expired rows and trim the disk tier to its size bound"""
+        if self.ttl_seconds > 0:
+            self._conn.execute("DELETE FROM intents WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        self._conn.execute(
+            "DELETE FROM intents WHERE key NOT IN "
+            "(SELECT key FROM intents ORDER BY last_access DESC LIMIT ?)",
+            (self.max_disk_entries,)
+        )
+
+    def clear(self):
+        """Remove every cached intent"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                try:
+                    self._conn.execute("DELETE FROM intents")
+                    self._conn.commit()
+                except sqlite3.Error:
+                    pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for display"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "fuzzy_hits": self.fuzzy_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+# Create singleton instance
+intent_cache = IntentCache(
+    db_path=os.getenv("INTENT_CACHE_PATH", ".cache/intent_cache.sqlite3") or None,
+    max_entries=int(os.getenv("INTENT_CACHE_MAX_ENTRIES", "256")),
+    ttl_seconds=float(os.getenv("INTENT_CACHE_TTL", "86400")),
+    fuzzy_threshold=float(os.getenv("INTENT_CACHE_FUZZY_THRESHOLD", "1.0"))
+)
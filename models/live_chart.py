@@ -0,0 +1,388 @@
+import os
+import time
+import logging
+import threading
+from typing import Dict, List, Optional, Any
+
+import pandas as pd
+import plotly.graph_objects as go
+from bson import json_util
+from dotenv import load_dotenv
+
+from .query_parser import MongoQueryIntent
+from utils.rollups import split_rollup_pipeline, partial_group, finalize_partials, safe_high_water, _ordered_id
+from utils.tracing import tracer
+from visualizations.chart_generator import ChartGenerator
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Seconds between refreshes of a live chart
+LIVE_REFRESH_INTERVAL = float(os.getenv("LIVE_REFRESH_INTERVAL", "10"))
+# Without change streams, updates and deletes go unnoticed; recompute in full every N polls (0 = never)
+LIVE_FULL_REFRESH_EVERY = int(os.getenv("LIVE_FULL_REFRESH_EVERY", "30"))
+# Seconds the high-water mark trails the clock, so slightly older concurrent writes aren't skipped
+LIVE_SAFETY_LAG = float(os.getenv("LIVE_SAFETY_LAG", "5"))
+
+# Stages after the $group that can be re-applied to the merged groups locally
+_TAIL_STAGES = {'$sort', '$limit', '$skip', '$project'}
+# Date fields that usually record insertion time, tried when _id isn't ordered
+_TIMESTAMP_NAMES = ('created_at', 'createdAt', 'inserted_at', 'timestamp', 'ts', 'time')
+
+def _simple_tail(tail: List[Dict[str, Any]]) -> bool:
+    """Whether every stage after the $group can be applied to a DataFrame of groups"""
+    for stage in tail:
+        operator, spec = next(iter(stage.items()))
+        if operator not in _TAIL_STAGES:
+            return False
+        if operator == '$project' and not all(
+            value in (0, 1, True, False) or (isinstance(value, str) and value.startswith("$")
+                                             and "." not in value and not value.startswith("$$"))
+            for value in spec.values()
+        ):
+            return False
+    return True
+
+def apply_tail(df: pd.DataFrame, tail: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Re-apply $sort/$skip/$limit/simple $project stages to merged group results"""
+    for stage in tail:
+        operator, spec = next(iter(stage.items()))
+        if operator == '$sort':
+            keys = [key for key in spec if key in df.columns]
+            if keys and not df.empty:
+                df = df.sort_values(keys, ascending=[spec[key] == 1 for key in keys],
+                                    kind="stable", key=lambda col: col.map(str) if col.dtype == object else col)
+        elif operator == '$skip':
+            df = df.iloc[int(spec):]
+        elif operator == '$limit':
+            df = df.iloc[:int(spec)]
+        elif operator == '$project':
+            included = {name: value for name, value in spec.items() if value not in (0, False)}
+            if included:
+                columns = {}
+                for name, value in included.items():
+                    source = value[1:] if isinstance(value, str) else name
+                    if source in df.columns:
+                        columns[name] = df[source]
+                if spec.get('_id', 1) not in (0, False) and '_id' in df.columns and '_id' not in columns:
+                    columns['_id'] = df['_id']
+                df = pd.DataFrame(columns, index=df.index)
+            else:
+                df = df.drop(columns=[name for name in spec if name in df.columns])
+    return df.reset_index(drop=True)
+
+class LiveChart:
+    """Keeps a grouped chart current by aggregating only documents added since the last refresh.
+
+    The pipeline's $match/$group head is run once up to a high-water mark
+    (the latest `_id`, or an insertion timestamp field), keeping per-group
+    partial aggregates. Each refresh aggregates just the documents past the
+    mark and folds them into those partials ($sum/$count/$avg add up,
+    $min/$max compare), re-applies the trailing $sort/$limit locally and
+    updates the existing figure's trace data in place. The mark trails the
+    clock by `safety_lag` seconds (see `safe_high_water`), since a concurrent
+    writer can still commit a document a little older than the newest one;
+    integer _ids carry no time and can't be held back.
+
+    On replica sets a change stream tells refreshes whether anything was
+    inserted (no query at all otherwise) and forces a full recompute after
+    updates or deletes. Elsewhere every refresh polls the high-water mark and
+    a full recompute runs every `full_refresh_every` polls.
+
+    Pipelines that aren't incremental (no $group, $push/$first accumulators,
+    unordered _id without a timestamp field, ...) are recomputed in full on
+    every refresh. The pipeline is built by the request pipeline like any
+    chart's (point budget, row ceiling), so full recomputes stay within the
+    collection's query budget; rollups are skipped, since they lag the source.
+    """
+
+    def __init__(self, pipeline, collection_name: str, intent: MongoQueryIntent, schema: Dict[str, str],
+                 exact: bool = False, allow_expensive: bool = False,
+                 full_refresh_every: int = LIVE_FULL_REFRESH_EVERY, safety_lag: float = LIVE_SAFETY_LAG):
+        self.request_pipeline = pipeline
+        self.connection = pipeline.connection
+        self.collection_name = collection_name
+        self.intent = intent
+        self.schema = schema
+        self.allow_expensive = allow_expensive
+        self.full_refresh_every = full_refresh_every
+        self.safety_lag = safety_lag
+        self.pipeline, self._ceiling_injected, _ = pipeline.build_pipeline(
+            intent, collection_name, schema, exact, rollups=False
+        )
+        split = split_rollup_pipeline(self.pipeline)
+        self.head, self.tail = split if split is not None and _simple_tail(split[1]) else (None, None)
+        self.watermark_field: Optional[str] = None
+        self.high_water: Any = None
+        self.df = pd.DataFrame()
+        # Whether the last full recompute was cut off by the row/byte ceiling, or ran on a preview sample
+        self.truncated = False
+        self.preview: Optional[Dict[str, Any]] = None
+        self.figure: Optional[go.Figure] = None
+        self.refreshes = 0
+        self.last_refresh: Dict[str, Any] = {}
+        self._groups: Dict[str, Dict[str, Any]] = {}
+        self._polls = 0
+        self._stream = None
+        self._op_id: Optional[str] = None
+        self._inserted = threading.Event()
+        self._changed = threading.Event()
+
+    @property
+    def incremental(self) -> bool:
+        return self.head is not None and self.watermark_field is not None
+
+    @property
+    def mode(self) -> str:
+        if not self.incremental:
+            return "full recompute"
+        return "change stream" if self._stream is not None else "polling"
+
+    # Setup
+
+    def _latest(self, field: str) -> Any:
+        collection = self.connection.get_collection(self.collection_name)
+        latest = collection.find_one({field: {"$exists": True}}, projection={field: 1}, sort=[(field, -1)])
+        return latest.get(field) if latest else None
+
+    def _high_water(self) -> Any:
+        """The newest watermark value old enough that nothing before it can still arrive"""
+        latest = self._latest(self.watermark_field)
+        high_water = safe_high_water(latest, self.safety_lag)
+        if high_water != latest:
+            # The newest documents are left for a later refresh, even if no further insert wakes it
+            self._inserted.set()
+        return high_water
+
+    def _choose_watermark(self) -> Optional[str]:
+        if _ordered_id(self._latest("_id")):
+            return "_id"
+        for name in _TIMESTAMP_NAMES:
+            if self.schema.get(name) == "date":
+                return name
+        return None
+
+    def _open_stream(self):
+        """Watch inserts (and changes that invalidate the partials) on replica sets"""
+        try:
+            if not self.connection.client.admin.command("hello").get("setName"):
+                return
+            collection = self.connection.get_collection(self.collection_name)
+            stream = collection.watch(
+                [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+            )
+        except Exception:
+            return
+
+        def run():
+            try:
+                with stream:
+                    for change in stream:
+                        if change["operationType"] == "insert":
+                            self._inserted.set()
+                        else:
+                            self._changed.set()
+            except Exception:
+                pass
+            finally:
+                self._stream = None
+
+        self._stream = stream
+        threading.Thread(target=run, name=f"live-chart-{self.collection_name}", daemon=True).start()
+
+    def start(self) -> pd.DataFrame:
+        """Load the initial result and begin watching for new documents"""
+        if self.head is not None:
+            self.watermark_field = self._choose_watermark()
+        if self.incremental:
+            self._open_stream()
+        self._recompute()
+        # Plain arrays, so refreshes can swap data into the trace in place
+        self.figure = ChartGenerator.generate_chart(self.df, self.intent, compact=False)
+        return self.df
+
+    def stop(self):
+        op_id = self._op_id
+        if op_id is not None:
+            self.connection.cancel_operation(op_id)
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    # Partial aggregates
+
+    @staticmethod
+    def _group_key(value: Any) -> str:
+        return json_util.dumps(value, sort_keys=True)
+
+    def _run_batches(self, pipeline: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Run a pipeline uncached within the query budget, raising if it fails"""
+        # Tracked, so stop() can kill a slow refresh
+        self._op_id = self.connection.new_operation_id()
+        try:
+            batches = list(self.connection.iter_query_batches(
+                self.collection_name, pipeline, use_cache=False, op_id=self._op_id, report_errors=False
+            ))
+        finally:
+            self._op_id = None
+        if self.connection.last_query_error is not None:
+            raise RuntimeError(f"Refreshing the chart failed: {self.connection.last_query_error}")
+        return batches
+
+    def _aggregate_partials(self, window: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        pipeline = ([{'$match': window}] if window else []) + self.head[:-1] + [
+            {'$group': partial_group(self.head[-1]['$group'])}
+        ]
+        partials = [doc for batch in self._run_batches(pipeline) for doc in batch]
+        # Folding in an incomplete set of partials would leave the groups wrong until the next recompute
+        if self.connection.last_query_truncated:
+            raise RuntimeError("Too many groups to keep the chart live; the result was cut off")
+        return partials
+
+    def _merge(self, partials: List[Dict[str, Any]]) -> int:
+        """Fold new partial aggregates into the kept groups; returns how many groups changed"""
+        group = self.head[-1]['$group']
+        for doc in partials:
+            key = self._group_key(doc['_id'])
+            current = self._groups.get(key)
+            if current is None:
+                self._groups[key] = doc
+                continue
+            for name, accumulator in group.items():
+                if name == '_id':
+                    continue
+                operator = next(iter(accumulator))
+                if operator == '$avg':
+                    for part in (f"{name}__sum", f"{name}__n"):
+                        current[part] = (current.get(part) or 0) + (doc.get(part) or 0)
+                elif operator in ('$sum', '$count'):
+                    current[name] = (current.get(name) or 0) + (doc.get(name) or 0)
+                else:
+                    values = [v for v in (current.get(name), doc.get(name)) if v is not None]
+                    if values:
+                        current[name] = min(values) if operator == '$min' else max(values)
+        return len(partials)
+
+    def _final_frame(self) -> pd.DataFrame:
+        """The merged groups as the original pipeline would have returned them"""
+        projection = finalize_partials(self.head[-1]['$group'])
+        rows = []
+        for doc in self._groups.values():
+            row = {'_id': doc['_id']}
+            for name, value in projection.items():
+                if name == '_id':
+                    continue
+                if value == 1:
+                    row[name] = doc.get(name)
+                else:
+                    total, count = doc.get(f"{name}__sum"), doc.get(f"{name}__n")
+                    row[name] = total / count if count else None
+            rows.append(row)
+        df = apply_tail(pd.DataFrame(rows), self.tail)
+        return ChartGenerator.flatten_id_columns(df)
+
+    def _recompute(self):
+        """Rebuild the result from scratch, leaving out only what the next incremental pass picks up"""
+        run_pipeline, self.preview = self.request_pipeline.guard_pipeline(
+            self.collection_name, self.pipeline, self.allow_expensive
+        )
+        if not self.incremental:
+            # Over budget, this runs on the $sample preview instead
+            self.df = ChartGenerator.batches_to_dataframe(self._run_batches(run_pipeline))
+            self.truncated = self.connection.last_query_truncated or (
+                self._ceiling_injected and len(self.df) >= self.connection.max_rows
+            )
+            return
+        if self.preview is not None:
+            # Partials of a sample can't be topped up with every new document
+            raise RuntimeError(f"This query {self.preview['reason']}, so it can't be kept live")
+        high_water = self._high_water()
+        self._groups = {}
+        # The complement of later windows ($gt the mark), so documents missing the field or
+        # holding another type still count, and ones inserted meanwhile aren't counted twice
+        window = {self.watermark_field: {'$not': {'$gt': high_water}}} if high_water is not None else None
+        self._merge(self._aggregate_partials(window))
+        self.high_water = high_water
+        self.df = self._final_frame()
+
+    # Refreshing
+
+    def refresh(self) -> Dict[str, Any]:
+        """Bring the chart up to date; returns what changed"""
+        started = time.perf_counter()
+        with tracer.span("live.refresh", collection=self.collection_name, mode=self.mode) as span:
+            self.refreshes += 1
+            new_documents, changed_groups, full = 0, 0, False
+            if not self.incremental:
+                self._recompute()
+                full, changed_groups = True, len(self.df)
+            elif self._changed.is_set() or (
+                self._stream is None and self.full_refresh_every and self.refreshes % self.full_refresh_every == 0
+            ):
+                # Updates or deletes can't be folded in; start over
+                self._changed.clear()
+                self._inserted.clear()
+                self._recompute()
+                full, changed_groups = True, len(self.df)
+            elif self._stream is None or self._inserted.is_set():
+                self._inserted.clear()
+                high_water = self._high_water()
+                if high_water is not None and (self.high_water is None or high_water > self.high_water):
+                    window = {self.watermark_field: {'$lte': high_water}}
+                    if self.high_water is not None:
+                        window[self.watermark_field]['$gt'] = self.high_water
+                    partials = self._aggregate_partials(window)
+                    new_documents = sum(self._count_documents(doc) for doc in partials)
+                    changed_groups = self._merge(partials)
+                    self.high_water = high_water
+                    self.df = self._final_frame()
+
+            if changed_groups:
+                self.figure = self.update_figure(self.figure, self.df, self.intent)
+            span.set(new_documents=new_documents, changed_groups=changed_groups, full=full)
+
+        self.last_refresh = {
+            "time": time.time(),
+            "new_documents": new_documents,
+            "changed_groups": changed_groups,
+            "full": full,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        return self.last_refresh
+
+    def _count_documents(self, partial: Dict[str, Any]) -> int:
+        """Documents behind a partial group, when the group counts them (or averages a field)"""
+        for name, accumulator in self.head[-1]['$group'].items():
+            if name == '_id':
+                continue
+            operator, expression = next(iter(accumulator.items()))
+            if operator == '$count' or (operator == '$sum' and expression == 1):
+                return int(partial.get(name) or 0)
+            if operator == '$avg':
+                return int(partial.get(f"{name}__n") or 0)
+        return 0
+
+    @staticmethod
+    def update_figure(fig: Optional[go.Figure], df: pd.DataFrame, intent: MongoQueryIntent) -> Optional[go.Figure]:
+        """Swap new data into an existing single-trace figure instead of rebuilding it"""
+        if fig is None or len(fig.data) != 1 or df.empty:
+            return ChartGenerator.generate_chart(df, intent, compact=False)
+        x_field, y_field = ChartGenerator.resolve_axes(df, intent)
+        if x_field not in df.columns or (y_field and y_field not in df.columns):
+            return ChartGenerator.generate_chart(df, intent, compact=False)
+        trace = fig.data[0]
+        with fig.batch_update():
+            if trace.type == 'pie':
+                trace.labels = df[x_field].to_numpy()
+                trace.values = df[y_field].to_numpy() if y_field else None
+            elif trace.type == 'histogram':
+                trace.x = df[x_field].to_numpy()
+            else:
+                trace.x = df[x_field].to_numpy()
+                trace.y = df[y_field].to_numpy() if y_field else None
+        return fig
@@ -0,0 +1,442 @@
+import re
+import json
+import copy
+from typing import Dict, List, Optional, Any, Set, Tuple
+
+# Accumulators whose result doesn't depend on the order documents arrive in ($mergeObjects
+# isn't one: the last document wins when keys repeat)
+ORDER_INSENSITIVE_ACCUMULATORS = {
+    '$sum', '$avg', '$min', '$max', '$count', '$addToSet', '$stdDevPop', '$stdDevSamp'
+}
+# Comparisons that can move out of $expr without changing results for scalar fields
+_EXPR_TO_QUERY = {'$eq': '$eq', '$gt': '$gt', '$gte': '$gte'}
+# Operators a clause on a group key may use to be pushed before the $group
+_RANGE_OPERATORS = {'$eq', '$gt', '$gte', '$lt', '$lte'}
+# Variables that refer to the whole document, so every field is read
+_WHOLE_DOCUMENT = ('$$ROOT', '$$CURRENT')
+# Upper bound on rewrite passes; each pass is linear in the pipeline length
+MAX_PASSES = 10
+
+class Stage:
+    """One pipeline stage: its operator and spec (multi-key or unknown stages are opaque)"""
+
+    def __init__(self, raw: Dict[str, Any]):
+        if len(raw) == 1:
+            self.op, self.spec = next(iter(raw.items()))
+        else:
+            self.op, self.spec = None, raw
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {self.op: self.spec} if self.op is not None else self.spec
+
+    def describe(self) -> str:
+        return self.op or "stage"
+
+def _conflicts(path: str, others: Set[str]) -> bool:
+    """Whether a dotted path overlaps any of the given paths (equal, parent or child)"""
+    for other in others:
+        if path == other or path.startswith(other + ".") or other.startswith(path + "."):
+            return True
+    return False
+
+def _expr_fields(expr: Any, fields: Set[str]) -> bool:
+    """Collect "$field" references from an aggregation expression.
+
+    Returns False when the expression reads the whole document ($$ROOT or
+    $$CURRENT), so its fields can't be listed.
+    """
+    if isinstance(expr, str):
+        if expr.startswith("$$"):
+            return expr.split(".")[0] not in _WHOLE_DOCUMENT
+        if expr.startswith("$"):
+            fields.add(expr[1:])
+        return True
+    if isinstance(expr, dict):
+        return all([_expr_fields(value, fields) for value in expr.values()])
+    if isinstance(expr, list):
+        return all([_expr_fields(value, fields) for value in expr])
+    return True
+
+def match_fields(predicate: Dict[str, Any]) -> Optional[Set[str]]:
+    """Field paths a $match predicate reads, or None if it can't be analysed ($where, $text, ...)"""
+    fields: Set[str] = set()
+    for key, value in predicate.items():
+        if key in ('$and', '$or', '$nor'):
+            if not isinstance(value, list):
+                return None
+            for clause in value:
+                inner = match_fields(clause) if isinstance(clause, dict) else None
+                if inner is None:
+                    return None
+                fields |= inner
+        elif key == '$expr':
+            if not _expr_fields(value, fields):
+                return None
+        elif key.startswith("$"):
+            return None
+        else:
+            fields.add(key)
+    return fields
+
+def _merge_predicates(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+    """AND two $match predicates, keeping a flat document when their keys don't collide"""
+    if not set(first) & set(second):
+        return {**first, **second}
+    clauses = []
+    for predicate in (first, second):
+        clauses.extend(predicate['$and'] if list(predicate) == ['$and'] else [predicate])
+    return {'$and': clauses}
+
+def _split_clauses(predicate: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Top-level conjuncts of a predicate, so they can be pushed down independently"""
+    if list(predicate) == ['$and'] and isinstance(predicate['$and'], list):
+        clauses = []
+        for clause in predicate['$and']:
+            clauses.extend(_split_clauses(clause))
+        return clauses
+    return [{key: value} for key, value in predicate.items()]
+
+def _join_clauses(clauses: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged: Dict[str, Any] = {}
+    for clause in clauses:
+        merged = _merge_predicates(merged, clause)
+    return merged
+
+def _written_fields(stage: Stage) -> Optional[Set[str]]:
+    """Fields a stage adds or replaces, for stages that otherwise pass documents through unchanged.
+
+    None means a $match can't be moved before the stage ($limit, $skip,
+    $group, $facet, $project, ...).
+    """
+    if stage.op in ('$addFields', '$set') and isinstance(stage.spec, dict):
+        return set(stage.spec)
+    if stage.op == '$unset':
+        return {stage.spec} if isinstance(stage.spec, str) else set(stage.spec)
+    if stage.op == '$unwind':
+        path = stage.spec if isinstance(stage.spec, str) else stage.spec.get('path', '')
+        written = {path.lstrip("$")}
+        if isinstance(stage.spec, dict) and stage.spec.get('includeArrayIndex'):
+            written.add(stage.spec['includeArrayIndex'])
+        return written
+    if stage.op == '$lookup' and isinstance(stage.spec, dict):
+        return {stage.spec.get('as', '')}
+    return None
+
+def _is_flag(value: Any, flag: int) -> bool:
+    return not isinstance(value, (dict, list, str)) and value == flag
+
+def _survives_project(field: str, spec: Dict[str, Any]) -> bool:
+    """Whether a field reaches the next stage unchanged through a $project"""
+    included = {k for k, v in spec.items() if _is_flag(v, 1)}
+    excluded = {k for k, v in spec.items() if _is_flag(v, 0)}
+    computed = set(spec) - included - excluded
+    if _conflicts(field, computed) or _conflicts(field, excluded):
+        return False
+    if included or computed - {'_id'}:
+        # Inclusion mode: only listed fields (and _id) survive
+        if '_id' not in spec:
+            included.add('_id')
+        return any(field == k or field.startswith(k + ".") for k in included)
+    return True
+
+def _can_cross(fields: Set[str], stage: Stage) -> bool:
+    """Whether a predicate on these fields gives the same result before the stage"""
+    if stage.op == '$project' and isinstance(stage.spec, dict):
+        return all(_survives_project(field, stage.spec) for field in fields)
+    written = _written_fields(stage)
+    if written is None:
+        return False
+    return not any(_conflicts(field, written) for field in fields)
+
+def _group_key_paths(group_id: Any) -> Optional[Dict[str, str]]:
+    """Map "_id"/"_id.k" paths of a $group output to the input fields they come from"""
+    if isinstance(group_id, str) and group_id.startswith("$") and not group_id.startswith("$$"):
+        return {"_id": group_id[1:]}
+    if isinstance(group_id, dict) and group_id and all(
+        isinstance(v, str) and v.startswith("$") and not v.startswith("$$") for v in group_id.values()
+    ):
+        return {f"_id.{k}": v[1:] for k, v in group_id.items()}
+    return None
+
+def _comparable(value: Any) -> bool:
+    """Whether a literal is a plain non-null value an equality or range match compares against"""
+    return value is not None and not isinstance(value, (dict, list)) and not hasattr(value, 'pattern')
+
+def _push_past_group(clause: Dict[str, Any], group: Stage) -> Optional[Dict[str, Any]]:
+    """Rewrite a clause on the group key into a clause on the input field, if possible"""
+    paths = _group_key_paths(group.spec.get('_id')) if isinstance(group.spec, dict) else None
+    if not paths or len(clause) != 1:
+        return None
+    key, value = next(iter(clause.items()))
+    if key.startswith("$") or key not in paths:
+        return None
+    # Documents missing the field form the null group, so $exists, $type and null
+    # checks on the key can't be answered from the input field; equality and ranges can
+    if isinstance(value, dict):
+        if not value or not set(value) <= _RANGE_OPERATORS or not all(_comparable(v) for v in value.values()):
+            return None
+    elif not _comparable(value):
+        return None
+    return {paths[key]: value}
+
+class PipelineOptimizer:
+    """Rule-based rewriter for LLM-generated aggregation pipelines.
+
+    Pushes $match predicates towards the front (past $sort, $project,
+    $addFields, $unwind, $lookup and, for clauses on the group key, $group),
+    coalesces adjacent stages, drops sorts whose order is thrown away, turns
+    simple $expr/$or predicates into index-friendly query operators and adds
+    a $limit for explicit top-N charts. Every rewrite is recorded as a note.
+    """
+
+    def __init__(self, schema: Optional[Dict[str, str]] = None, intent: Optional[Any] = None):
+        self.schema = schema or {}
+        self.intent = intent
+        self.notes: List[str] = []
+
+    def _note(self, message: str):
+        if message not in self.notes:
+            self.notes.append(message)
+
+    def optimize(self, pipeline: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        stages = [Stage(copy.deepcopy(raw)) for raw in pipeline]
+        for _ in range(MAX_PASSES):
+            before = json.dumps([s.to_dict() for s in stages], sort_keys=True, default=str)
+            stages = self._rewrite_predicates(stages)
+            stages = self._push_down_matches(stages)
+            stages = self._coalesce(stages)
+            stages = self._drop_redundant_sorts(stages)
+            if json.dumps([s.to_dict() for s in stages], sort_keys=True, default=str) == before:
+                break
+        stages = self._limit_top_n(stages)
+        return [stage.to_dict() for stage in stages], self.notes
+
+    # Predicate rewrites
+
+    def _is_scalar_field(self, field: str) -> bool:
+        kind = self.schema.get(field)
+        return kind is not None and kind not in ('array', 'object')
+
+    def _same_type(self, field: str, literal: Any) -> bool:
+        kind = self.schema.get(field)
+        if kind in ('integer', 'float', 'number'):
+            return isinstance(literal, (int, float)) and not isinstance(literal, bool)
+        if kind == 'string':
+            return isinstance(literal, str)
+        return False
+
+    def _rewrite_predicate(self, predicate: Dict[str, Any]) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for key, value in predicate.items():
+            if key == '$expr':
+                rewritten = self._expr_to_query(value)
+                if rewritten is not None:
+                    result = _merge_predicates(result, rewritten)
+                    continue
+            elif key == '$or' and isinstance(value, list):
+                rewritten = self._or_to_in(value)
+                if rewritten is not None:
+                    result = _merge_predicates(result, rewritten)
+                    continue
+            elif key == '$and' and isinstance(value, list):
+                value = [self._rewrite_predicate(c) if isinstance(c, dict) else c for c in value]
+            elif not key.startswith("$") and isinstance(value, dict) and list(value) == ['$in'] \
+                    and isinstance(value['$in'], list) and len(value['$in']) == 1 \
+                    and not isinstance(value['$in'][0], (dict, list)):
+                self._note(f"Rewrote single-value $in on {key} as an equality match")
+                value = value['$in'][0]
+            result = _merge_predicates(result, {key: value})
+        return result
+
+    def _expr_to_query(self, expr: Any) -> Optional[Dict[str, Any]]:
+        """{$expr: {$eq: ["$f", 5]}} -> {f: 5}, which can use an index on f"""
+        if not isinstance(expr, dict) or len(expr) != 1:
+            return None
+        op, args = next(iter(expr.items()))
+        if op == '$and' and isinstance(args, list):
+            parts = [self._expr_to_query(arg) for arg in args]
+            return _join_clauses(parts) if parts and all(p is not None for p in parts) else None
+        if op not in _EXPR_TO_QUERY or not isinstance(args, list) or len(args) != 2:
+            return None
+        field, literal = args
+        if not (isinstance(field, str) and field.startswith("$") and not field.startswith("$$")):
+            return None
+        if literal is None or isinstance(literal, (dict, list)) or (isinstance(literal, str) and literal.startswith("$")):
+            return None
+        # Array fields match element-wise in queries but not in $expr
+        if not self._is_scalar_field(field[1:]):
+            return None
+        # Range queries only compare within one BSON type; $expr compares across types
+        if op != '$eq' and not self._same_type(field[1:], literal):
+            return None
+        self._note(f"Rewrote $expr {op} on {field[1:]} as a query predicate so it can use an index")
+        query_op = _EXPR_TO_QUERY[op]
+        return {field[1:]: literal if query_op == '$eq' else {query_op: literal}}
+
+    def _or_to_in(self, clauses: List[Any]) -> Optional[Dict[str, Any]]:
+        """{$or: [{f: a}, {f: b}]} -> {f: {$in: [a, b]}}"""
+        field, values = None, []
+        for clause in clauses:
+            if not isinstance(clause, dict) or len(clause) != 1:
+                return None
+            key, value = next(iter(clause.items()))
+            if key.startswith("$") or isinstance(value, (dict, list)) or (field is not None and key != field):
+                return None
+            field = key
+            values.append(value)
+        if field is None:
+            return None
+        self._note(f"Rewrote $or of equality matches on {field} as $in")
+        return {field: {'$in': values}}
+
+    def _rewrite_predicates(self, stages: List[Stage]) -> List[Stage]:
+        for stage in stages:
+            if stage.op == '$match' and isinstance(stage.spec, dict):
+                stage.spec = self._rewrite_predicate(stage.spec)
+        return stages
+
+    # Stage reordering
+
+    def _push_down_matches(self, stages: List[Stage]) -> List[Stage]:
+        i = 1
+        while i < len(stages):
+            stage, prev = stages[i], stages[i - 1]
+            if stage.op != '$match' or not isinstance(stage.spec, dict):
+                i += 1
+                continue
+
+            if prev.op == '$sort':
+                stages[i - 1], stages[i] = stage, prev
+                self._note("Moved $match before $sort so fewer documents are sorted")
+                i = max(i - 1, 1)
+                continue
+
+            if prev.op == '$group':
+                pushed, kept = [], []
+                for clause in _split_clauses(stage.spec):
+                    rewritten = _push_past_group(clause, prev)
+                    # Array-valued keys group by the whole array but match element-wise
+                    if rewritten is not None and not self._is_scalar_field(next(iter(rewritten))):
+                        rewritten = None
+                    (pushed if rewritten is not None else kept).append(rewritten or clause)
+                if pushed:
+                    new = [Stage({'$match': _join_clauses(pushed)}), prev]
+                    if kept:
+                        new.append(Stage({'$match': _join_clauses(kept)}))
+                    stages[i - 1:i + 1] = new
+                    self._note("Moved $match on the group key before $group so it filters input documents")
+                    i = max(i - 1, 1)
+                    continue
+                i += 1
+                continue
+
+            crossable, blocked = [], []
+            for clause in _split_clauses(stage.spec):
+                fields = match_fields(clause)
+                (crossable if fields is not None and _can_cross(fields, prev) else blocked).append(clause)
+            if crossable:
+                new = [Stage({'$match': _join_clauses(crossable)}), prev]
+                if blocked:
+                    new.append(Stage({'$match': _join_clauses(blocked)}))
+                stages[i - 1:i + 1] = new
+                self._note(f"Moved $match before {prev.describe()} so it runs earlier")
+                i = max(i - 1, 1)
+                continue
+            i += 1
+        return stages
+
+    def _coalesce(self, stages: List[Stage]) -> List[Stage]:
+        result: List[Stage] = []
+        for stage in stages:
+            prev = result[-1] if result else None
+            if prev is not None and prev.op == stage.op:
+                merged = self._merge_pair(prev, stage)
+                if merged is not None:
+                    result[-1] = merged
+                    continue
+            if stage.op == '$match' and stage.spec == {} and len(stages) > 1:
+                self._note("Removed an empty $match")
+                continue
+            result.append(stage)
+        return result
+
+    def _merge_pair(self, first: Stage, second: Stage) -> Optional[Stage]:
+        op = first.op
+        if op == '$match' and isinstance(first.spec, dict) and isinstance(second.spec, dict):
+            self._note("Combined adjacent $match stages")
+            return Stage({'$match': _merge_predicates(first.spec, second.spec)})
+        if op == '$limit':
+            self._note("Combined adjacent $limit stages")
+            return Stage({'$limit': min(first.spec, second.spec)})
+        if op == '$skip':
+            self._note("Combined adjacent $skip stages")
+            return Stage({'$skip': first.spec + second.spec})
+        if op == '$sort':
+            # Sorts aren't stable, so only the last one determines the order
+            self._note("Dropped a $sort that was immediately re-sorted")
+            return second
+        if op == '$unwind' and first.spec == second.spec:
+            # Assumes arrays of scalars/documents; unwinding those twice is a no-op
+            self._note("Removed a repeated $unwind of the same path")
+            return first
+        if op == '$project' and self._pure_inclusion(first.spec) and self._pure_inclusion(second.spec):
+            # The second projection is all that's left when it keeps a subset of the first's
+            # exact paths and treats _id the same way
+            first_paths = set(first.spec) - {'_id'}
+            second_paths = set(second.spec) - {'_id'}
+            if second_paths <= first_paths and _is_flag(first.spec.get('_id', 1), 1) == _is_flag(second.spec.get('_id', 1), 1):
+                self._note("Combined adjacent $project stages")
+                return second
+            return None
+        if op in ('$addFields', '$set') and isinstance(first.spec, dict) and isinstance(second.spec, dict):
+            refs: Set[str] = set()
+            analysable = _expr_fields(second.spec, refs)
+            if analysable and not set(first.spec) & set(second.spec) \
+                    and not any(_conflicts(r, set(first.spec)) for r in refs):
+                self._note(f"Combined adjacent {op} stages")
+                return Stage({op: {**first.spec, **second.spec}})
+        return None
+
+    @staticmethod
+    def _pure_inclusion(spec: Any) -> bool:
+        return isinstance(spec, dict) and any(k != '_id' for k in spec) and all(
+            _is_flag(v, 1) for k, v in spec.items() if k != '_id'
+        ) and (_is_flag(spec.get('_id', 1), 1) or _is_flag(spec.get('_id'), 0))
+
+    def _drop_redundant_sorts(self, stages: List[Stage]) -> List[Stage]:
+        """A $sort right before an order-insensitive $group or a $count does nothing useful"""
+        result = []
+        for i, stage in enumerate(stages):
+            following = stages[i + 1] if i + 1 < len(stages) else None
+            if stage.op == '$sort' and following is not None:
+                if following.op == '$count':
+                    self._note("Dropped a $sort before $count")
+                    continue
+                if following.op == '$group' and isinstance(following.spec, dict):
+                    accumulators = {
+                        op for key, value in following.spec.items() if key != '_id' and isinstance(value, dict)
+                        for op in value
+                    }
+                    if accumulators <= ORDER_INSENSITIVE_ACCUMULATORS:
+                        self._note("Dropped a $sort before $group; its order is discarded by the grouping")
+                        continue
+            result.append(stage)
+        return result
+
+    def _limit_top_n(self, stages: List[Stage]) -> List[Stage]:
+        """Explicit "top N" charts only need the first N sorted rows"""
+        if self.intent is None or not stages or stages[-1].op != '$sort':
+            return stages
+        if any(stage.op in ('$limit', '$sample') for stage in stages):
+            return stages
+        match = re.search(r"\b(top|bottom|first)\s+(\d+)\b", getattr(self.intent, 'title', '') or '', re.I)
+        if not match:
+            return stages
+        n = int(match.group(2))
+        self._note(f"Added $limit {n} after the final $sort for the top-{n} chart")
+        return stages + [Stage({'$limit': n})]
+
+def optimize_pipeline(pipeline: List[Dict[str, Any]], schema: Optional[Dict[str, str]] = None,
+                      intent: Optional[Any] = None) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Optimized copy of a pipeline and notes describing each rewrite"""
+    return PipelineOptimizer(schema, intent).optimize(pipeline)
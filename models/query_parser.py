@@ -1,13 +1,15 @@
 import os
+import threading
+from collections import Counter
 from typing import Dict, List, Optional, Any
 import json
 import streamlit as st
 from dotenv import load_dotenv
-from langchain.chains import LLMChain
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.prompts import PromptTemplate
-from langchain.output_parsers import PydanticOutputParser
-from pydantic import BaseModel, Field
+from functools import cached_property
+from pydantic import BaseModel, Field, PrivateAttr
+from .intent_cache import intent_cache
+from .rule_parser import rule_parser, tokenize
+from utils.tracing import tracer, traced, set_attributes
 
 # Load environment variables
 load_dotenv()
@@ -21,73 +23,364 @@ class MongoQueryIntent(BaseModel):
     x_axis: str = Field(description="Field to use for x-axis")
     y_axis: str = Field(description="Field or operation to use for y-axis")
     title: str = Field(description="Chart title")
+    # Which path produced the intent: "cache", "rules" or "llm"
+    _source: str = PrivateAttr(default="llm")
+
+    @property
+    def source(self) -> str:
+        return self._source
+
+def _served_by(intent: Optional[MongoQueryIntent], source: str) -> Optional[MongoQueryIntent]:
+    if intent is not None:
+        intent._source = source
+    return intent
+
+class MongoQueryIntentList(BaseModel):
+    """Schema for several parsed intents returned by one LLM call"""
+    intents: List[MongoQueryIntent] = Field(description="One intent per numbered question, in the same order")
+
+PROMPT_TEMPLATE = """You are an expert in MongoDB and data visualization. You need to translate a natural language query about a MongoDB collection into a proper MongoDB aggregation pipeline and determine the appropriate visualization.
+
+Collection name: {collection_name}
+Collection schema: {schema}
+{related}
+User query: {query}
+
+First, analyze the intent of the query to determine what data to retrieve and how to visualize it.
+Then, construct the appropriate MongoDB aggregation pipeline to fulfill this intent.
+Finally, determine the best chart type to visualize the result.
+
+{format_instructions}
+"""
+
+BATCH_PROMPT_TEMPLATE = """You are an expert in MongoDB and data visualization. You need to translate each of the numbered natural language queries about a MongoDB collection into a proper MongoDB aggregation pipeline and determine the appropriate visualization.
+
+Collection name: {collection_name}
+Collection schema: {schema}
+{related}
+User queries:
+{queries}
+
+For each query, analyze its intent, construct the appropriate MongoDB aggregation pipeline and choose the best chart type.
+Return exactly one intent per query, in the same order.
+
+{format_instructions}
+"""
+
+# Schemas wider than this are pruned to the fields relevant to the question
+MAX_PROMPT_FIELDS = int(os.getenv("PROMPT_MAX_FIELDS", "40"))
+# Approximate prompt budget (about 4 characters per token)
+MAX_PROMPT_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "3000"))
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count used for the prompt budget"""
+    return len(text) // 4
+
+def prune_schema(queries: List[str], schema: Dict[str, str], max_fields: int = MAX_PROMPT_FIELDS) -> Dict[str, str]:
+    """Keep the fields whose names lexically match the questions, up to max_fields.
+
+    Small schemas are returned unchanged. Remaining slots after the matching
+    fields are filled with the other fields in their original order.
+    """
+    if len(schema) <= max_fields:
+        return schema
+
+    query_tokens = set()
+    for query in queries:
+        query_tokens |= tokenize(query)
+
+    scored = []
+    for position, field in enumerate(schema):
+        score = len(tokenize(field) & query_tokens)
+        scored.append((-score, position, field))
+    keep = {field for _, _, field in sorted(scored)[:max_fields]}
+    return {field: kind for field, kind in schema.items() if field in keep}
 
 class QueryParser:
+    """Natural language -> MongoQueryIntent via the intent cache, local rules or the LLM.
+
+    langchain and the Gemini client take over a second to import, so they're
+    loaded on first use (or ahead of it by `warm_up`, from a background
+    thread) rather than when the app starts; questions answered from the cache or by the rules
+    never load them at all.
+    """
+
     def __init__(self):
-        """Initialize the query parser with LLM"""
+        """Initialize the query parser; the LLM client is created on first use"""
         self.api_key = os.getenv("GOOGLE_API_KEY")
-        
-        if not self.api_key:
-            st.error("Google API key not found. Please set it in the .env file.")
-            return
-            
+        # Requests served per path ("cache", "rules", "llm")
+        self.source_counts = Counter()
+        self._llm = None
+        self._llm_lock = threading.Lock()
+        # Key whose client failed to initialize, so the error isn't repeated on every question
+        self._failed_key: Optional[str] = None
+    
+    @property
+    def llm(self):
+        """Gemini chat model for the current GOOGLE_API_KEY, or None without a key"""
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if self._llm is not None or not api_key or api_key == self._failed_key:
+            return self._llm
+        with self._llm_lock:
+            if self._llm is None:
+                try:
+                    from langchain_google_genai import ChatGoogleGenerativeAI
+                    self._llm = ChatGoogleGenerativeAI(
+                        api_key=api_key,
+                        model="gemini-2.0-flash",
+                        temperature=0
+                    )
+                    self.api_key = api_key
+                except Exception as e:
+                    self._failed_key = api_key
+                    st.error(f"Failed to initialize LLM: {str(e)}")
+        return self._llm
+    
+    @llm.setter
+    def llm(self, value):
+        self._llm = value
+    
+    @cached_property
+    def output_parser(self):
+        from langchain.output_parsers import PydanticOutputParser
+        return PydanticOutputParser(pydantic_object=MongoQueryIntent)
+    
+    @cached_property
+    def batch_output_parser(self):
+        from langchain.output_parsers import PydanticOutputParser
+        return PydanticOutputParser(pydantic_object=MongoQueryIntentList)
+    
+    # Templates (and their format instructions) are built once, not per query
+    @cached_property
+    def prompt_template(self):
+        from langchain.prompts import PromptTemplate
+        return PromptTemplate(
+            template=PROMPT_TEMPLATE,
+            input_variables=["query", "collection_name", "schema", "related"],
+            partial_variables={"format_instructions": self.output_parser.get_format_instructions()}
+        )
+    
+    @cached_property
+    def batch_prompt_template(self):
+        from langchain.prompts import PromptTemplate
+        return PromptTemplate(
+            template=BATCH_PROMPT_TEMPLATE,
+            input_variables=["queries", "collection_name", "schema", "related"],
+            partial_variables={"format_instructions": self.batch_output_parser.get_format_instructions()}
+        )
+    
+    def warm_up(self):
+        """Import langchain and build the prompt templates ahead of the first question"""
         try:
-            self.llm = ChatGoogleGenerativeAI(
-                api_key=self.api_key,
-                model="gemini-2.0-flash",
-                temperature=0
-            )
-            self.output_parser = PydanticOutputParser(pydantic_object=MongoQueryIntent)
-        except Exception as e:
-            st.error(f"Failed to initialize LLM: {str(e)}")
+            import langchain_google_genai  # noqa: F401
+            self.prompt_template
+            self.batch_prompt_template
+        except Exception:
+            # Reported (through st.error) when a question actually needs them
+            pass
     
-    def create_prompt(self, query: str, collection_name: str, schema: Dict[str, str]) -> str:
+    @staticmethod
+    def _format_related(related_collections: str) -> str:
+        if not related_collections:
+            return ""
+        return (
+            "Other collections in this database (join them with $lookup if the query needs them):\n"
+            f"{related_collections}\n"
+        )
+    
+    def _fit_prompt(self, render, queries: List[str], schema: Dict[str, str], related_collections: str) -> str:
+        """Render a prompt with a pruned schema, shrinking it until it fits the token budget"""
+        max_fields = MAX_PROMPT_FIELDS
+        related = self._format_related(related_collections)
+        while True:
+            pruned = prune_schema(queries, schema, max_fields)
+            prompt = render(json.dumps(pruned, separators=(",", ":")), related)
+            if estimate_tokens(prompt) <= MAX_PROMPT_TOKENS:
+                return prompt
+            if related:
+                # Cross-collection context goes first
+                related = ""
+            elif max_fields > 5:
+                max_fields = max(max_fields // 2, 5)
+            else:
+                return prompt
+    
+    def create_prompt(self, query: str, collection_name: str, schema: Dict[str, str],
+                      related_collections: str = "") -> str:
         """Create a prompt for the LLM"""
-        format_instructions = self.output_parser.get_format_instructions()
+        return self._fit_prompt(
+            lambda schema_json, related: self.prompt_template.format(
+                query=query, collection_name=collection_name, schema=schema_json, related=related
+            ),
+            [query], schema, related_collections
+        )
+    
+    def create_batch_prompt(self, queries: List[str], collection_name: str, schema: Dict[str, str],
+                            related_collections: str = "") -> str:
+        """Create one prompt asking for an intent per question"""
+        numbered = "\n".join(f"{i + 1}. {query}" for i, query in enumerate(queries))
+        return self._fit_prompt(
+            lambda schema_json, related: self.batch_prompt_template.format(
+                queries=numbered, collection_name=collection_name, schema=schema_json, related=related
+            ),
+            queries, schema, related_collections
+        )
+    
+    def _cached_intent(self, query: str, namespace: str,
+                       cache_schema: Dict[str, Any]) -> Optional[MongoQueryIntent]:
+        """Intent from the intent cache, if this question was parsed before"""
+        cached = intent_cache.get(query, namespace, cache_schema)
+        if cached is not None:
+            try:
+                return _served_by(MongoQueryIntent(**cached), "cache")
+            except Exception:
+                pass
+        return None
+    
+    @staticmethod
+    def _rule_intent(query: str, collection_name: str, schema: Dict[str, str]) -> Optional[MongoQueryIntent]:
+        """Intent compiled locally for common question shapes, if a rule matches confidently"""
+        compiled = rule_parser.try_compile(query, collection_name, schema)
+        return _served_by(MongoQueryIntent(**compiled), "rules") if compiled is not None else None
+    
+    def _local_intent(self, query: str, collection_name: str, schema: Dict[str, str],
+                      cache_schema: Dict[str, Any], namespace: str) -> Optional[MongoQueryIntent]:
+        """Cache, then rules; None means the question needs the LLM"""
+        intent = self._cached_intent(query, namespace, cache_schema)
+        if intent is None:
+            intent = self._rule_intent(query, collection_name, schema)
+        if intent is not None:
+            self.source_counts[intent.source] += 1
+            set_attributes(source=intent.source, cache_hit=intent.source == "cache")
+        return intent
+    
+    def _llm_available(self) -> bool:
+        if self.llm is not None:
+            return True
+        st.error(
+            "This question can't be answered offline and no Google API key is set. "
+            "Try a simpler form such as 'count of documents by <field>'."
+        )
+        return False
+    
+    @staticmethod
+    def _prompt_context(collection_name: str, schema: Dict[str, str], catalog: Optional[Any]):
+        """Related-collection listing and the schema used as the cache key"""
+        related = catalog.format_for_prompt(exclude=collection_name) if catalog is not None else ""
+        # The related collections change the prompt, so they're part of the cache key
+        cache_schema = {"schema": schema, "related": related} if related else schema
+        return related, cache_schema
+    
+    def _begin_parse(self, query: str, collection_name: str, schema: Dict[str, str], catalog: Optional[Any],
+                     namespace: str):
+        """Answer locally, or build the LLM prompt; returns (local_intent, prompt, cache_schema).
         
-        template = """
-        You are an expert in MongoDB and data visualization. You need to translate a natural language query about a MongoDB collection into a proper MongoDB aggregation pipeline and determine the appropriate visualization.
-
-        Collection name: {collection_name}
-        Collection schema: {schema}
+        The prompt is None when the question was answered locally or can't be sent.
+        """
+        related, cache_schema = self._prompt_context(collection_name, schema, catalog)
         
-        User query: {query}
+        # Repeated questions and common shapes ("count of X by Y") skip the LLM
+        local = self._local_intent(query, collection_name, schema, cache_schema, namespace)
+        if local is not None or not self._llm_available():
+            return local, None, cache_schema
         
-        First, analyze the intent of the query to determine what data to retrieve and how to visualize it.
-        Then, construct the appropriate MongoDB aggregation pipeline to fulfill this intent.
-        Finally, determine the best chart type to visualize the result.
+        set_attributes(source="llm", cache_hit=False)
+        with tracer.span("parse.prompt") as span:
+            prompt = self.create_prompt(query, collection_name, schema, related)
+            span.set(prompt_bytes=len(prompt))
+        return None, prompt, cache_schema
+    
+    def _finish_parse(self, query: str, namespace: str, cache_schema: Dict[str, Any],
+                      content: str) -> MongoQueryIntent:
+        """Parse the LLM's response and cache the intent"""
+        with tracer.span("parse.output"):
+            parsed_result = self.output_parser.parse(content)
+        intent_cache.put(query, namespace, cache_schema, parsed_result.dict())
+        self.source_counts["llm"] += 1
+        return parsed_result
+    
+    @traced("parse")
+    def parse_query(self, query: str, collection_name: str, schema: Dict[str, str],
+                    catalog: Optional[Any] = None, namespace: Optional[str] = None) -> Optional[MongoQueryIntent]:
+        """Parse a natural language query into a MongoDB query.
         
-        {format_instructions}
+        `catalog` is an optional SchemaCatalog describing the other collections,
+        which lets the LLM build cross-collection $lookup pipelines. Intents
+        are cached per `namespace` (the database-qualified collection name,
+        see MongoDBConnection.namespace) and schema.
         """
+        namespace = namespace or collection_name
+        try:
+            local, prompt, cache_schema = self._begin_parse(query, collection_name, schema, catalog, namespace)
+            if prompt is None:
+                return local
+            with tracer.span("parse.llm") as span:
+                response = self.llm.invoke(prompt)
+                span.set(response_bytes=len(response.content))
+            return self._finish_parse(query, namespace, cache_schema, response.content)
+        except Exception as e:
+            st.error(f"Failed to parse query: {str(e)}")
+            return None
+    
+    @traced("parse.batch")
+    def parse_queries(self, queries: List[str], collection_name: str, schema: Dict[str, str],
+                      catalog: Optional[Any] = None, namespace: Optional[str] = None) -> List[Optional[MongoQueryIntent]]:
+        """Parse several questions about one collection with a single LLM call.
         
-        prompt = PromptTemplate(
-            template=template,
-            input_variables=["query", "collection_name", "schema"],
-            partial_variables={"format_instructions": format_instructions}
-        )
+        Cached and rule-compiled questions are answered locally; the rest are
+        sent together. If the LLM doesn't return one intent per question, its
+        answers can't be matched to the questions, so each is asked on its own.
+        Returns one intent (or None) per question, in order.
+        """
+        namespace = namespace or collection_name
+        related, cache_schema = self._prompt_context(collection_name, schema, catalog)
+        results: List[Optional[MongoQueryIntent]] = [
+            self._local_intent(query, collection_name, schema, cache_schema, namespace) for query in queries
+        ]
+        pending = [i for i, intent in enumerate(results) if intent is None]
+        if not pending:
+            return results
         
-        return prompt.format(
-            query=query,
-            collection_name=collection_name,
-            schema=json.dumps(schema)
-        )
+        if not self._llm_available():
+            return results
+        
+        try:
+            set_attributes(llm_questions=len(pending))
+            with tracer.span("parse.prompt") as span:
+                prompt = self.create_batch_prompt([queries[i] for i in pending], collection_name, schema, related)
+                span.set(prompt_bytes=len(prompt))
+            with tracer.span("parse.llm") as span:
+                response = self.llm.invoke(prompt)
+                span.set(response_bytes=len(response.content))
+            with tracer.span("parse.output"):
+                parsed = self.batch_output_parser.parse(response.content).intents
+        except Exception as e:
+            st.error(f"Failed to parse queries: {str(e)}")
+            return results
+        
+        if len(parsed) != len(pending):
+            set_attributes(llm_intents=len(parsed))
+            for i in pending:
+                results[i] = self.parse_query(queries[i], collection_name, schema, catalog, namespace)
+            return results
+        for i, intent in zip(pending, parsed):
+            results[i] = intent
+            intent_cache.put(queries[i], namespace, cache_schema, intent.dict())
+            self.source_counts["llm"] += 1
+        return results
     
-    def parse_query(self, query: str, collection_name: str, schema: Dict[str, str]) -> Optional[MongoQueryIntent]:
-        """Parse a natural language query into a MongoDB query"""
-        if not self.api_key:
-            st.error("Google API key not found. Please set it in the .env file.")
-            return None
-            
+    async def aparse_query(self, query: str, collection_name: str, schema: Dict[str, str],
+                           catalog: Optional[Any] = None, namespace: Optional[str] = None) -> Optional[MongoQueryIntent]:
+        """Async variant of parse_query; awaits the LLM so other work can overlap it"""
+        namespace = namespace or collection_name
         try:
-            prompt = self.create_prompt(query, collection_name, schema)
-            
-            # Call the LLM
-            response = self.llm.invoke(prompt)
-            
-            # Parse the response
-            parsed_result = self.output_parser.parse(response.content)
-            return parsed_result
-            
+            local, prompt, cache_schema = self._begin_parse(query, collection_name, schema, catalog, namespace)
+            if prompt is None:
+                return local
+            with tracer.span("parse.llm") as span:
+                response = await self.llm.ainvoke(prompt)
+                span.set(response_bytes=len(response.content))
+            return self._finish_parse(query, namespace, cache_schema, response.content)
         except Exception as e:
             st.error(f"Failed to parse query: {str(e)}")
             return None
@@ -0,0 +1,357 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, Callable
+
+import pandas as pd
+from pymongo.errors import ExecutionTimeout
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from .query_parser import MongoQueryIntent, query_parser
+from .aggregation_builder import AggregationBuilder
+from .approximate import ApproximateQuery
+from utils.mongo_connection import mongo_connection
+from utils.query_guard import preview_pipeline
+from utils.tracing import tracer, traced, run_in_context
+from utils.schema_detection import build_collection_profile
+from visualizations.chart_generator import ChartGenerator, CHART_TYPES
+from visualizations.chart_selector import ChartSelector
+from visualizations.downsampling import point_budget
+
+# How often `on_poll` is called while the script thread waits for a request
+POLL_INTERVAL = 0.25
+
+class RequestCancelled(Exception):
+    """Raised when a chart request is cancelled before it finishes"""
+
+class CancelToken:
+    """Thread-safe cancellation flag shared between the UI and a running request"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], Any]] = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback: Callable[[], Any]):
+        """Call `callback` when the token is cancelled (right away if it already is)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise RequestCancelled()
+
+class RequestPipeline:
+    """Run a chart request (parse -> build -> execute -> DataFrame -> chart) on an asyncio loop.
+
+    The LLM call is awaited while the Mongo connection and schema profile are
+    warmed up on worker threads, and every stage reports its status through
+    `on_stage(stage, state, seconds)` where state is "running", "done" or "skipped".
+    """
+
+    def __init__(self, connection=None, parser=None, max_workers: int = 4):
+        self.connection = connection or mongo_connection
+        self.parser = parser or query_parser
+        self.max_workers = max_workers
+
+    def _executor(self) -> ThreadPoolExecutor:
+        """Worker pool whose threads can still report errors into the Streamlit session"""
+        ctx = get_script_run_ctx()
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="request-pipeline",
+            initializer=(lambda: add_script_run_ctx(threading.current_thread(), ctx)) if ctx else None
+        )
+
+    @staticmethod
+    def _report(on_stage: Optional[Callable], stage: str, state: str, seconds: float = 0.0):
+        if on_stage:
+            on_stage(stage, state, seconds)
+
+    def _prewarm(self, collection_name: str):
+        """Ping the server and refresh the schema profile while the LLM is busy"""
+        if self.connection.client is not None:
+            self.connection.client.admin.command('ping')
+        build_collection_profile(collection_name, connection=self.connection)
+        # Warm the fingerprint lookup the result cache will need
+        self.connection.get_collection_fingerprint(collection_name)
+
+    def build_pipeline(self, intent: MongoQueryIntent, collection_name: str, schema: Dict[str, str],
+                       exact: bool = False, rollups: bool = True):
+        """Safe, optimized, budgeted and capped pipeline for an intent, read from a rollup when one is fresh.
+        
+        Returns (pipeline, ceiling_injected, optimizer_notes). Pass
+        `rollups=False` when the pipeline must read the source collection.
+        """
+        pipeline = AggregationBuilder.create_safe_aggregation_from_intent(intent)
+        pipeline, notes = AggregationBuilder.optimize_pipeline(pipeline, schema, intent)
+        if not exact:
+            # Bin or sample raw-point line/scatter pipelines on the server
+            time_span = None
+            if schema.get(intent.x_axis) == 'date':
+                field_range = self.connection.get_field_range(collection_name, intent.x_axis)
+                if field_range:
+                    time_span = (field_range[1] - field_range[0]).total_seconds()
+            pipeline = AggregationBuilder.apply_point_budget(
+                pipeline, intent, schema, point_budget(intent.chart_type), time_span
+            )
+        capped_pipeline = AggregationBuilder.apply_row_ceiling(pipeline, self.connection.max_rows)
+        ceiling_injected = capped_pipeline is not pipeline
+        if rollups and self.connection.db is not None:
+            # Grouped pipelines are neither budgeted nor capped, so the rollup rewrite comes last
+            capped_pipeline, rollup_note = AggregationBuilder.apply_rollup(
+                capped_pipeline, self.connection.cluster_namespace(collection_name)
+            )
+            if rollup_note:
+                notes = notes + [rollup_note]
+        return capped_pipeline, ceiling_injected, notes
+
+    def execute(self, collection_name: str, pipeline: List[Dict[str, Any]], op_id: Optional[str] = None):
+        """Run the pipeline into a DataFrame; returns (df, truncated).
+        
+        With an op_id the running aggregation can be killed through
+        `connection.cancel_operation(op_id)`.
+        """
+        # Arrow fast path when available, otherwise stream cursor batches
+        table = None
+        if self.connection.columnar:
+            table = self.connection.execute_query_columnar(collection_name, pipeline, op_id=op_id)
+            if table is None and self.connection.last_query_error is not None \
+                    and (self.connection.query_guard.is_cancelled(op_id)
+                         or isinstance(self.connection.last_query_error, ExecutionTimeout)):
+                # Cancelled or out of time; running it again as a stream wouldn't help
+                return pd.DataFrame(), False
+        # The aggregation's own time is recorded as a child span, so this span's self time is the conversion
+        with tracer.span("dataframe") as span:
+            if table is not None:
+                df, truncated = ChartGenerator.columnar_to_dataframe(table), False
+            else:
+                batches = self.connection.iter_query_batches(collection_name, pipeline, op_id=op_id)
+                df, truncated = ChartGenerator.batches_to_dataframe(batches), self.connection.last_query_truncated
+            span.set(rows=len(df), columns=len(df.columns), bytes=int(df.memory_usage(deep=False).sum()))
+        return df, truncated
+    
+    def field_stats(self, collection_name: str, pipeline: List[Dict[str, Any]]) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Schema statistics for the pipeline's result columns, from the already profiled collection"""
+        if self.connection.db is None:
+            return None
+        profile = self.connection.collection_schemas.get((self.connection.db.name, collection_name))
+        if profile is None:
+            return None
+        return ChartSelector.result_field_stats(pipeline, profile.field_summaries())
+    
+    def guard_pipeline(self, collection_name: str, pipeline: List[Dict[str, Any]],
+                       allow_expensive: bool = False, estimate: Optional[Dict[str, Any]] = None):
+        """Pre-flight cost check; expensive pipelines run on a $sample preview instead.
+        
+        Returns (pipeline_to_run, preview) where preview describes the sampling
+        (or is None when the full pipeline runs). `estimate` is a preflight()
+        result already computed for the pipeline.
+        """
+        if estimate is None:
+            estimate = self.connection.preflight(collection_name, pipeline)
+        if not estimate["over_budget"] or allow_expensive:
+            return pipeline, None
+        
+        budget = self.connection.query_guard.budget_for(collection_name)
+        preview = {
+            "sample_size": budget.preview_size,
+            "estimated_docs": estimate["estimated_docs"],
+            "reason": estimate["over_budget"],
+        }
+        return preview_pipeline(pipeline, budget.preview_size), preview
+
+    @staticmethod
+    def _in_thread(executor: ThreadPoolExecutor, func: Callable, *args):
+        """Run func on the worker pool, keeping the current trace span as its parent"""
+        return asyncio.get_running_loop().run_in_executor(executor, run_in_context(func, *args))
+
+    async def _stage(self, name: str, start: Callable, on_stage, token: CancelToken, traced: bool = True):
+        """Run one stage: `start()` returns the awaitable, created inside the stage's span"""
+        token.raise_if_cancelled()
+        self._report(on_stage, name, "running")
+        began = time.perf_counter()
+        if traced:
+            with tracer.span(name):
+                result = await start()
+        else:
+            result = await start()
+        elapsed = time.perf_counter() - began
+        self._report(on_stage, name, "done", elapsed)
+        return result, elapsed
+
+    async def _run(self, query: str, collection_name: str, schema: Dict[str, str], catalog, exact: bool,
+                   allow_expensive: bool, approximate: bool, on_stage, token: CancelToken,
+                   executor: ThreadPoolExecutor) -> Dict[str, Any]:
+        with tracer.span("request", query=query, collection=collection_name) as root:
+            result = await self._run_stages(query, collection_name, schema, catalog, exact, allow_expensive,
+                                            approximate, on_stage, token, executor)
+            root.set(source=result["intent"].source if result["intent"] is not None else None)
+        result["trace_id"] = root.trace_id
+        return result
+
+    async def _run_stages(self, query: str, collection_name: str, schema: Dict[str, str], catalog, exact: bool,
+                          allow_expensive: bool, approximate: bool, on_stage, token: CancelToken,
+                          executor: ThreadPoolExecutor) -> Dict[str, Any]:
+        timings = {}
+
+        # Speculative pre-warm overlaps the LLM round trip
+        prewarm = self._in_thread(executor, traced("prewarm")(self._prewarm), collection_name)
+        intent, timings["parse"] = await self._stage(
+            "parse",
+            lambda: self.parser.aparse_query(query, collection_name, schema, catalog,
+                                             self.connection.namespace(collection_name)),
+            on_stage, token
+        )
+        if intent is None:
+            prewarm.cancel()
+            return {"intent": None, "timings": timings}
+        try:
+            # Only waits here; the pre-warm work has its own span
+            _, timings["prewarm"] = await self._stage("prewarm", lambda: prewarm, on_stage, token, traced=False)
+        except RequestCancelled:
+            raise
+        except Exception:
+            # Pre-warming is best effort; the real query reports its own errors
+            self._report(on_stage, "prewarm", "skipped")
+
+        (pipeline, ceiling_injected, optimizer_notes), timings["build"] = await self._stage(
+            "build",
+            lambda: self._in_thread(executor, self.build_pipeline, intent, collection_name, schema, exact),
+            on_stage, token
+        )
+        approximate_query = None
+        if approximate:
+            candidate = ApproximateQuery(self.connection, collection_name, pipeline, allow_expensive=allow_expensive)
+            approximate_query = candidate if candidate.supported else None
+        
+        # The plan is explained alongside execution, so index advice costs no extra latency
+        advise = traced("explain")(self.connection.advise_query)
+        if approximate_query is not None:
+            explain = self._in_thread(executor, advise, collection_name, pipeline)
+            # A small leading $sample is cheap on any collection, so there is no pre-flight check
+            self._report(on_stage, "preflight", "skipped")
+            token.on_cancel(approximate_query.stop)
+            estimate, timings["execute"] = await self._stage(
+                "execute", lambda: self._in_thread(executor, approximate_query.first), on_stage, token
+            )
+            df = estimate["df"] if estimate is not None else pd.DataFrame()
+            run_pipeline, preview, truncated = pipeline, None, False
+        else:
+            def preflight():
+                estimate = self.connection.preflight(collection_name, pipeline)
+                return self.guard_pipeline(collection_name, pipeline, allow_expensive, estimate), estimate
+
+            ((run_pipeline, preview), estimate), timings["preflight"] = await self._stage(
+                "preflight", lambda: self._in_thread(executor, preflight), on_stage, token
+            )
+            # Index advice reuses the pre-flight's plan rather than explaining the pipeline again
+            explain = self._in_thread(executor, advise, collection_name, pipeline, None, estimate.get("explain"))
+            # Cancelling the request kills the aggregation on the server too
+            op_id = self.connection.new_operation_id()
+            token.on_cancel(lambda: self.connection.cancel_operation(op_id))
+            (df, truncated), timings["execute"] = await self._stage(
+                "execute",
+                lambda: self._in_thread(executor, self.execute, collection_name, run_pipeline, op_id),
+                on_stage, token
+            )
+            truncated = truncated or (ceiling_injected and len(df) >= self.connection.max_rows)
+
+        # Only needed when the chart type is left to ChartSelector
+        field_stats = self.field_stats(collection_name, run_pipeline) if intent.chart_type not in CHART_TYPES else None
+        fig, timings["chart"] = await self._stage(
+            "chart",
+            lambda: self._in_thread(
+                executor, lambda: ChartGenerator.generate_chart(df, intent, exact=exact, field_stats=field_stats)
+            ),
+            on_stage, token
+        )
+        try:
+            plan = await explain
+        except Exception:
+            plan = None
+        return {
+            "intent": intent,
+            "pipeline": pipeline,
+            "original_pipeline": intent.aggregation_pipeline,
+            "optimizer_notes": optimizer_notes,
+            "df": df,
+            "fig": fig,
+            "truncated": truncated,
+            "preview": preview,
+            "approximate": approximate_query,
+            "plan": plan,
+            "timings": timings,
+        }
+
+    async def run(self, query: str, collection_name: str, schema: Dict[str, str], catalog=None,
+                  exact: bool = False, on_stage: Optional[Callable] = None,
+                  token: Optional[CancelToken] = None, allow_expensive: bool = False,
+                  approximate: bool = False, on_poll: Optional[Callable[[], Any]] = None) -> Dict[str, Any]:
+        """Run the request, raising RequestCancelled if the token is cancelled midway.
+        
+        Pipelines whose pre-flight estimate exceeds the collection's budget run
+        on a $sample preview unless `allow_expensive` is set. With `approximate`,
+        grouped pipelines are first answered from a small random sample; the
+        result's "approximate" entry (an ApproximateQuery) can then refine it.
+        
+        Every stage runs off the calling thread, which only waits; `on_poll()`
+        is called from it every POLL_INTERVAL seconds. Streamlit only stops a
+        script inside st.* calls, so the app makes one there for a rerun (the
+        Cancel Query button) to interrupt the request, which then kills its
+        server-side work.
+        """
+        token = token or CancelToken()
+        executor = self._executor()
+        main = asyncio.ensure_future(
+            self._run(query, collection_name, schema, catalog, exact, allow_expensive, approximate, on_stage, token,
+                      executor)
+        )
+        try:
+            # Poll the token so cancellation interrupts even a long LLM await
+            polled = time.perf_counter()
+            while not main.done():
+                if token.cancelled:
+                    main.cancel()
+                    break
+                await asyncio.wait({main}, timeout=0.05)
+                if on_poll is not None and time.perf_counter() - polled >= POLL_INTERVAL:
+                    polled = time.perf_counter()
+                    on_poll()
+            try:
+                return await main
+            except asyncio.CancelledError:
+                raise RequestCancelled()
+        finally:
+            if not main.done() or main.cancelled():
+                # Interrupted (e.g. by a Streamlit rerun): stop the server-side work as well
+                token.cancel()
+            # Abandon any blocking work that is still running
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def run_sync(self, *args, **kwargs) -> Dict[str, Any]:
+        """Blocking entry point for the Streamlit script thread"""
+        return asyncio.run(self.run(*args, **kwargs))
+
+# Create singleton instance
+request_pipeline = RequestPipeline()
@@ -0,0 +1,249 @@
+import os
+import re
+from typing import Dict, List, Optional, Any, Set, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+_CAMEL_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str) -> Set[str]:
+    """Lowercase word tokens, splitting camelCase/snake_case/dotted names and trailing plurals"""
+    words = _TOKEN.findall(_CAMEL_BOUNDARY.sub(" ", text).lower())
+    return {w[:-1] if len(w) > 3 and w.endswith("s") else w for w in words}
+
+# Intents below this confidence are handed to the LLM
+MIN_CONFIDENCE = float(os.getenv("RULE_PARSER_MIN_CONFIDENCE", "0.75"))
+
+_AGGREGATES = {
+    "count": "count", "number": "count", "how many": "count",
+    "average": "avg", "avg": "avg", "mean": "avg",
+    "total": "sum", "sum": "sum",
+    "minimum": "min", "min": "min", "lowest": "min",
+    "maximum": "max", "max": "max", "highest": "max",
+}
+_AGGREGATE_WORDS = "|".join(sorted((re.escape(k) for k in _AGGREGATES), key=len, reverse=True))
+_FILLER = re.compile(r"^(show|plot|chart|graph|display|give me|what is|what's|get)\s+(me\s+)?(the\s+)?", re.I)
+_CHART_WORDS = {
+    "pie": "pie", "line": "line", "bar": "bar", "scatter": "scatter", "histogram": "histogram",
+    "share": "pie", "proportion": "pie", "breakdown": "pie", "trend": "line",
+}
+_TIME_UNITS = {
+    "hour": "hour", "hourly": "hour", "day": "day", "daily": "day", "week": "week", "weekly": "week",
+    "month": "month", "monthly": "month", "quarter": "quarter", "quarterly": "quarter",
+    "year": "year", "yearly": "year", "annually": "year",
+}
+
+_TIME_QUALIFIER = re.compile(
+    r"\b(over time|over the years|by date|(per|by|each) (hour|day|week|month|quarter|year)|"
+    r"(hourly|daily|weekly|monthly|quarterly|yearly|annually))\b",
+    re.I
+)
+
+# "count of orders by region", "average price per category over time"
+_AGG_BY = re.compile(
+    rf"^(?P<agg>{_AGGREGATE_WORDS})(\s+(of|the))*\s+(?P<metric>.+?)\s+(by|per|for each|across|grouped by)\s+(?P<group>.+?)$",
+    re.I
+)
+# "orders by region" (implicit count)
+_THING_BY = re.compile(r"^(?P<metric>.+?)\s+(by|per|for each)\s+(?P<group>.+?)$", re.I)
+# "top 10 products by revenue"
+_TOP_N = re.compile(
+    r"^(?P<dir>top|bottom)\s+(?P<n>\d+)\s+(?P<group>.+?)\s+(by|with the (most|highest|largest))\s+(?P<metric>.+?)$",
+    re.I
+)
+# Words a counted phrase may use besides the collection name ("number of orders", "all records")
+_COUNT_WORDS = tokenize("count number how many records documents rows entries all of the")
+# "distribution of status"
+_DISTRIBUTION = re.compile(r"^(distribution|breakdown|frequency)\s+of\s+(?P<group>.+?)$", re.I)
+
+class RuleBasedParser:
+    """Deterministic compiler for common question shapes, used before (or instead of) the LLM.
+
+    `compile` returns an intent dict (the MongoQueryIntent fields) and a
+    confidence between 0 and 1; callers fall back to the LLM when the
+    confidence is below MIN_CONFIDENCE.
+    """
+
+    def __init__(self, min_confidence: float = MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+
+    @staticmethod
+    def match_field(phrase: str, schema: Dict[str, str],
+                    kinds: Optional[Set[str]] = None) -> Tuple[Optional[str], float]:
+        """Best schema field for a phrase, scored by token overlap"""
+        phrase = phrase.strip().lower()
+        phrase_tokens = tokenize(phrase)
+        if not phrase_tokens:
+            return None, 0.0
+
+        best, best_score = None, 0.0
+        for field, kind in schema.items():
+            if kinds and kind not in kinds:
+                continue
+            if field.lower() == phrase or field.lower().replace("_", " ") == phrase:
+                return field, 1.0
+            field_tokens = tokenize(field)
+            if not field_tokens:
+                continue
+            score = len(phrase_tokens & field_tokens) / len(phrase_tokens | field_tokens)
+            # Prefer top-level fields over nested ones on ties
+            if score > best_score or (score == best_score and best and field.count(".") < best.count(".")):
+                best, best_score = field, score
+        return best, best_score
+
+    @staticmethod
+    def _chart_hint(query: str) -> Optional[str]:
+        for word in tokenize(query):
+            if word in _CHART_WORDS:
+                return _CHART_WORDS[word]
+        return None
+
+    @staticmethod
+    def _strip(query: str) -> Tuple[str, Optional[str], bool]:
+        """Remove filler words, chart words and time qualifiers; return (core, unit, over_time)"""
+        text = query.strip().rstrip("?.!").strip()
+        text = _FILLER.sub("", text)
+        text = re.sub(r"\b(as|in|on)\s+an?\s+\w+\s+(chart|graph|plot)\b", "", text, flags=re.I)
+        text = re.sub(r"\b(pie|line|bar|scatter)\s+(chart|graph|plot)\s+(of|for)\s+", "", text, flags=re.I)
+
+        unit = None
+        over_time = False
+        # A question can carry several qualifiers ("over time per month")
+        for match in reversed(list(_TIME_QUALIFIER.finditer(text))):
+            over_time = True
+            phrase = match.group(0).lower()
+            for word, value in _TIME_UNITS.items():
+                if unit is None and re.search(rf"\b{word}\b", phrase):
+                    unit = value
+            text = text[:match.start()] + text[match.end():]
+        return re.sub(r"\s+", " ", text).strip(), unit, over_time
+
+    @staticmethod
+    def _accumulator(agg: str, field: Optional[str]) -> Tuple[str, Dict[str, Any]]:
+        if agg == "count" or field is None:
+            return "count", {"$sum": 1}
+        name = f"{agg}_{field.replace('.', '_')}"
+        return name, {f"${agg}": f"${field}"}
+
+    def compile(self, query: str, collection_name: str, schema: Dict[str, str]) -> Tuple[Optional[Dict[str, Any]], float]:
+        """Compile a question into an intent dict, or (None, 0.0) when no rule applies"""
+        if not schema:
+            return None, 0.0
+
+        core, unit, over_time = self._strip(query)
+        numeric = {"integer", "float", "number"}
+        dates = {"date"}
+
+        agg, metric_phrase, group_phrase, top_n, descending = "count", None, None, None, True
+        base = 0.0
+
+        match = _TOP_N.match(core)
+        if match:
+            top_n = int(match.group("n"))
+            descending = match.group("dir").lower() == "top"
+            group_phrase = match.group("group")
+            metric_phrase = match.group("metric")
+            agg = "sum"
+            base = 0.9
+        elif _AGG_BY.match(core):
+            match = _AGG_BY.match(core)
+            agg = _AGGREGATES[match.group("agg").lower()]
+            metric_phrase = match.group("metric")
+            group_phrase = match.group("group")
+            base = 1.0
+        elif _DISTRIBUTION.match(core):
+            group_phrase = _DISTRIBUTION.match(core).group("group")
+            base = 0.95
+        elif _THING_BY.match(core):
+            match = _THING_BY.match(core)
+            metric_phrase = match.group("metric")
+            group_phrase = match.group("group")
+            base = 0.85
+        elif over_time and core:
+            # "average price over time" / "orders per month"
+            parts = re.match(rf"^(?P<agg>{_AGGREGATE_WORDS})?(\s+(of|the))*\s*(?P<metric>.+)$", core, re.I)
+            if parts and parts.group("agg"):
+                agg = _AGGREGATES[parts.group("agg").lower()]
+            metric_phrase = parts.group("metric") if parts else core
+            base = 0.85
+        else:
+            return None, 0.0
+
+        # Resolve the metric: a numeric field for sum/avg/min/max, otherwise a plain count
+        metric_field, metric_score = None, 1.0
+        if agg != "count" and metric_phrase:
+            if metric_phrase.strip().lower() in ("count", "number", "records", "documents", collection_name.lower()):
+                agg = "count"
+            else:
+                metric_field, metric_score = self.match_field(metric_phrase, schema, numeric)
+                if metric_field is None or metric_score < 0.5:
+                    return None, 0.0
+        elif agg == "count" and metric_phrase:
+            # "orders by region" counts documents; if the phrase names a numeric field, sum it
+            field, score = self.match_field(metric_phrase, schema, numeric)
+            if top_n is None and field is not None and score >= 0.8 and base < 1.0:
+                agg, metric_field, metric_score = "sum", field, score
+
+        # A counted phrase that says more than the collection name ("cancelled orders")
+        # is a filter the rules can't express; leave it to the LLM
+        if agg == "count" and metric_phrase \
+                and tokenize(metric_phrase) - tokenize(collection_name) - _COUNT_WORDS:
+            return None, 0.0
+
+        # Resolve the grouping field; time questions group on a date field
+        if over_time and not group_phrase:
+            date_fields = [f for f, kind in schema.items() if kind in dates]
+            if len(date_fields) != 1:
+                return None, 0.0
+            group_field, group_score = date_fields[0], 0.9
+        else:
+            group_field, group_score = self.match_field(group_phrase or "", schema)
+            if group_field is None or group_score < 0.5:
+                return None, 0.0
+            if over_time and schema.get(group_field) not in dates:
+                over_time = False
+
+        y_name, accumulator = self._accumulator(agg, metric_field)
+        is_date = schema.get(group_field) in dates
+        if is_date:
+            group_key: Any = {"$dateTrunc": {"date": f"${group_field}", "unit": unit or "day"}}
+        else:
+            group_key = f"${group_field}"
+
+        pipeline: List[Dict[str, Any]] = [{"$group": {"_id": group_key, y_name: accumulator}}]
+        if top_n is not None:
+            pipeline += [{"$sort": {y_name: -1 if descending else 1}}, {"$limit": top_n}]
+        else:
+            pipeline.append({"$sort": {"_id": 1}})
+
+        chart_type = self._chart_hint(query)
+        if chart_type is None:
+            chart_type = "line" if is_date else "bar"
+
+        labels = {"avg": "Average", "sum": "Total", "min": "Minimum", "max": "Maximum"}
+        metric_label = "Count" if y_name == "count" else f"{labels[agg]} {metric_field}"
+        title = f"{'Top' if descending else 'Bottom'} {top_n} {group_field} by {metric_label.lower()}" \
+            if top_n is not None else f"{metric_label} by {group_field}"
+
+        confidence = base * min(metric_score, group_score)
+        intent = {
+            "collection": collection_name,
+            "operation_type": "aggregate",
+            "aggregation_pipeline": pipeline,
+            "chart_type": chart_type,
+            "x_axis": "_id",
+            "y_axis": y_name,
+            "title": title,
+        }
+        return intent, confidence
+
+    def try_compile(self, query: str, collection_name: str, schema: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """Intent dict if a rule matched with enough confidence, else None"""
+        intent, confidence = self.compile(query, collection_name, schema)
+        return intent if intent is not None and confidence >= self.min_confidence else None
+
+# Create singleton instance
+rule_parser = RuleBasedParser()
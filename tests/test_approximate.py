@@ -0,0 +1,93 @@
+import math
+
+import mongomock
+import pytest
+
+from models.approximate import ApproximateQuery, carry_errors, estimate_rows, sample_group
+from utils.mongo_connection import MongoDBConnection
+
+Z95 = 1.959963984540054
+
+# Estimates
+
+def test_counts_are_scaled_to_the_population():
+    group = {'_id': '$region', 'orders': {'$sum': 1}}
+    [row] = estimate_rows([{'_id': 'east', 'orders': 30, 'orders__sq': 30}], group, sampled=100, population=1000)
+    assert row['orders'] == 300
+    # A 0/1 contribution per sampled document: 30 ones, 70 zeros
+    variance = (30 - 30 * 30 / 100) / 99
+    assert row['orders__error'] == pytest.approx(Z95 * 1000 * math.sqrt(variance * 0.9 / 100))
+
+def test_sums_of_values_are_scaled_without_rounding():
+    group = {'_id': None, 'revenue': {'$sum': '$amount'}}
+    [row] = estimate_rows([{'_id': None, 'revenue': 2.5, 'revenue__sq': 6.25}], group, sampled=4, population=10)
+    assert row['revenue'] == 6.25
+
+def test_averages_get_the_standard_error_of_the_mean():
+    group = {'_id': None, 'mean': {'$avg': '$amount'}}
+    # Values 2, 4, 6: sample variance 4
+    doc = {'_id': None, 'mean__sum': 12, 'mean__sq': 56, 'mean__n': 3}
+    [row] = estimate_rows([doc], group, sampled=1000, population=10 ** 9)
+    assert row['mean'] == 4
+    assert row['mean__error'] == pytest.approx(Z95 * math.sqrt(4 / 3), rel=1e-5)
+
+def test_a_sample_of_everything_has_no_error():
+    group = {'_id': None, 'orders': {'$count': {}}, 'mean': {'$avg': '$amount'}}
+    doc = {'_id': None, 'orders': 3, 'orders__sq': 3, 'mean__sum': 12, 'mean__sq': 56, 'mean__n': 3}
+    [row] = estimate_rows([doc], group, sampled=3, population=3)
+    assert row['orders'] == 3 and row['mean'] == 4
+    assert row['orders__error'] == 0 and row['mean__error'] == 0
+
+def test_higher_confidence_widens_the_interval():
+    group = {'_id': None, 'mean': {'$avg': '$amount'}}
+    doc = {'_id': None, 'mean__sum': 12, 'mean__sq': 56, 'mean__n': 3}
+    narrow = estimate_rows([doc], group, 100, 10 ** 6, confidence=0.8)[0]['mean__error']
+    wide = estimate_rows([doc], group, 100, 10 ** 6, confidence=0.99)[0]['mean__error']
+    assert narrow < wide
+
+def test_extremes_and_single_values_get_no_interval():
+    group = {'_id': None, 'high': {'$max': '$amount'}, 'mean': {'$avg': '$amount'}}
+    [row] = estimate_rows([{'_id': None, 'high': 9, 'mean__sum': 9, 'mean__sq': 81, 'mean__n': 1}],
+                          group, sampled=10, population=100)
+    assert row == {'_id': None, 'high': 9, 'mean': 9, 'mean__error': None}
+
+# Pipeline rewrites
+
+def test_sample_group_keeps_sums_of_squares():
+    stats = sample_group({'_id': '$region', 'orders': {'$count': {}}, 'mean': {'$avg': '$amount'},
+                          'high': {'$max': '$amount'}})
+    assert stats['orders'] == {'$sum': 1} and stats['orders__sq'] == {'$sum': 1}
+    assert set(stats) == {'_id', 'orders', 'orders__sq', 'mean__sum', 'mean__sq', 'mean__n', 'high'}
+    assert stats['high'] == {'$max': '$amount'}
+
+def test_projections_carry_the_error_columns():
+    group = {'_id': '$region', 'total': {'$sum': '$amount'}}
+    tail = [{'$sort': {'total': -1}}, {'$project': {'_id': 0, 'region': '$_id', 'revenue': '$total'}},
+            {'$project': {'internal': 0}}]
+    assert carry_errors(tail, group) == [
+        {'$sort': {'total': -1}},
+        {'$project': {'_id': 0, 'region': '$_id', 'revenue': '$total', 'revenue__error': '$total__error'}},
+        {'$project': {'internal': 0}},
+    ]
+
+# Running against a collection
+
+@pytest.fixture
+def connection():
+    connection = MongoDBConnection()
+    connection.client = mongomock.MongoClient()
+    connection.db = connection.client.shop
+    connection.db.orders.insert_many([{'region': f'r{n % 40}', 'amount': n} for n in range(400)])
+    return connection
+
+PIPELINE = [{'$group': {'_id': '$region', 'orders': {'$sum': 1}}}, {'$sort': {'_id': 1}}]
+
+def test_exact_result_is_marked_exact(connection):
+    query = ApproximateQuery(connection, 'orders', PIPELINE, sample_sizes=[100])
+    result = query.first()
+    assert result['exact'] and len(result['df']) == 40
+
+def test_truncated_result_is_not_presented_as_exact(connection):
+    connection.query_guard.defaults.max_rows = 20
+    query = ApproximateQuery(connection, 'orders', PIPELINE, sample_sizes=[100])
+    assert query.exact(report_errors=False) is None
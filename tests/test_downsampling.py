@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from visualizations.downsampling import lttb_indices, minmax_indices, reduce_points
+
+def wave(n=1000):
+    x = np.arange(n, dtype=np.float64)
+    return x, np.sin(x / 25.0)
+
+# LTTB
+
+def test_lttb_keeps_endpoints_and_returns_threshold_points():
+    x, y = wave()
+    picked = lttb_indices(x, y, 100)
+    assert len(picked) == 100
+    assert picked[0] == 0 and picked[-1] == len(x) - 1
+    assert np.all(np.diff(picked) > 0)
+
+def test_lttb_keeps_a_spike():
+    x = np.arange(500, dtype=np.float64)
+    y = np.zeros(500)
+    y[237] = 50.0
+    assert 237 in lttb_indices(x, y, 20)
+
+def test_lttb_returns_everything_under_the_threshold():
+    x, y = wave(50)
+    assert np.array_equal(lttb_indices(x, y, 50), np.arange(50))
+    assert np.array_equal(lttb_indices(x, y, 2), np.arange(50))
+
+# Min/max
+
+def test_minmax_keeps_the_extremes_within_the_threshold():
+    rng = np.random.default_rng(7)
+    x = rng.uniform(0, 100, 2000)
+    y = rng.normal(size=2000)
+    picked = minmax_indices(x, y, 200)
+    assert len(picked) <= 200
+    assert np.argmin(y) in picked and np.argmax(y) in picked
+
+def test_minmax_ignores_missing_values_for_the_minimum():
+    x = np.arange(100, dtype=np.float64)
+    y = np.arange(100, dtype=np.float64)
+    y[10] = np.nan
+    picked = minmax_indices(x, y, 2)
+    assert set(picked) == {0, 99}
+
+# Frames
+
+def test_reduce_points_leaves_small_frames_alone():
+    df = pd.DataFrame({'x': range(10), 'y': range(10)})
+    assert reduce_points(df, 'x', 'y', 'line', budget=10) is df
+
+def test_reduce_points_line_respects_budget_and_order():
+    x, y = wave()
+    df = pd.DataFrame({'x': x, 'y': y}).sample(frac=1, random_state=1)
+    reduced = reduce_points(df, 'x', 'y', 'line', budget=100)
+    assert len(reduced) == 100
+    assert reduced['x'].min() == 0 and reduced['x'].max() == len(x) - 1
+
+def test_reduce_points_handles_datetime_axes():
+    df = pd.DataFrame({'when': pd.date_range('2024-01-01', periods=1000, freq='h'), 'y': wave()[1]})
+    reduced = reduce_points(df, 'when', 'y', 'line', budget=50)
+    assert len(reduced) == 50
+    assert reduced['when'].iloc[0] == df['when'].iloc[0]
+    assert reduced['when'].iloc[-1] == df['when'].iloc[-1]
+
+def test_reduce_points_strides_over_non_numeric_axes():
+    df = pd.DataFrame({'label': [f'item {i}' for i in range(1000)], 'y': range(1000)})
+    reduced = reduce_points(df, 'label', 'y', 'scatter', budget=100)
+    assert len(reduced) == 100
+    assert reduced.index[0] == 0
@@ -0,0 +1,86 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from models.history_store import HistoryStore, MemoryHistoryBackend, SQLiteHistoryBackend
+
+NAMESPACE = 'shop.orders'
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(request, tmp_path):
+    backend = SQLiteHistoryBackend(str(tmp_path / 'history.sqlite3')) if request.param == 'sqlite' \
+        else MemoryHistoryBackend()
+    return HistoryStore(backend, max_entries=100)
+
+def record(store, query, namespace=NAMESPACE, df=None):
+    return store.record(namespace, query, {'chart_type': 'bar'}, [{'$match': {}}], df, timings={'query': 0.1})
+
+def queries(entries):
+    return [entry['query'] for entry in entries]
+
+# Search
+
+def test_search_matches_word_prefixes(store):
+    record(store, 'Total revenue by region')
+    record(store, 'Orders per month')
+    assert queries(store.search('reven reg', NAMESPACE)) == ['Total revenue by region']
+    assert queries(store.search('month', NAMESPACE)) == ['Orders per month']
+    assert store.search('revenue month', NAMESPACE) == []
+
+def test_search_is_scoped_to_the_namespace(store):
+    record(store, 'Total revenue by region')
+    record(store, 'Total revenue by region', namespace='shop.returns')
+    assert [entry['namespace'] for entry in store.search('revenue', NAMESPACE)] == [NAMESPACE]
+    assert len(store.search('revenue', None)) == 2
+
+def test_search_quotes_fts_syntax(store):
+    record(store, 'revenue OR "refunds"')
+    assert store.search('"refunds" NEAR(', NAMESPACE) == []
+    assert queries(store.search('refunds', NAMESPACE)) == ['revenue OR "refunds"']
+
+# Upserts and deletes
+
+def test_reasking_replaces_the_entry_and_counts_runs(store):
+    first = record(store, 'Total revenue by region')
+    second = record(store, '  total REVENUE by region ')
+    assert first == second
+    entries = store.search('revenue', NAMESPACE)
+    assert len(entries) == 1
+    assert entries[0]['runs'] == 2
+    assert entries[0]['query'] == '  total REVENUE by region '
+
+def test_deleted_entries_leave_the_search_index(store):
+    kept = record(store, 'Total revenue by region')
+    dropped = record(store, 'Total revenue by month')
+    store.delete(dropped)
+    assert [entry['id'] for entry in store.search('revenue', NAMESPACE)] == [kept]
+    # The freed question can be recorded and found again
+    record(store, 'Total revenue by month')
+    assert len(store.search('revenue', NAMESPACE)) == 2
+
+def test_replay_returns_the_snapshot_and_counts_the_replay(store):
+    df = pd.DataFrame({'region': ['east', 'west'], 'total': [10.0, 20.5]})
+    entry_id = record(store, 'Total revenue by region', df=df)
+    entry, snapshot = store.replay(entry_id)
+    pd.testing.assert_frame_equal(snapshot, df)
+    assert entry['rows'] == 2
+    assert store.list(NAMESPACE)[0]['replays'] == 1
+
+# SQLite full-text index
+
+def test_existing_history_is_indexed_when_full_text_is_added(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    backend = SQLiteHistoryBackend(path)
+    if not backend.full_text:
+        pytest.skip('SQLite is built without FTS5')
+    record(HistoryStore(backend), 'Total revenue by region')
+    # Simulate a file written before the index existed
+    conn = sqlite3.connect(path)
+    conn.executescript("""DROP TRIGGER history_fts_insert;
+                          DROP TRIGGER history_fts_delete;
+                          DROP TABLE history_fts;""")
+    conn.close()
+
+    reopened = HistoryStore(SQLiteHistoryBackend(path))
+    assert queries(reopened.search('revenue', NAMESPACE)) == ['Total revenue by region']
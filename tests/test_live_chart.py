@@ -0,0 +1,111 @@
+import mongomock
+import pandas as pd
+import pytest
+from bson import ObjectId
+
+from models.live_chart import LiveChart, _simple_tail, apply_tail
+from models.query_parser import MongoQueryIntent
+from models.request_pipeline import RequestPipeline
+from utils.mongo_connection import MongoDBConnection
+
+SCHEMA = {'_id': 'objectId', 'region': 'string', 'amount': 'float'}
+PIPELINE = [
+    {'$group': {'_id': '$region', 'total': {'$sum': '$amount'}, 'mean': {'$avg': '$amount'},
+                'low': {'$min': '$amount'}, 'high': {'$max': '$amount'}, 'orders': {'$sum': 1}}},
+    {'$sort': {'total': -1}},
+]
+
+def oid(seconds_ago, n):
+    """A distinct ObjectId created `seconds_ago` seconds before now"""
+    stamp = ObjectId.from_datetime(pd.Timestamp.now(tz='UTC') - pd.Timedelta(seconds=seconds_ago))
+    return ObjectId(stamp.binary[:4] + n.to_bytes(8, 'big'))
+
+def order(region, amount, seconds_ago=600, n=0):
+    return {'_id': oid(seconds_ago, n), 'region': region, 'amount': amount}
+
+@pytest.fixture
+def connection():
+    connection = MongoDBConnection()
+    connection.client = mongomock.MongoClient()
+    connection.db = connection.client.shop
+    return connection
+
+def live_chart(connection, pipeline=PIPELINE, **options):
+    intent = MongoQueryIntent(collection='orders', operation_type='aggregate', aggregation_pipeline=pipeline,
+                              chart_type='bar', x_axis='_id', y_axis='total', title='Revenue by region')
+    options.setdefault('full_refresh_every', 0)
+    chart = LiveChart(RequestPipeline(connection=connection), 'orders', intent, SCHEMA, **options)
+    chart.start()
+    return chart
+
+def rows(df):
+    return {row['_id']: {k: v for k, v in row.items() if k != '_id'} for row in df.to_dict('records')}
+
+# Tail stages
+
+def test_apply_tail_sorts_skips_limits_and_projects():
+    df = pd.DataFrame({'_id': ['a', 'b', 'c', 'd'], 'total': [3, 9, 1, 5]})
+    tail = [{'$sort': {'total': -1}}, {'$skip': 1}, {'$limit': 2}, {'$project': {'_id': 0, 'revenue': '$total'}}]
+    assert apply_tail(df, tail).to_dict('list') == {'revenue': [5, 3]}
+
+def test_only_simple_tails_are_applied_locally():
+    assert _simple_tail([{'$sort': {'total': -1}}, {'$limit': 5}, {'$project': {'total': 1, 'name': '$_id'}}])
+    assert not _simple_tail([{'$project': {'share': {'$divide': ['$total', 100]}}}])
+    assert not _simple_tail([{'$project': {'name': '$_id.region'}}])
+    assert not _simple_tail([{'$lookup': {'from': 'regions', 'localField': '_id',
+                                          'foreignField': 'code', 'as': 'region'}}])
+
+# Merging partials
+
+def test_merged_partials_finalize_like_the_group(connection):
+    connection.db.orders.insert_many([order('east', 10, n=1), order('west', 2, n=2)])
+    chart = live_chart(connection)
+    chart._merge([
+        {'_id': 'east', 'total': 5, 'mean__sum': 5, 'mean__n': 1, 'low': 5, 'high': 5, 'orders': 1},
+        {'_id': 'west', 'total': 30, 'mean__sum': 30, 'mean__n': 2, 'low': None, 'high': 20, 'orders': 2},
+        {'_id': 'north', 'total': 1, 'mean__sum': 1, 'mean__n': 1, 'low': 1, 'high': 1, 'orders': 1},
+    ])
+    df = chart._final_frame()
+    assert list(df['_id']) == ['west', 'east', 'north']
+    assert rows(df) == {
+        'west': {'total': 32, 'mean': 32 / 3, 'low': 2, 'high': 20, 'orders': 3},
+        'east': {'total': 15, 'mean': 7.5, 'low': 5, 'high': 10, 'orders': 2},
+        'north': {'total': 1, 'mean': 1.0, 'low': 1, 'high': 1, 'orders': 1},
+    }
+
+# Refreshing
+
+def test_refresh_matches_a_full_recompute(connection):
+    connection.db.orders.insert_many([order(region, amount, n=n) for n, (region, amount)
+                                      in enumerate([('east', 10), ('west', 4), ('east', 6)])])
+    chart = live_chart(connection)
+    assert chart.mode == 'polling'
+    connection.db.orders.insert_many([order('west', 8, seconds_ago=300, n=10),
+                                      order('north', 3, seconds_ago=300, n=11)])
+    result = chart.refresh()
+    assert result['new_documents'] == 2 and not result['full']
+    expected = pd.DataFrame(list(connection.db.orders.aggregate(PIPELINE)))
+    assert rows(chart.df) == rows(expected)
+    assert list(chart.df['_id']) == list(expected['_id'])
+
+def test_late_writes_behind_the_newest_document_are_counted(connection):
+    connection.db.orders.insert_many([order('east', 1, n=n) for n in range(3)])
+    chart = live_chart(connection, safety_lag=5)
+    # Newer than the safety lag, so it waits for a later refresh
+    connection.db.orders.insert_one(order('east', 1, seconds_ago=1, n=10))
+    assert chart.refresh()['new_documents'] == 0
+    assert chart._inserted.is_set()
+    # Another client's write with an older id commits after it
+    connection.db.orders.insert_one(order('east', 1, seconds_ago=3, n=11))
+    chart.safety_lag = 0
+    assert chart.refresh()['new_documents'] == 2
+    assert rows(chart.df)['east']['orders'] == 5
+
+def test_pipelines_that_cant_be_merged_are_recomputed(connection):
+    connection.db.orders.insert_many([order('east', 1, n=1)])
+    pipeline = [{'$group': {'_id': '$region', 'amounts': {'$push': '$amount'}}}]
+    chart = live_chart(connection, pipeline=pipeline)
+    assert chart.mode == 'full recompute'
+    connection.db.orders.insert_one(order('east', 2, n=2))
+    assert chart.refresh()['full']
+    assert sorted(chart.df['amounts'][0]) == [1, 2]
@@ -0,0 +1,164 @@
+import re
+from types import SimpleNamespace
+
+from models.pipeline_optimizer import optimize_pipeline
+
+SCHEMA = {'status': 'string', 'region': 'string', 'amount': 'float', 'qty': 'integer', 'tags': 'array'}
+
+def optimized(pipeline, schema=SCHEMA, intent=None):
+    return optimize_pipeline(pipeline, schema, intent)[0]
+
+# Predicate rewrites
+
+def test_expr_equality_becomes_query_predicate():
+    assert optimized([{'$match': {'$expr': {'$eq': ['$status', 'open']}}}]) == [{'$match': {'status': 'open'}}]
+
+def test_expr_range_needs_matching_type():
+    assert optimized([{'$match': {'$expr': {'$gt': ['$amount', 10]}}}]) == [{'$match': {'amount': {'$gt': 10}}}]
+    pipeline = [{'$match': {'$expr': {'$gt': ['$amount', '10']}}}]
+    assert optimized(pipeline) == pipeline
+
+def test_expr_on_array_field_is_kept():
+    pipeline = [{'$match': {'$expr': {'$eq': ['$tags', 'a']}}}]
+    assert optimized(pipeline) == pipeline
+
+def test_or_of_equalities_becomes_in():
+    pipeline = [{'$match': {'$or': [{'status': 'open'}, {'status': 'closed'}]}}]
+    assert optimized(pipeline) == [{'$match': {'status': {'$in': ['open', 'closed']}}}]
+
+def test_single_value_in_becomes_equality():
+    assert optimized([{'$match': {'status': {'$in': ['open']}}}]) == [{'$match': {'status': 'open'}}]
+
+# Moving $match earlier
+
+def test_match_moves_before_sort():
+    pipeline = [{'$sort': {'amount': -1}}, {'$match': {'status': 'open'}}]
+    assert optimized(pipeline) == [{'$match': {'status': 'open'}}, {'$sort': {'amount': -1}}]
+
+def test_match_on_group_key_moves_before_group():
+    group = {'$group': {'_id': '$region', 'total': {'$sum': '$amount'}}}
+    pipeline = [group, {'$match': {'_id': {'$gte': 'M'}, 'total': {'$gt': 5}}}]
+    assert optimized(pipeline) == [{'$match': {'region': {'$gte': 'M'}}}, group, {'$match': {'total': {'$gt': 5}}}]
+
+def test_match_on_compound_group_key_moves_before_group():
+    group = {'$group': {'_id': {'r': '$region', 's': '$status'}, 'n': {'$sum': 1}}}
+    pipeline = [group, {'$match': {'_id.r': 'EU'}}]
+    assert optimized(pipeline) == [{'$match': {'region': 'EU'}}, group]
+
+def test_existence_type_and_null_checks_stay_after_group():
+    group = {'$group': {'_id': '$region', 'n': {'$sum': 1}}}
+    for predicate in ({'_id': None}, {'_id': {'$exists': True}}, {'_id': {'$type': 'string'}},
+                      {'_id': {'$ne': None}}, {'_id': {'$eq': None}}, {'_id': {'$in': ['EU', None]}},
+                      {'_id': re.compile('^E')}):
+        pipeline = [group, {'$match': predicate}]
+        assert optimized(pipeline) == pipeline, predicate
+
+def test_match_on_array_group_key_stays_after_group():
+    group = {'$group': {'_id': '$tags', 'n': {'$sum': 1}}}
+    pipeline = [group, {'$match': {'_id': 'a'}}]
+    assert optimized(pipeline) == pipeline
+
+def test_match_moves_before_unrelated_add_fields():
+    add = {'$addFields': {'double': {'$multiply': ['$amount', 2]}}}
+    pipeline = [add, {'$match': {'status': 'open', 'double': {'$gt': 4}}}]
+    assert optimized(pipeline) == [{'$match': {'status': 'open'}}, add, {'$match': {'double': {'$gt': 4}}}]
+
+def test_match_reading_root_stays_after_add_fields():
+    add = {'$addFields': {'double': {'$multiply': ['$amount', 2]}}}
+    for variable in ('$$ROOT', '$$CURRENT', '$$ROOT.double'):
+        pipeline = [add, {'$match': {'$expr': {'$gt': [{'$size': {'$objectToArray': variable}}, 3]}}}]
+        assert optimized(pipeline) == pipeline, variable
+
+def test_match_moves_before_project_that_keeps_its_field():
+    project = {'$project': {'status': 1, 'amount': 1}}
+    pipeline = [project, {'$match': {'status': 'open'}}]
+    assert optimized(pipeline) == [{'$match': {'status': 'open'}}, project]
+
+def test_match_on_computed_field_stays_after_project():
+    project = {'$project': {'status': {'$toUpper': '$status'}}}
+    pipeline = [project, {'$match': {'status': 'OPEN'}}]
+    assert optimized(pipeline) == pipeline
+
+def test_match_moves_before_unwind_of_other_path():
+    unwind = {'$unwind': '$tags'}
+    pipeline = [unwind, {'$match': {'status': 'open', 'tags': 'a'}}]
+    assert optimized(pipeline) == [{'$match': {'status': 'open'}}, unwind, {'$match': {'tags': 'a'}}]
+
+def test_match_stays_after_limit():
+    pipeline = [{'$limit': 10}, {'$match': {'status': 'open'}}]
+    assert optimized(pipeline) == pipeline
+
+# Coalescing
+
+def test_adjacent_matches_are_combined():
+    pipeline = [{'$match': {'status': 'open'}}, {'$match': {'region': 'EU'}}]
+    assert optimized(pipeline) == [{'$match': {'status': 'open', 'region': 'EU'}}]
+
+def test_adjacent_matches_on_same_field_use_and():
+    pipeline = [{'$match': {'qty': {'$gt': 1}}}, {'$match': {'qty': {'$lt': 5}}}]
+    assert optimized(pipeline) == [{'$match': {'$and': [{'qty': {'$gt': 1}}, {'qty': {'$lt': 5}}]}}]
+
+def test_adjacent_limits_skips_and_sorts_are_combined():
+    assert optimized([{'$limit': 10}, {'$limit': 3}]) == [{'$limit': 3}]
+    assert optimized([{'$skip': 2}, {'$skip': 3}]) == [{'$skip': 5}]
+    assert optimized([{'$sort': {'qty': 1}}, {'$sort': {'amount': -1}}]) == [{'$sort': {'amount': -1}}]
+
+def test_repeated_unwind_is_removed():
+    assert optimized([{'$unwind': '$tags'}, {'$unwind': '$tags'}]) == [{'$unwind': '$tags'}]
+
+def test_independent_add_fields_are_combined():
+    pipeline = [{'$addFields': {'a': 1}}, {'$addFields': {'b': '$amount'}}]
+    assert optimized(pipeline) == [{'$addFields': {'a': 1, 'b': '$amount'}}]
+
+def test_dependent_add_fields_are_kept_apart():
+    pipeline = [{'$addFields': {'a': 1}}, {'$addFields': {'b': '$a'}}]
+    assert optimized(pipeline) == pipeline
+
+def test_add_fields_reading_root_are_kept_apart():
+    pipeline = [{'$addFields': {'a': 1}}, {'$addFields': {'doc': '$$ROOT'}}]
+    assert optimized(pipeline) == pipeline
+
+def test_project_subset_is_combined():
+    pipeline = [{'$project': {'status': 1, 'amount': 1}}, {'$project': {'status': 1}}]
+    assert optimized(pipeline) == [{'$project': {'status': 1}}]
+
+def test_project_subset_excluding_id_is_combined():
+    pipeline = [{'$project': {'_id': 0, 'status': 1, 'amount': 1}}, {'$project': {'_id': 0, 'amount': 1}}]
+    assert optimized(pipeline) == [{'$project': {'_id': 0, 'amount': 1}}]
+
+def test_projects_treating_id_differently_are_kept():
+    pipeline = [{'$project': {'_id': 0, 'status': 1}}, {'$project': {'status': 1}}]
+    assert optimized(pipeline) == pipeline
+    pipeline = [{'$project': {'status': 1}}, {'$project': {'_id': 0, 'status': 1}}]
+    assert optimized(pipeline) == pipeline
+
+def test_projects_with_different_paths_are_kept():
+    pipeline = [{'$project': {'status': 1}}, {'$project': {'status': 1, 'amount': 1}}]
+    assert optimized(pipeline) == pipeline
+    pipeline = [{'$project': {'item': 1}}, {'$project': {'item.name': 1}}]
+    assert optimized(pipeline) == pipeline
+
+# Dropping and adding stages
+
+def test_sort_before_count_is_dropped():
+    assert optimized([{'$sort': {'qty': 1}}, {'$count': 'n'}]) == [{'$count': 'n'}]
+
+def test_sort_before_order_insensitive_group_is_dropped():
+    group = {'$group': {'_id': '$region', 'total': {'$sum': '$amount'}}}
+    assert optimized([{'$sort': {'qty': 1}}, group]) == [group]
+
+def test_sort_before_order_sensitive_group_is_kept():
+    for operator in ('$first', '$last', '$push', '$mergeObjects'):
+        pipeline = [{'$sort': {'qty': 1}}, {'$group': {'_id': '$region', 'value': {operator: '$amount'}}}]
+        assert optimized(pipeline) == pipeline, operator
+
+def test_top_n_chart_gets_a_limit():
+    intent = SimpleNamespace(title="Top 5 regions by revenue")
+    pipeline = [{'$group': {'_id': '$region', 'total': {'$sum': '$amount'}}}, {'$sort': {'total': -1}}]
+    assert optimized(pipeline, intent=intent) == pipeline + [{'$limit': 5}]
+    assert optimized(pipeline, intent=SimpleNamespace(title="Revenue by region")) == pipeline
+
+def test_every_rewrite_is_noted():
+    _, notes = optimize_pipeline([{'$sort': {'qty': 1}}, {'$match': {'status': {'$in': ['open']}}}], SCHEMA)
+    assert any("$in" in note for note in notes)
+    assert any("before $sort" in note for note in notes)
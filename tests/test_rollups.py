@@ -0,0 +1,107 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+from utils.rollups import (combine_partials, finalize_partials, partial_group, rollup_key, safe_high_water,
+                           split_rollup_pipeline)
+
+GROUP = {'_id': '$region', 'total': {'$sum': '$amount'}, 'mean': {'$avg': '$amount'},
+         'low': {'$min': '$amount'}, 'high': {'$max': '$amount'}, 'orders': {'$count': {}}}
+# The same group for mongomock, which has no $count accumulator
+REFERENCE = {**GROUP, 'orders': {'$sum': 1}}
+
+ORDERS = [
+    {'region': 'east', 'amount': 10}, {'region': 'east', 'amount': 4},
+    {'region': 'west', 'amount': 7}, {'region': 'east', 'amount': 16},
+    {'region': 'west', 'amount': 1}, {'region': 'east', 'amount': 30},
+    {'region': 'north', 'amount': None},
+]
+
+def aggregate(docs, pipeline):
+    collection = mongomock.MongoClient().db.orders
+    collection.insert_many([dict(doc) for doc in docs])
+    return {doc['_id']: doc for doc in collection.aggregate(pipeline)}
+
+def combine(rollup, new):
+    """Apply combine_partials as $merge would, with $$new bound to the new partials"""
+    spec = json.loads(json.dumps(combine_partials(GROUP)).replace('$$new.', '$new.'))
+    matched = [{**rollup[key], 'new': new[key]} for key in rollup.keys() & new.keys()]
+    merged = aggregate(matched, [{'$project': {**spec, '_id': 1}}]) if matched else {}
+    # Unmatched partials are inserted as they are
+    return {**rollup, **new, **merged}
+
+# Splitting pipelines
+
+def test_split_keeps_matches_and_group_as_the_head():
+    pipeline = [{'$match': {'status': 'open'}}, {'$group': GROUP}, {'$sort': {'total': -1}}, {'$limit': 5}]
+    head, tail = split_rollup_pipeline(pipeline)
+    assert head == pipeline[:2]
+    assert tail == pipeline[2:]
+
+@pytest.mark.parametrize('pipeline', [
+    [{'$group': {'_id': '$region', 'names': {'$push': '$name'}}}],
+    [{'$group': {'_id': '$region', 'first': {'$first': '$amount'}}}],
+    [{'$sort': {'amount': 1}}, {'$group': GROUP}],
+    [{'$match': {'$expr': {'$lt': ['$created', '$$NOW']}}}, {'$group': GROUP}],
+    [{'$sample': {'size': 10}}, {'$group': GROUP}],
+    [{'$match': {'status': 'open'}}],
+])
+def test_split_rejects_pipelines_that_cant_be_rolled_up(pipeline):
+    assert split_rollup_pipeline(pipeline) is None
+
+def test_rollup_key_depends_on_the_cluster_namespace():
+    head = [{'$group': GROUP}]
+    assert rollup_key('a1b2/shop.orders', head) != rollup_key('c3d4/shop.orders', head)
+    assert rollup_key('a1b2/shop.orders', head) == rollup_key('a1b2/shop.orders', [{'$group': dict(GROUP)}])
+
+# Partials
+
+def test_finalized_partials_match_the_original_group():
+    expected = aggregate(ORDERS, [{'$group': REFERENCE}])
+    partials = aggregate(ORDERS, [{'$group': partial_group(GROUP)}])
+    assert aggregate(partials.values(), [{'$project': finalize_partials(GROUP)}]) == expected
+
+def test_combined_partials_match_the_original_group():
+    expected = aggregate(ORDERS, [{'$group': REFERENCE}])
+    rollup = aggregate(ORDERS[:3], [{'$group': partial_group(GROUP)}])
+    for batch in (ORDERS[3:5], ORDERS[5:]):
+        rollup = combine(rollup, aggregate(batch, [{'$group': partial_group(GROUP)}]))
+    assert aggregate(rollup.values(), [{'$project': finalize_partials(GROUP)}]) == expected
+
+def test_average_counts_only_numbers():
+    group = {'_id': '$region', 'mean': {'$avg': '$amount'}}
+    docs = ORDERS + [{'region': 'east', 'amount': 'n/a'}]
+    partials = aggregate(docs, [{'$group': partial_group(group)}])
+    assert set(partials['east']) == {'_id', 'mean__sum', 'mean__n'}
+    assert partials['east']['mean__n'] == 4
+    finalized = aggregate(partials.values(), [{'$project': finalize_partials(group)}])
+    assert finalized['east']['mean'] == 15
+    assert finalized['north']['mean'] is None
+
+# High-water marks
+
+NOW = datetime(2026, 3, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+def test_recent_object_ids_are_held_back():
+    recent = ObjectId.from_datetime(NOW - timedelta(seconds=1))
+    capped = safe_high_water(recent, 5, now=NOW.timestamp())
+    assert capped < recent
+    assert capped.generation_time == NOW - timedelta(seconds=5)
+
+def test_old_marks_are_kept():
+    old = ObjectId.from_datetime(NOW - timedelta(minutes=5))
+    assert safe_high_water(old, 5, now=NOW.timestamp()) == old
+    assert safe_high_water(NOW - timedelta(minutes=5), 5, now=NOW.timestamp()) == NOW - timedelta(minutes=5)
+
+def test_datetimes_are_capped_in_their_own_timezone_style():
+    naive = (NOW - timedelta(seconds=1)).replace(tzinfo=None)
+    assert safe_high_water(naive, 5, now=NOW.timestamp()) == (NOW - timedelta(seconds=5)).replace(tzinfo=None)
+    assert safe_high_water(NOW, 5, now=NOW.timestamp()) == NOW - timedelta(seconds=5)
+
+def test_marks_without_a_clock_are_unchanged():
+    assert safe_high_water(42, 5, now=NOW.timestamp()) == 42
+    recent = ObjectId.from_datetime(NOW)
+    assert safe_high_water(recent, 0, now=NOW.timestamp()) == recent
@@ -0,0 +1,191 @@
+import os
+import time
+import hashlib
+import threading
+from typing import Dict, List, Tuple, Any
+
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool counters collected from pymongo's CMAP events"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = threading.local()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checked_out = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.connections_created = 0
+        self.connections_closed = 0
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def connection_check_out_started(self, event):
+        self._pending.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        started = getattr(self._pending, "started", None)
+        wait_ms = (time.perf_counter() - started) * 1000 if started is not None else 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checked_out": self.checked_out,
+                "avg_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait_ms,
+                "open_connections": self.connections_created - self.connections_closed,
+            }
+
+class _RegistryEntry:
+    def __init__(self, client: MongoClient, metrics: PoolMetrics):
+        self.client = client
+        self.metrics = metrics
+        self.refcount = 0
+        self.last_released = time.time()
+
+def _redact(uri: str) -> str:
+    """Hide credentials when showing a URI"""
+    if "@" in uri and "://" in uri:
+        scheme, rest = uri.split("://", 1)
+        return f"{scheme}://***@{rest.split('@', 1)[1]}"
+    return uri
+
+def cluster_id(uri: str) -> str:
+    """Short identity of the deployment (and credentials) a URI connects to, for keys shared across sessions.
+
+    It is a hash of the whole URI, so credentials never show up in keys and
+    connections with different users don't share cached results.
+    """
+    return hashlib.sha256(uri.encode("utf-8")).hexdigest()[:12]
+
+class ClientRegistry:
+    """Shared, reference-counted MongoClients keyed on (URI, database).
+
+    Every session that connects to the same URI and database reuses one client
+    (and therefore one connection pool). Clients nobody holds any more are
+    closed once they've been idle for `max_idle_seconds`. There is no timer:
+    idle clients are only closed on the next acquire/release (or an explicit
+    `evict_idle()`), so the last client released stays open until then.
+    """
+
+    def __init__(self, max_pool_size: int = 50, min_pool_size: int = 0, max_idle_time_ms: int = 60000,
+                 max_idle_seconds: float = 300, read_preference: str = "secondaryPreferred"):
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.max_idle_time_ms = max_idle_time_ms
+        self.max_idle_seconds = max_idle_seconds
+        self.read_preference = read_preference
+        self._entries: Dict[Tuple[str, str], _RegistryEntry] = {}
+        self._lock = threading.Lock()
+
+    def analytics_read_preference(self):
+        """Read preference used for analytics reads (defaults to secondaries when available)"""
+        return make_read_preference(read_pref_mode_from_name(self.read_preference), None)
+
+    def acquire(self, uri: str, db_name: str) -> MongoClient:
+        """Get (or create) the shared client for a URI/database and take a reference to it"""
+        key = (uri, db_name)
+        with self._lock:
+            self._evict_idle_locked()
+            entry = self._entries.get(key)
+            if entry is None:
+                metrics = PoolMetrics()
+                client = MongoClient(
+                    uri,
+                    maxPoolSize=self.max_pool_size,
+                    minPoolSize=self.min_pool_size,
+                    maxIdleTimeMS=self.max_idle_time_ms,
+                    event_listeners=[metrics],
+                    appname="MongoChart"
+                )
+                entry = self._entries[key] = _RegistryEntry(client, metrics)
+            entry.refcount += 1
+            return entry.client
+
+    def release(self, uri: str, db_name: str):
+        """Drop a reference taken with acquire"""
+        with self._lock:
+            entry = self._entries.get((uri, db_name))
+            if entry is None:
+                return
+            entry.refcount = max(entry.refcount - 1, 0)
+            if entry.refcount == 0:
+                entry.last_released = time.time()
+            self._evict_idle_locked()
+
+    def discard(self, uri: str, db_name: str):
+        """Drop a reference and close the client right away if nobody else holds it
+        (e.g. after a failed connection attempt)"""
+        with self._lock:
+            entry = self._entries.get((uri, db_name))
+            if entry is None:
+                return
+            entry.refcount = max(entry.refcount - 1, 0)
+            if entry.refcount > 0:
+                return
+            del self._entries[(uri, db_name)]
+        entry.client.close()
+
+    def evict_idle(self):
+        """Close clients that have had no references for longer than max_idle_seconds"""
+        with self._lock:
+            self._evict_idle_locked()
+
+    def _evict_idle_locked(self):
+        now = time.time()
+        for key, entry in list(self._entries.items()):
+            if entry.refcount == 0 and now - entry.last_released > self.max_idle_seconds:
+                del self._entries[key]
+                entry.client.close()
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        """Per-client reference counts and pool metrics"""
+        with self._lock:
+            entries = list(self._entries.items())
+        return [
+            {"uri": _redact(uri), "db": db_name, "refcount": entry.refcount, **entry.metrics.snapshot()}
+            for (uri, db_name), entry in entries
+        ]
+
+# Create singleton instance
+client_registry = ClientRegistry(
+    max_pool_size=int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+    min_pool_size=int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    max_idle_time_ms=int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000")),
+    max_idle_seconds=float(os.getenv("MONGO_CLIENT_IDLE_SECONDS", "300")),
+    read_preference=os.getenv("MONGO_ANALYTICS_READ_PREFERENCE", "secondaryPreferred")
+)
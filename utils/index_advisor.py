@@ -0,0 +1,160 @@
+import threading
+from typing import Dict, List, Optional, Any, Tuple
+
+# Range operators go last in an Equality-Sort-Range compound index
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$regex', '$exists', '$not'}
+EQUALITY_OPERATORS = {'$eq', '$in'}
+
+IndexKey = Tuple[Tuple[str, int], ...]
+
+def _walk_plan(node: Any, summary: Dict[str, Any]):
+    """Collect plan stages and execution counters from any explain() layout
+    (classic or SBE plans, pushed-down or $cursor pipelines, sharded or not)"""
+    if isinstance(node, dict):
+        stage = node.get("stage")
+        if isinstance(stage, str):
+            summary["plan_stages"].add(stage)
+            if stage == "IXSCAN" and node.get("indexName"):
+                summary["indexes_used"].add(node["indexName"])
+        for key in ("totalDocsExamined", "totalKeysExamined", "nReturned", "executionTimeMillis"):
+            # Only the top-level executionStats counters, not every plan node's
+            if key in node and "executionStages" in node:
+                summary[key] += node[key] or 0
+        for key, value in node.items():
+            # Skip alternative plans and the echoed command
+            if key in ("rejectedPlans", "command", "originalCommand", "parsedQuery"):
+                continue
+            _walk_plan(value, summary)
+    elif isinstance(node, list):
+        for value in node:
+            _walk_plan(value, summary)
+
+def summarize_explain(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """Docs examined vs returned, collection scans, in-memory sorts and indexes used"""
+    summary: Dict[str, Any] = {
+        "plan_stages": set(), "indexes_used": set(),
+        "totalDocsExamined": 0, "totalKeysExamined": 0, "nReturned": 0, "executionTimeMillis": 0,
+    }
+    _walk_plan(explain, summary)
+    stages = summary["plan_stages"]
+    has_stats = any(summary[k] for k in ("totalDocsExamined", "totalKeysExamined", "nReturned"))
+    return {
+        "collscan": "COLLSCAN" in stages,
+        # A blocking SORT in the query plan; sorts after $group are unavoidable and not counted
+        "in_memory_sort": "SORT" in stages,
+        "indexes_used": sorted(summary["indexes_used"]),
+        "docs_examined": summary["totalDocsExamined"] if has_stats else None,
+        "keys_examined": summary["totalKeysExamined"] if has_stats else None,
+        "returned": summary["nReturned"] if has_stats else None,
+        "execution_ms": summary["executionTimeMillis"] if has_stats else None,
+    }
+
+def _leading_stages(pipeline: List[Dict[str, Any]]):
+    """The $match predicates and the $sort at the front of a pipeline, which the query planner can index"""
+    predicates, sort = [], None
+    for stage in pipeline:
+        if "$match" in stage and sort is None:
+            predicates.append(stage["$match"])
+        elif "$sort" in stage and sort is None:
+            sort = stage["$sort"]
+        else:
+            break
+    return predicates, sort
+
+def _classify_predicate(predicate: Dict[str, Any], equality: List[str], ranges: List[str]):
+    for key, value in predicate.items():
+        if key == "$and" and isinstance(value, list):
+            for clause in value:
+                if isinstance(clause, dict):
+                    _classify_predicate(clause, equality, ranges)
+        elif key.startswith("$"):
+            # $or/$expr/$text need their own indexes; leave them out of the compound key
+            continue
+        elif isinstance(value, dict) and any(op.startswith("$") for op in value):
+            if set(value) <= EQUALITY_OPERATORS:
+                equality.append(key)
+            elif set(value) & RANGE_OPERATORS or set(value) & EQUALITY_OPERATORS:
+                ranges.append(key)
+        else:
+            equality.append(key)
+
+def suggest_index(pipeline: List[Dict[str, Any]]) -> Optional[IndexKey]:
+    """Compound index for the pipeline's leading $match/$sort, ordered Equality, Sort, Range"""
+    predicates, sort = _leading_stages(pipeline)
+    equality: List[str] = []
+    ranges: List[str] = []
+    for predicate in predicates:
+        if isinstance(predicate, dict):
+            _classify_predicate(predicate, equality, ranges)
+
+    key: List[Tuple[str, int]] = []
+    seen = set()
+    for field in equality:
+        if field not in seen:
+            key.append((field, 1))
+            seen.add(field)
+    for field, direction in (sort or {}).items():
+        if field not in seen and direction in (1, -1):
+            key.append((field, direction))
+            seen.add(field)
+    for field in ranges:
+        if field not in seen:
+            key.append((field, 1))
+            seen.add(field)
+    return tuple(key) or None
+
+def index_covered(suggested: IndexKey, existing: List[IndexKey]) -> bool:
+    """Whether an existing index already starts with the suggested key pattern (or its reverse)"""
+    reverse = tuple((field, -direction) for field, direction in suggested)
+    for index in existing:
+        prefix = tuple(index[:len(suggested)])
+        if prefix == suggested or prefix == reverse:
+            return True
+    return False
+
+def format_index(key: IndexKey) -> str:
+    """createIndex() argument for a key pattern"""
+    return "{" + ", ".join(f'"{field}": {direction}' for field, direction in key) + "}"
+
+class IndexAdvisor:
+    """Aggregates explain() findings across queries to rank the indexes that would help most.
+
+    Each suggestion is weighted by the documents its queries examined (or the
+    number of collection scans when only queryPlanner output is available).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._advice: Dict[Tuple[str, IndexKey], Dict[str, Any]] = {}
+
+    def record(self, namespace: str, suggested: Optional[IndexKey], summary: Dict[str, Any]):
+        """Add one explained query to the running totals"""
+        if suggested is None or not (summary["collscan"] or summary["in_memory_sort"]):
+            return
+        with self._lock:
+            entry = self._advice.setdefault((namespace, suggested), {
+                "queries": 0, "collscans": 0, "in_memory_sorts": 0, "docs_examined": 0, "returned": 0,
+            })
+            entry["queries"] += 1
+            entry["collscans"] += int(summary["collscan"])
+            entry["in_memory_sorts"] += int(summary["in_memory_sort"])
+            entry["docs_examined"] += summary["docs_examined"] or 0
+            entry["returned"] += summary["returned"] or 0
+
+    def report(self, namespace_prefix: str = "", limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Suggested indexes, most valuable first"""
+        with self._lock:
+            items = [(key, dict(entry)) for key, entry in self._advice.items() if key[0].startswith(namespace_prefix)]
+        rows = [
+            {"collection": namespace.split(".", 1)[-1], "index": format_index(index), **entry}
+            for (namespace, index), entry in items
+        ]
+        rows.sort(key=lambda r: (r["docs_examined"], r["collscans"] + r["in_memory_sorts"], r["queries"]), reverse=True)
+        return rows[:limit] if limit else rows
+
+    def clear(self):
+        with self._lock:
+            self._advice.clear()
+
+# Create singleton instance
+index_advisor = IndexAdvisor()
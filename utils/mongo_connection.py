@@ -1,13 +1,34 @@
 import os
-from typing import Dict, List, Optional, Tuple
+import time
+import uuid
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple, Iterator, Any
 
+import bson
 import pymongo
-from pymongo import MongoClient
+from pymongo.errors import ExecutionTimeout
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
 from pymongo.database import Database
 from pymongo.collection import Collection
 import streamlit as st
 from dotenv import load_dotenv
 
+from .result_cache import result_cache
+from .client_registry import client_registry, cluster_id
+from .index_advisor import index_advisor, summarize_explain, suggest_index, index_covered, format_index
+from .query_guard import QueryGuard, QueryBudget, parse_collection_limits
+from .tracing import tracer
+from .rollups import rollup_manager
+
+try:
+    # Optional: decodes cursor batches straight into Arrow tables
+    from pymongoarrow.api import aggregate_arrow_all
+except ImportError:
+    aggregate_arrow_all = None
+
 # Load environment variables
 load_dotenv()
 
@@ -15,19 +36,67 @@ class MongoDBConnection:
     def __init__(self):
         self.client = None
         self.db = None
+        self._client_key = None
+        self._release = None
         self.collections = {}
         self.collection_schemas = {}
+        # Result cache invalidation: fingerprint check on every lookup, and
+        # optionally a change-stream watcher (replica sets only)
+        self.fingerprint_results = os.getenv("RESULT_CACHE_FINGERPRINT", "1") == "1"
+        self.watch_changes = os.getenv("RESULT_CACHE_CHANGE_STREAMS", "0") == "1"
+        # Streaming execution limits (0 disables a limit)
+        self.batch_size = int(os.getenv("QUERY_BATCH_SIZE", "1000"))
+        self.max_rows = int(os.getenv("QUERY_MAX_ROWS", "50000"))
+        self.max_bytes = int(os.getenv("QUERY_MAX_MB", "100")) * 1024 * 1024
+        self.allow_disk_use = os.getenv("QUERY_ALLOW_DISK_USE", "0") == "1"
+        self.max_time_ms = int(os.getenv("QUERY_MAX_TIME_MS", "60000"))
+        # Outcome of the calling thread's last streamed/columnar query; batch workers,
+        # dashboards and background refinements share this connection
+        self._query_state = threading.local()
+        self.columnar = os.getenv("QUERY_COLUMNAR", "1") == "1" and aggregate_arrow_all is not None
+        # "off", "queryPlanner" (plan only) or "executionStats" (runs the pipeline again to count documents)
+        self.explain_verbosity = os.getenv("INDEX_ADVISOR_VERBOSITY", "queryPlanner")
+        # Budgets (with per-collection overrides), pre-flight checks and the kill switch
+        self.query_guard = QueryGuard(
+            QueryBudget(
+                max_time_ms=self.max_time_ms,
+                max_rows=self.max_rows,
+                max_bytes=self.max_bytes,
+                max_docs_examined=int(os.getenv("QUERY_MAX_DOCS_EXAMINED", "5000000")),
+                preview_size=int(os.getenv("QUERY_PREVIEW_SAMPLE", "10000"))
+            ),
+            parse_collection_limits(os.getenv("QUERY_COLLECTION_LIMITS", "")),
+            violation_log=os.getenv("QUERY_VIOLATION_LOG", ".cache/query_violations.jsonl") or None
+        )
     
     def connect(self, connection_string: str, db_name: str) -> bool:
         """Connect to MongoDB using the provided connection string and database name"""
+        # Give back the previous client before switching, so its pool isn't leaked
+        self.disconnect()
         try:
-            self.client = MongoClient(connection_string)
-            self.db = self.client[db_name]
+            self.client = client_registry.acquire(connection_string, db_name)
+            self._client_key = (connection_string, db_name)
+            # Release the shared client when this connection object is garbage collected
+            # (e.g. when a Streamlit session ends without disconnecting)
+            self._release = weakref.finalize(self, client_registry.release, connection_string, db_name)
+            # Analytics reads go to secondaries when the deployment has them
+            self.db = self.client.get_database(
+                db_name, read_preference=client_registry.analytics_read_preference()
+            )
             # Test connection
             self.client.admin.command('ping')
+            # Rollups of frequently run $group pipelines (when ROLLUPS=1)
+            rollup_manager.attach(self.client, self.cluster, db_name)
             return True
         except Exception as e:
             st.error(f"Failed to connect to MongoDB: {str(e)}")
+            if self._release is not None:
+                self._release.detach()
+                self._release = None
+            client_registry.discard(connection_string, db_name)
+            self.client = None
+            self.db = None
+            self._client_key = None
             return False
     
     def get_collections(self) -> List[str]:
@@ -67,27 +136,428 @@ class MongoDBConnection:
             st.error(f"Failed to get sample from {collection_name}: {str(e)}")
             return []
     
-    def execute_query(self, collection_name: str, query: List[Dict]) -> List[Dict]:
+    def get_collection_state(self, collection_name: str) -> Optional[Tuple[int, Any]]:
+        """Estimated document count and the latest _id of a collection"""
+        collection = self.get_collection(collection_name)
+        if collection is None:
+            return None
+        
+        try:
+            count = collection.estimated_document_count()
+            latest = collection.find_one({}, projection={"_id": 1}, sort=[("_id", pymongo.DESCENDING)])
+            return count, (latest["_id"] if latest else None)
+        except Exception:
+            return None
+    
+    def namespace(self, collection_name: str) -> str:
+        """Database-qualified name ("db.collection")"""
+        return f"{self.db.name}.{collection_name}"
+    
+    @property
+    def cluster(self) -> str:
+        """Identity of the connected deployment (see client_registry.cluster_id)"""
+        return cluster_id(self._client_key[0]) if self._client_key else "default"
+    
+    def cluster_namespace(self, collection_name: str) -> str:
+        """Namespace qualified by the cluster ("<cluster>/db.collection"), so state shared across
+        sessions (the result cache, rollups, schema profiles) can't mix deployments or databases"""
+        return f"{self.cluster}/{self.namespace(collection_name)}"
+    
+    def get_collection_fingerprint(self, collection_name: str) -> Optional[str]:
+        """Cheap change detector: estimated document count plus the latest _id"""
+        state = self.get_collection_state(collection_name)
+        if state is None:
+            return None
+        return f"{state[0]}:{state[1]}"
+    
+    def get_field_range(self, collection_name: str, field: str) -> Optional[Tuple[Any, Any]]:
+        """Minimum and maximum value of a field (uses an index on the field when one exists)"""
+        collection = self.get_collection(collection_name)
+        if collection is None:
+            return None
+        
+        try:
+            query = {field: {"$ne": None}}
+            low = collection.find_one(query, projection={field: 1}, sort=[(field, pymongo.ASCENDING)])
+            high = collection.find_one(query, projection={field: 1}, sort=[(field, pymongo.DESCENDING)])
+            if not low or not high:
+                return None
+            return low.get(field), high.get(field)
+        except Exception:
+            return None
+    
+    @property
+    def last_query_truncated(self) -> bool:
+        """Whether a row/byte ceiling cut this thread's last streamed query short"""
+        return getattr(self._query_state, "truncated", False)
+    
+    @last_query_truncated.setter
+    def last_query_truncated(self, value: bool):
+        self._query_state.truncated = value
+    
+    @property
+    def last_query_error(self) -> Optional[Exception]:
+        """Set when this thread's last streamed/columnar query failed, timed out or was cancelled"""
+        return getattr(self._query_state, "error", None)
+    
+    @last_query_error.setter
+    def last_query_error(self, value: Optional[Exception]):
+        self._query_state.error = value
+    
+    def execute_query(self, collection_name: str, query: List[Dict], use_cache: bool = True) -> List[Dict]:
         """Execute a MongoDB aggregation pipeline"""
         collection = self.get_collection(collection_name)
         if collection is None:
             return []
         
+        fingerprint = None
+        if use_cache:
+            if self.watch_changes:
+                result_cache.watch_collection(self.cluster_namespace(collection_name), collection.watch)
+            if self.fingerprint_results:
+                fingerprint = self.get_collection_fingerprint(collection_name)
+            cached = result_cache.get(self.cluster_namespace(collection_name), query, fingerprint)
+            if cached is not None:
+                tracer.record_span("mongo.aggregate", 0.0, collection=collection_name, rows=len(cached),
+                                   cache_hit=True)
+                return cached
+        
+        with tracer.span("mongo.aggregate", collection=collection_name, cache_hit=False) as span:
+            try:
+                result = list(collection.aggregate(query, **self._aggregate_options()))
+                span.set(rows=len(result))
+                if use_cache:
+                    result_cache.put(self.cluster_namespace(collection_name), query, result, fingerprint)
+                return result
+            except Exception as e:
+                span.status = "error"
+                st.error(f"Failed to execute query on {collection_name}: {str(e)}")
+                return []
+    
+    def _aggregate_options(self, batch_size: Optional[int] = None, allow_disk_use: Optional[bool] = None,
+                           max_time_ms: Optional[int] = None) -> Dict[str, Any]:
+        """Build keyword arguments for collection.aggregate"""
+        options: Dict[str, Any] = {}
+        allow_disk_use = self.allow_disk_use if allow_disk_use is None else allow_disk_use
+        max_time_ms = self.max_time_ms if max_time_ms is None else max_time_ms
+        if batch_size:
+            options["batchSize"] = batch_size
+        if allow_disk_use:
+            options["allowDiskUse"] = True
+        if max_time_ms:
+            options["maxTimeMS"] = max_time_ms
+        return options
+    
+    @contextmanager
+    def _tracked_operation(self, op_id: Optional[str]):
+        """Run an aggregation in its own session, tagged with op_id, so it can be killed.
+        
+        Yields extra aggregate() keyword arguments.
+        """
+        if not op_id:
+            yield {}
+            return
+        
+        try:
+            session = self.client.start_session()
+        except Exception:
+            # Mocks and some deployments don't support sessions; killOp still works via the comment
+            session = None
+        self.query_guard.register(op_id, self.client, session)
+        try:
+            yield {"session": session, "comment": op_id} if session is not None else {"comment": op_id}
+        finally:
+            self.query_guard.unregister(op_id)
+            if session is not None:
+                session.end_session()
+    
+    def _report_failure(self, collection_name: str, query: List[Dict], error: Exception,
+                        op_id: Optional[str], max_time_ms: Optional[int]):
+        """Turn timeouts and cancellations into budget violations instead of raw errors"""
+        self.last_query_error = error
+        namespace = self.namespace(collection_name)
+        if self.query_guard.is_cancelled(op_id):
+            self.query_guard.record_violation("cancelled", namespace, "cancelled by the user", query)
+        elif isinstance(error, ExecutionTimeout):
+            self.query_guard.record_violation("max_time_ms", namespace, f"exceeded {max_time_ms} ms", query)
+            st.error(f"The query on {collection_name} was stopped after {max_time_ms:,} ms. "
+                     "Try narrowing it down.")
+        else:
+            st.error(f"Failed to execute query on {collection_name}: {str(error)}")
+    
+    def new_operation_id(self) -> str:
+        """Id to pass to iter_query_batches/execute_query_columnar so the query can be cancelled"""
+        return f"mongochart:{uuid.uuid4().hex}"
+    
+    def cancel_operation(self, op_id: str) -> bool:
+        """Kill a running aggregation started with op_id"""
+        return self.query_guard.cancel(op_id)
+    
+    def preflight(self, collection_name: str, query: List[Dict]) -> Dict[str, Any]:
+        """Estimate a pipeline's cost from its query plan and the collection stats.
+        
+        A collection scan is assumed to examine every document; index scans
+        are considered within budget. Returns the estimate plus `over_budget`
+        (a reason string or None) for the collection's budget, and the raw
+        queryPlanner `explain` output for advise_query to reuse.
+        """
+        estimate: Dict[str, Any] = {"estimated_docs": None, "estimated_bytes": None, "collscan": None}
+        collection = self.get_collection(collection_name)
+        if collection is None:
+            estimate["over_budget"] = None
+            return estimate
+        
         try:
-            result = list(collection.aggregate(query))
-            return result
+            estimate["explain"] = self.explain_query(collection_name, query, "queryPlanner")
+            estimate["collscan"] = summarize_explain(estimate["explain"])["collscan"]
+        except Exception:
+            # Without explain, assume pipelines that don't start with $match/$sort scan everything
+            estimate["collscan"] = not query or not ({"$match", "$sort", "$geoNear"} & set(query[0]))
+        
+        if estimate["collscan"]:
+            try:
+                count = collection.estimated_document_count()
+                estimate["estimated_docs"] = count
+                try:
+                    avg_size = self.db.command("collStats", collection_name).get("avgObjSize", 0)
+                    estimate["estimated_bytes"] = int(count * avg_size)
+                except Exception:
+                    pass
+            except Exception:
+                pass
+        
+        estimate["over_budget"] = self.query_guard.over_budget(
+            estimate, self.query_guard.budget_for(collection_name)
+        )
+        if estimate["over_budget"]:
+            self.query_guard.record_violation(
+                "preflight", self.namespace(collection_name), estimate["over_budget"], query
+            )
+        return estimate
+    
+    def iter_query_batches(self, collection_name: str, query: List[Dict], batch_size: Optional[int] = None,
+                           max_rows: Optional[int] = None, max_bytes: Optional[int] = None,
+                           allow_disk_use: Optional[bool] = None, max_time_ms: Optional[int] = None,
+                           use_cache: bool = True, op_id: Optional[str] = None,
+                           report_errors: bool = True) -> Iterator[List[Dict]]:
+        """Stream an aggregation in cursor batches, stopping at the row/byte ceilings.
+        
+        Limits default to the collection's query budget. Sets
+        `last_query_truncated` when a ceiling cut the result short. Pass an
+        `op_id` (see new_operation_id) to be able to cancel the query. With
+        `report_errors=False` failures are only recorded in `last_query_error`,
+        for callers that have a fallback. Both are kept per thread, so read
+        them from the thread that consumed the batches.
+        """
+        self.last_query_truncated = False
+        self.last_query_error = None
+        collection = self.get_collection(collection_name)
+        if collection is None:
+            return
+        
+        budget = self.query_guard.budget_for(collection_name)
+        batch_size = batch_size or self.batch_size
+        max_rows = budget.max_rows if max_rows is None else max_rows
+        max_bytes = budget.max_bytes if max_bytes is None else max_bytes
+        max_time_ms = budget.max_time_ms if max_time_ms is None else max_time_ms
+        
+        # Time spent in here (server, network, decode), excluding the consumer's work between batches
+        resumed = time.perf_counter()
+        busy = 0.0
+        decode_seconds = 0.0
+        
+        fingerprint = None
+        if use_cache:
+            if self.fingerprint_results:
+                fingerprint = self.get_collection_fingerprint(collection_name)
+            cached = result_cache.get(self.cluster_namespace(collection_name), query, fingerprint)
+            if cached is not None:
+                tracer.record_span("mongo.aggregate", time.perf_counter() - resumed, collection=collection_name,
+                                   rows=len(cached), cache_hit=True)
+                for start in range(0, len(cached), batch_size):
+                    yield cached[start:start + batch_size]
+                return
+        
+        # Decode documents ourselves so their BSON size is known without re-encoding
+        try:
+            raw_collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        except NotImplementedError:
+            # Drivers/mocks without raw document support decode to dicts
+            raw_collection = collection
+        options = self._aggregate_options(batch_size, allow_disk_use, max_time_ms)
+        
+        rows = 0
+        total_bytes = 0
+        truncated = False
+        # Keep a copy for the result cache only while it still fits there
+        cacheable = [] if use_cache else None
+        batch = []
+        try:
+            with self._tracked_operation(op_id) as tracking, \
+                    raw_collection.aggregate(query, **options, **tracking) as cursor:
+                for raw_doc in cursor:
+                    if isinstance(raw_doc, RawBSONDocument):
+                        size = len(raw_doc.raw)
+                        decode_start = time.perf_counter()
+                        doc = bson.decode(raw_doc.raw)
+                        decode_seconds += time.perf_counter() - decode_start
+                    else:
+                        doc = raw_doc
+                        size = len(bson.encode(doc))
+                    
+                    if (max_rows and rows >= max_rows) or (max_bytes and total_bytes + size > max_bytes):
+                        truncated = self.last_query_truncated = True
+                        limit = "max_rows" if max_rows and rows >= max_rows else "max_bytes"
+                        self.query_guard.record_violation(
+                            limit, self.namespace(collection_name),
+                            f"result cut off at {rows:,} rows / {total_bytes:,} bytes", query
+                        )
+                        break
+                    
+                    rows += 1
+                    total_bytes += size
+                    batch.append(doc)
+                    if cacheable is not None:
+                        if total_bytes <= result_cache.max_bytes:
+                            cacheable.append(doc)
+                        else:
+                            cacheable = None
+                    
+                    if len(batch) >= batch_size:
+                        busy += time.perf_counter() - resumed
+                        resumed = None
+                        yield batch
+                        resumed = time.perf_counter()
+                        batch = []
+            
+            if batch:
+                busy += time.perf_counter() - resumed
+                resumed = None
+                yield batch
+                resumed = time.perf_counter()
+            if cacheable is not None and not truncated:
+                result_cache.put(self.cluster_namespace(collection_name), query, cacheable, fingerprint)
+        except Exception as e:
+            if report_errors:
+                self._report_failure(collection_name, query, e, op_id, max_time_ms)
+            else:
+                self.last_query_error = e
+        finally:
+            if resumed is not None:
+                busy += time.perf_counter() - resumed
+            tracer.record_span(
+                "mongo.aggregate", busy, collection=collection_name, rows=rows, bytes=total_bytes,
+                decode_ms=round(decode_seconds * 1000, 2), cache_hit=False, truncated=truncated
+            )
+    
+    def execute_query_columnar(self, collection_name: str, query: List[Dict],
+                               allow_disk_use: Optional[bool] = None, max_time_ms: Optional[int] = None,
+                               op_id: Optional[str] = None):
+        """Execute an aggregation and decode the results straight into a pyarrow Table.
+        
+        Returns None when pymongoarrow isn't installed or the query fails; callers
+        should fall back to `iter_query_batches`. This path bypasses the result
+        cache and the streaming byte ceiling, so pipelines should already be
+        capped with `AggregationBuilder.apply_row_ceiling`.
+        """
+        self.last_query_truncated = False
+        self.last_query_error = None
+        if aggregate_arrow_all is None:
+            return None
+        
+        collection = self.get_collection(collection_name)
+        if collection is None:
+            return None
+        
+        if max_time_ms is None:
+            max_time_ms = self.query_guard.budget_for(collection_name).max_time_ms
+        try:
+            options = self._aggregate_options(self.batch_size, allow_disk_use, max_time_ms)
+            with self._tracked_operation(op_id) as tracking, \
+                    tracer.span("mongo.aggregate", collection=collection_name, cache_hit=False, columnar=True) as span:
+                table = aggregate_arrow_all(collection, query, **options, **tracking)
+                span.set(rows=table.num_rows, bytes=table.nbytes)
+                return table
         except Exception as e:
-            st.error(f"Failed to execute query on {collection_name}: {str(e)}")
+            self._report_failure(collection_name, query, e, op_id, max_time_ms)
+            return None
+    
+    def explain_query(self, collection_name: str, query: List[Dict],
+                      verbosity: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Raw explain() output for an aggregation pipeline"""
+        collection = self.get_collection(collection_name)
+        if collection is None:
+            return None
+        
+        return self.db.command(
+            "explain",
+            {"aggregate": collection_name, "pipeline": query, "cursor": {}},
+            verbosity=verbosity or self.explain_verbosity
+        )
+    
+    def _index_keys(self, collection_name: str) -> List[Tuple[Tuple[str, int], ...]]:
+        """Key patterns of the collection's existing indexes"""
+        collection = self.get_collection(collection_name)
+        if collection is None:
             return []
+        return [
+            tuple((field, direction) for field, direction in info["key"])
+            for info in collection.index_information().values()
+        ]
+    
+    def advise_query(self, collection_name: str, query: List[Dict], verbosity: Optional[str] = None,
+                     explain: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Explain a pipeline, summarize its plan and suggest a missing index.
+        
+        The finding is also added to the shared index advisor so suggestions
+        can be ranked across the query history. Pass the queryPlanner
+        `explain` output of preflight() to reuse it instead of explaining
+        again (it is ignored at other verbosities). Returns None when explain
+        is disabled or unsupported.
+        """
+        verbosity = verbosity or self.explain_verbosity
+        if verbosity == "off":
+            return None
+        
+        try:
+            if explain is None or verbosity != "queryPlanner":
+                explain = self.explain_query(collection_name, query, verbosity)
+            summary = summarize_explain(explain)
+            suggested = suggest_index(query)
+            if suggested is not None and index_covered(suggested, self._index_keys(collection_name)):
+                suggested = None
+        except Exception:
+            # Advice is best effort (e.g. the user may lack explain privileges)
+            return None
+        
+        summary["suggested_index"] = format_index(suggested) if suggested and (
+            summary["collscan"] or summary["in_memory_sort"]
+        ) else None
+        index_advisor.record(self.namespace(collection_name), suggested, summary)
+        return summary
+    
+    def index_recommendations(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Suggested indexes for this database, ranked across every explained query"""
+        if self.db is None:
+            return []
+        return index_advisor.report(f"{self.db.name}.", limit)
     
     def disconnect(self):
         """Close the MongoDB connection"""
         if self.client is not None:
-            self.client.close()
+            if self._release is not None:
+                # Drops this connection's reference; the registry closes idle clients
+                self._release()
+                self._release = None
             self.client = None
             self.db = None
+            self._client_key = None
             self.collections = {}
             self.collection_schemas = {}
+    
+    def pool_metrics(self) -> List[Dict[str, Any]]:
+        """Pool metrics for every client in the shared registry"""
+        return client_registry.metrics()
 
 # Create singleton instance
 mongo_connection = MongoDBConnection() 
\ No newline at end of file
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+# Budget names accepted in QUERY_COLLECTION_LIMITS
+LIMIT_NAMES = ("max_time_ms", "max_rows", "max_mb", "max_docs_examined", "preview_size")
+
+class QueryBudget:
+    """Per-query limits; 0 disables a limit"""
+
+    def __init__(self, max_time_ms: int = 0, max_rows: int = 0, max_bytes: int = 0,
+                 max_docs_examined: int = 0, preview_size: int = 10000):
+        self.max_time_ms = max_time_ms
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_docs_examined = max_docs_examined
+        self.preview_size = preview_size
+
+    def with_overrides(self, overrides: Dict[str, float]) -> "QueryBudget":
+        return QueryBudget(
+            max_time_ms=int(overrides.get("max_time_ms", self.max_time_ms)),
+            max_rows=int(overrides.get("max_rows", self.max_rows)),
+            max_bytes=int(overrides["max_mb"] * 1024 * 1024) if "max_mb" in overrides else self.max_bytes,
+            max_docs_examined=int(overrides.get("max_docs_examined", self.max_docs_examined)),
+            preview_size=int(overrides.get("preview_size", self.preview_size)),
+        )
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "max_time_ms": self.max_time_ms,
+            "max_rows": self.max_rows,
+            "max_bytes": self.max_bytes,
+            "max_docs_examined": self.max_docs_examined,
+            "preview_size": self.preview_size,
+        }
+
+def parse_collection_limits(raw: str) -> Dict[str, Dict[str, float]]:
+    """Parse QUERY_COLLECTION_LIMITS, e.g. 'orders:max_time_ms=5000,max_rows=10000;events:max_docs_examined=1000000'"""
+    limits: Dict[str, Dict[str, float]] = {}
+    for part in raw.split(";"):
+        if ":" not in part:
+            continue
+        name, settings = part.split(":", 1)
+        for setting in settings.split(","):
+            if "=" not in setting:
+                continue
+            key, value = (s.strip() for s in setting.split("=", 1))
+            if key not in LIMIT_NAMES:
+                continue
+            try:
+                limits.setdefault(name.strip(), {})[key] = float(value)
+            except ValueError:
+                continue
+    return limits
+
+def preview_pipeline(pipeline: List[Dict[str, Any]], size: int) -> List[Dict[str, Any]]:
+    """Run the pipeline over a random sample of the collection instead of all of it"""
+    return [{"$sample": {"size": size}}] + pipeline
+
+class _Operation:
+    def __init__(self, client, session, comment: str):
+        self.client = client
+        self.session = session
+        self.comment = comment
+        self.cancelled = False
+
+class QueryGuard:
+    """Query budgets, pre-flight cost checks, running-operation registry and violation log.
+
+    Budgets come from the connection defaults with optional per-collection
+    overrides. Every running aggregation can be registered under an operation
+    id so the UI can kill it on the server (killSessions, falling back to
+    killOp on the operation's comment).
+    """
+
+    def __init__(self, defaults: QueryBudget, collection_limits: Optional[Dict[str, Dict[str, float]]] = None,
+                 violation_log: Optional[str] = None, max_recent: int = 100):
+        self.defaults = defaults
+        self.collection_limits = collection_limits or {}
+        self.violation_log = violation_log
+        self.recent_violations = deque(maxlen=max_recent)
+        self._operations: Dict[str, _Operation] = {}
+        self._lock = threading.Lock()
+
+    def budget_for(self, collection_name: str) -> QueryBudget:
+        overrides = self.collection_limits.get(collection_name)
+        return self.defaults.with_overrides(overrides) if overrides else self.defaults
+
+    def set_collection_limits(self, collection_name: str, **limits: float):
+        """Override limits for one collection at runtime"""
+        unknown = set(limits) - set(LIMIT_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown query limits: {', '.join(sorted(unknown))}")
+        self.collection_limits.setdefault(collection_name, {}).update(limits)
+
+    def over_budget(self, estimate: Dict[str, Any], budget: QueryBudget) -> Optional[str]:
+        """Reason a pre-flight estimate exceeds the budget, or None"""
+        docs = estimate.get("estimated_docs")
+        if budget.max_docs_examined and docs and docs > budget.max_docs_examined:
+            return (f"would examine about {docs:,} documents "
+                    f"(limit {budget.max_docs_examined:,})")
+        return None
+
+    def record_violation(self, kind: str, namespace: str, detail: str, pipeline: Optional[List[Dict]] = None):
+        """Log a budget violation ("preflight", "max_time_ms", "max_rows", "max_bytes" or "cancelled")"""
+        entry = {"time": time.time(), "kind": kind, "namespace": namespace, "detail": detail}
+        logger.warning("Query budget violation on %s (%s): %s", namespace, kind, detail)
+        self.recent_violations.append(entry)
+        if self.violation_log:
+            try:
+                directory = os.path.dirname(self.violation_log)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.violation_log, "a") as f:
+                    f.write(json.dumps({**entry, "pipeline": pipeline}, default=str) + "\n")
+            except OSError:
+                logger.exception("Could not write the query violation log")
+
+    # Running operations
+
+    def register(self, op_id: str, client, session):
+        with self._lock:
+            self._operations[op_id] = _Operation(client, session, op_id)
+
+    def unregister(self, op_id: str) -> bool:
+        """Forget an operation; returns whether it had been cancelled"""
+        with self._lock:
+            operation = self._operations.pop(op_id, None)
+        return operation is not None and operation.cancelled
+
+    def is_cancelled(self, op_id: Optional[str]) -> bool:
+        with self._lock:
+            operation = self._operations.get(op_id) if op_id else None
+        return operation is not None and operation.cancelled
+
+    def cancel(self, op_id: str) -> bool:
+        """Kill a running operation on the server; returns whether it was found"""
+        with self._lock:
+            operation = self._operations.get(op_id)
+            if operation is None:
+                return False
+            operation.cancelled = True
+
+        admin = operation.client.admin
+        if operation.session is not None:
+            try:
+                # Ending the server session interrupts its running operations and cursors
+                admin.command("killSessions", [operation.session.session_id])
+                return True
+            except Exception:
+                pass
+        try:
+            ops = admin.aggregate([
+                {"$currentOp": {}},
+                {"$match": {"command.comment": operation.comment}},
+            ])
+            for op in ops:
+                admin.command("killOp", op=op["opid"])
+        except Exception:
+            logger.exception("Could not kill operation %s", op_id)
+        return True
+
+    def active_operations(self) -> List[str]:
+        with self._lock:
+            return list(self._operations)
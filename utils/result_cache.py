@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Callable
+
+import bson
+from bson import ObjectId
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Stages whose key order carries meaning and must not be re-sorted
+ORDER_SENSITIVE_STAGES = {'$sort'}
+# Operators and variables whose results differ from run to run (a random draw, the current
+# time), so pipelines using them are never cached or materialized
+VOLATILE_OPERATORS = {'$sample', '$rand', '$$NOW', '$$CLUSTER_TIME'}
+
+def _normalize_literal(value: Any, sort_keys: bool = False) -> Any:
+    """Recursively normalize a pipeline fragment into JSON-stable values.
+
+    Keys are only re-sorted where their order carries no meaning: stage specs
+    (`sort_keys`) and operator documents such as {"$gte": 1, "$lt": 5}.
+    Embedded documents keep their order, since {a: 1, b: 2} and {b: 2, a: 1}
+    are different values to MongoDB.
+    """
+    if isinstance(value, dict):
+        operators = bool(value) and all(str(k).startswith("$") for k in value)
+        items = sorted(value.items(), key=lambda item: str(item[0])) if sort_keys or operators else value.items()
+        return {str(k): _normalize_literal(v) for k, v in items}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_literal(v) for v in value]
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        # 10.0 and 10 select the same documents
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime.datetime):
+        return {"$date": value.isoformat()}
+    return {"$repr": repr(value)}
+
+def canonicalize_pipeline(pipeline: List[Dict[str, Any]]) -> str:
+    """Serialize a pipeline so equivalent pipelines produce identical text"""
+    normalized = []
+    for stage in pipeline:
+        if isinstance(stage, dict) and len(stage) == 1:
+            operator, spec = next(iter(stage.items()))
+            normalized.append({str(operator): _normalize_literal(spec, operator not in ORDER_SENSITIVE_STAGES)})
+        else:
+            normalized.append(_normalize_literal(stage))
+    return json.dumps(normalized, separators=(",", ":"), sort_keys=False)
+
+def is_deterministic(value: Any) -> bool:
+    """Whether a pipeline (or fragment) returns the same result on every run, i.e. uses no VOLATILE_OPERATORS"""
+    if isinstance(value, dict):
+        return all(k not in VOLATILE_OPERATORS and is_deterministic(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return all(is_deterministic(v) for v in value)
+    return not (isinstance(value, str) and value in VOLATILE_OPERATORS)
+
+def pipeline_hash(collection_name: str, pipeline: List[Dict[str, Any]]) -> str:
+    """Cache key for a pipeline run against a collection"""
+    raw = f"{collection_name}\x00{canonicalize_pipeline(pipeline)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def estimate_result_bytes(results: List[Dict[str, Any]]) -> int:
+    """Approximate memory footprint of a result set by its BSON size"""
+    total = 0
+    for doc in results:
+        try:
+            total += len(bson.encode(doc))
+        except Exception:
+            total += len(json.dumps(doc, default=str))
+    return total
+
+class ResultCache:
+    """Byte-bounded LRU cache of aggregation results"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, default_ttl: float = 300,
+                 collection_ttls: Optional[Dict[str, float]] = None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.collection_ttls = dict(collection_ttls or {})
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._watchers: Dict[str, threading.Thread] = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def ttl_for(self, collection_name: str) -> float:
+        """TTL for a collection (a bare name or "<cluster>/db.collection" namespace), falling back to the default"""
+        if collection_name in self.collection_ttls:
+            return self.collection_ttls[collection_name]
+        # Overrides name bare collections; database names can't contain dots
+        return self.collection_ttls.get(collection_name.split(".", 1)[-1], self.default_ttl)
+
+    def set_collection_ttl(self, collection_name: str, ttl_seconds: float):
+        """Override the TTL for one collection"""
+        self.collection_ttls[collection_name] = ttl_seconds
+
+    def get(self, collection_name: str, pipeline: List[Dict[str, Any]],
+            fingerprint: Optional[str] = None) -> Optional[List[Dict[str, Any]]]:
+        """Return cached results, or None on miss, expiry or a changed fingerprint"""
+        if not is_deterministic(pipeline):
+            return None
+        key = pipeline_hash(collection_name, pipeline)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            ttl = self.ttl_for(collection_name)
+            expired = ttl > 0 and time.time() - entry["created_at"] > ttl
+            stale = fingerprint is not None and entry["fingerprint"] != fingerprint
+            if expired or stale:
+                self._drop(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["results"]
+
+    def put(self, collection_name: str, pipeline: List[Dict[str, Any]],
+            results: List[Dict[str, Any]], fingerprint: Optional[str] = None):
+        """Store results, evicting least recently used entries to fit the byte budget"""
+        if not is_deterministic(pipeline):
+            # A random sample must be drawn again each time, and "now" keeps moving
+            return
+        size = estimate_result_bytes(results)
+        if size > self.max_bytes:
+            # Never let a single huge result flush the whole cache
+            return
+
+        key = pipeline_hash(collection_name, pipeline)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = {
+                "collection": collection_name,
+                "results": results,
+                "bytes": size,
+                "fingerprint": fingerprint,
+                "created_at": time.time(),
+            }
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry["bytes"]
+
+    def invalidate_collection(self, collection_name: str):
+        """Drop every cached result for a collection"""
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if e["collection"] == collection_name]
+            for key in keys:
+                self._drop(key)
+            if keys:
+                self.invalidations += 1
+
+    def clear(self):
+        """Remove every cached result"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def watch_collection(self, collection_name: str, open_stream: Callable[[], Any]) -> bool:
+        """Invalidate a collection's entries whenever its change stream fires.
+
+        `open_stream` must return a change stream (e.g. `collection.watch`).
+        Returns False when change streams aren't available (standalone servers),
+        in which case callers should rely on fingerprints instead.
+        """
+        with self._lock:
+            if collection_name in self._watchers and self._watchers[collection_name].is_alive():
+                return True
+
+        try:
+            stream = open_stream()
+        except Exception:
+            return False
+
+        def run():
+            try:
+                with stream:
+                    for _ in stream:
+                        self.invalidate_collection(collection_name)
+            except Exception:
+                # Stream closed or the server stepped down; fingerprints still apply
+                pass
+            finally:
+                with self._lock:
+                    self._watchers.pop(collection_name, None)
+
+        thread = threading.Thread(target=run, name=f"result-cache-watch-{collection_name}", daemon=True)
+        with self._lock:
+            self._watchers[collection_name] = thread
+        thread.start()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and memory usage for display"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "invalidations": self.invalidations,
+        }
+
+def _parse_collection_ttls(raw: str) -> Dict[str, float]:
+    """Parse RESULT_CACHE_COLLECTION_TTLS, e.g. 'orders=60,events=10'"""
+    ttls = {}
+    for part in raw.split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            try:
+                ttls[name.strip()] = float(value)
+            except ValueError:
+                continue
+    return ttls
+
+# Create singleton instance
+result_cache = ResultCache(
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_MB", "64")) * 1024 * 1024,
+    default_ttl=float(os.getenv("RESULT_CACHE_TTL", "300")),
+    collection_ttls=_parse_collection_ttls(os.getenv("RESULT_CACHE_COLLECTION_TTLS", ""))
+)
@@ -0,0 +1,504 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Any, Tuple
+
+from bson import ObjectId, json_util
+from pymongo import ReadPreference
+from dotenv import load_dotenv
+
+from .result_cache import canonicalize_pipeline, is_deterministic
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Accumulators that can be pre-aggregated and combined again
+ROLLUP_ACCUMULATORS = {'$sum', '$avg', '$min', '$max', '$count'}
+# Stages allowed before the $group of a rollup-able pipeline
+PREFIX_STAGES = {'$match'}
+def split_rollup_pipeline(pipeline: List[Dict[str, Any]]) -> Optional[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """Split a pipeline into its rollup-able head ($match stages and one $group) and the rest.
+
+    Returns None when the pipeline doesn't start that way, the group uses
+    accumulators that can't be combined incrementally ($push, $first, ...),
+    or the result depends on the time it runs.
+    """
+    head: List[Dict[str, Any]] = []
+    for position, stage in enumerate(pipeline):
+        if not isinstance(stage, dict) or len(stage) != 1:
+            return None
+        operator, spec = next(iter(stage.items()))
+        if operator in PREFIX_STAGES:
+            head.append(stage)
+            continue
+        if operator != '$group' or not isinstance(spec, dict) or '_id' not in spec:
+            return None
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1 \
+                    or next(iter(accumulator)) not in ROLLUP_ACCUMULATORS:
+                return None
+        head.append(stage)
+        if not is_deterministic(head):
+            return None
+        return head, pipeline[position + 1:]
+    return None
+
+def partial_group(group: Dict[str, Any]) -> Dict[str, Any]:
+    """$group spec storing combinable partial aggregates ($avg as a sum and a count)"""
+    partial: Dict[str, Any] = {'_id': group['_id']}
+    for name, accumulator in group.items():
+        if name == '_id':
+            continue
+        operator, expression = next(iter(accumulator.items()))
+        if operator == '$count':
+            partial[name] = {'$sum': 1}
+        elif operator == '$avg':
+            partial[f"{name}__sum"] = {'$sum': expression}
+            # $avg ignores non-numeric values, so the count must too
+            partial[f"{name}__n"] = {'$sum': {'$cond': [{'$isNumber': expression}, 1, 0]}}
+        else:
+            partial[name] = {operator: expression}
+    return partial
+
+def combine_partials(group: Dict[str, Any]) -> Dict[str, Any]:
+    """$merge whenMatched update folding newly aggregated partials ($$new) into a rollup document"""
+    combined: Dict[str, Any] = {}
+    for name, accumulator in group.items():
+        if name == '_id':
+            continue
+        operator = next(iter(accumulator))
+        if operator in ('$sum', '$count'):
+            combined[name] = {'$add': [f"${name}", f"$$new.{name}"]}
+        elif operator == '$avg':
+            for part in (f"{name}__sum", f"{name}__n"):
+                combined[part] = {'$add': [f"${part}", f"$$new.{part}"]}
+        else:
+            combined[name] = {operator: [f"${name}", f"$$new.{name}"]}
+    return combined
+
+def finalize_partials(group: Dict[str, Any]) -> Dict[str, Any]:
+    """$project turning rollup documents back into the original $group's output"""
+    projection: Dict[str, Any] = {'_id': 1}
+    for name, accumulator in group.items():
+        if name == '_id':
+            continue
+        operator = next(iter(accumulator))
+        if operator == '$avg':
+            projection[name] = {'$cond': [
+                {'$gt': [f"${name}__n", 0]},
+                {'$divide': [f"${name}__sum", f"${name}__n"]},
+                None
+            ]}
+        else:
+            projection[name] = 1
+    return projection
+
+def rollup_key(namespace: str, head: List[Dict[str, Any]]) -> str:
+    raw = f"{namespace}\x00{canonicalize_pipeline(head)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def safe_high_water(value: Any, lag: float, now: Optional[float] = None) -> Any:
+    """Cap a high-water mark `lag` seconds before `now`, where other clients' writes may still land.
+
+    ObjectIds embed their client's clock (to the second) and timestamps are
+    set before the write commits, so a document older than the newest one
+    can still arrive. ObjectIds and datetimes are capped; other values (e.g.
+    integer _ids) carry no time and are returned as they are.
+    """
+    if lag <= 0:
+        return value
+    cutoff = datetime.fromtimestamp((time.time() if now is None else now) - lag, timezone.utc)
+    if isinstance(value, ObjectId):
+        # This id sorts before every real one of its second, so that second is the next window's
+        return min(value, ObjectId.from_datetime(cutoff))
+    if isinstance(value, datetime):
+        return min(value, cutoff if value.tzinfo is not None else cutoff.replace(tzinfo=None))
+    return value
+
+def _ordered_id(value: Any) -> bool:
+    """Whether _id values of this type increase with insertion order, so a high-water mark works"""
+    return isinstance(value, (ObjectId, int, float)) and not isinstance(value, bool)
+
+class Rollup:
+    """A materialized $match/$group head, stored in its own collection"""
+
+    def __init__(self, key: str, namespace: str, head: List[Dict[str, Any]], collection: str,
+                 refreshed_at: Optional[float] = None, full_refreshed_at: Optional[float] = None,
+                 high_water: Any = None, created_at: Optional[float] = None):
+        self.key = key
+        self.namespace = namespace
+        self.head = head
+        self.collection = collection
+        self.refreshed_at = refreshed_at
+        self.full_refreshed_at = full_refreshed_at
+        self.high_water = high_water
+        self.created_at = created_at or time.time()
+        # Set by the change stream watcher; "incremental" or "full"
+        self.pending: Optional[str] = None
+        self.hits = 0
+
+    @property
+    def source(self) -> str:
+        return self.namespace.split(".", 1)[1]
+
+    @property
+    def group(self) -> Dict[str, Any]:
+        return self.head[-1]['$group']
+
+    def to_document(self) -> Dict[str, Any]:
+        return {
+            "_id": self.key,
+            "namespace": self.namespace,
+            # Operator names can't be stored as field names, so the pipeline is kept as Extended JSON
+            "head": json_util.dumps(self.head),
+            "collection": self.collection,
+            "refreshed_at": self.refreshed_at,
+            "full_refreshed_at": self.full_refreshed_at,
+            "high_water": self.high_water,
+            "created_at": self.created_at,
+        }
+
+    @classmethod
+    def from_document(cls, doc: Dict[str, Any]) -> "Rollup":
+        return cls(
+            key=doc["_id"], namespace=doc["namespace"], head=json_util.loads(doc["head"]), collection=doc["collection"],
+            refreshed_at=doc.get("refreshed_at"), full_refreshed_at=doc.get("full_refreshed_at"),
+            high_water=doc.get("high_water"), created_at=doc.get("created_at"),
+        )
+
+class RollupManager:
+    """Materializes frequently run $group pipelines and redirects them to the result.
+
+    Every built pipeline is recorded; a rollup-able head ($match stages plus a
+    $group with combinable accumulators) seen `min_runs` times within `window`
+    seconds is materialized with $merge into its own collection. A background
+    thread refreshes rollups every `refresh_interval` seconds: incrementally
+    (only documents past the last-seen _id) when the source's _id is ordered,
+    with a full rebuild every `full_refresh_interval` seconds to pick up
+    updates and deletes. With change streams (replica sets), inserts and
+    updates schedule the next refresh as soon as they happen.
+
+    ObjectIds are only roughly ordered across clients (each embeds its
+    client's clock, to the second), so the high-water mark trails the newest
+    _id by `safety_lag` seconds: documents are only folded in once any
+    client's insert from that second should have landed. Inserts arriving
+    later than that (clock skew or slow writes beyond the lag), and
+    out-of-order integer _ids, are missed until the next full rebuild, and a
+    fresh rollup covers the source only up to its high-water mark.
+
+    Rollup definitions live in `meta_collection` of each database, so they are
+    shared by every session and app instance and survive restarts. Namespaces
+    are cluster-qualified ("<cluster>/db.collection", see
+    `MongoDBConnection.cluster_namespace`), so two deployments with the same
+    database name never read each other's rollups.
+    """
+
+    def __init__(self, enabled: bool = False, min_runs: int = 5, window: float = 3600,
+                 max_staleness: float = 300, refresh_interval: float = 60,
+                 full_refresh_interval: float = 3600, max_rollups: int = 20,
+                 meta_collection: str = "mongochart_rollups", change_streams: bool = False,
+                 safety_lag: float = 5):
+        self.enabled = enabled
+        self.min_runs = min_runs
+        self.window = window
+        self.max_staleness = max_staleness
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.max_rollups = max_rollups
+        self.meta_collection = meta_collection
+        self.change_streams = change_streams
+        self.safety_lag = safety_lag
+        self._lock = threading.Lock()
+        self._runs: Dict[str, deque] = {}
+        self._candidates: Dict[str, Tuple[str, List[Dict[str, Any]]]] = {}
+        self._rollups: Dict[str, Rollup] = {}
+        # "<cluster>/db" -> database
+        self._databases: Dict[str, Any] = {}
+        self._watchers: Dict[str, threading.Thread] = {}
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # Attaching databases
+
+    def attach(self, client, cluster: str, db_name: str):
+        """Start managing rollups for a database of a cluster (no-op unless enabled)"""
+        if not self.enabled:
+            return
+        # $merge writes, so it must run on the primary regardless of the analytics read preference
+        db = client.get_database(db_name, read_preference=ReadPreference.PRIMARY)
+        database = f"{cluster}/{db_name}"
+        with self._lock:
+            self._databases[database] = db
+        self._load_definitions(database, db)
+        self._ensure_thread()
+
+    def _load_definitions(self, database: str, db):
+        try:
+            docs = list(db[self.meta_collection].find())
+        except Exception:
+            logger.exception("Could not load rollup definitions from %s", db.name)
+            return
+        with self._lock:
+            for doc in docs:
+                if not doc["namespace"].startswith(f"{database}."):
+                    # Recorded through another connection string; its rollups are that cluster's
+                    continue
+                existing = self._rollups.get(doc["_id"])
+                rollup = Rollup.from_document(doc)
+                if existing is not None:
+                    # Keep local state, take the latest refresh from whichever instance did it
+                    rollup.pending, rollup.hits = existing.pending, existing.hits
+                self._rollups[rollup.key] = rollup
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="rollup-refresh", daemon=True)
+            self._thread.start()
+
+    # Detection and rewriting
+
+    def record(self, namespace: str, pipeline: List[Dict[str, Any]]):
+        """Count one run of a pipeline towards materializing its head"""
+        if not self.enabled:
+            return
+        split = split_rollup_pipeline(pipeline)
+        if split is None:
+            return
+        head = split[0]
+        key = rollup_key(namespace, head)
+        now = time.time()
+        with self._lock:
+            if key in self._rollups:
+                return
+            runs = self._runs.setdefault(key, deque())
+            runs.append(now)
+            while runs and runs[0] < now - self.window:
+                runs.popleft()
+            if len(runs) >= self.min_runs and len(self._rollups) + len(self._candidates) < self.max_rollups:
+                self._candidates[key] = (namespace, head)
+                self._wake.set()
+
+    def is_fresh(self, rollup: Rollup) -> bool:
+        return rollup.refreshed_at is not None and time.time() - rollup.refreshed_at <= self.max_staleness
+
+    def rewrite(self, namespace: str, pipeline: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Read a pipeline's head from its rollup when one is fresh enough; returns (pipeline, note)"""
+        if not self.enabled:
+            return pipeline, None
+        split = split_rollup_pipeline(pipeline)
+        if split is None:
+            return pipeline, None
+        head, tail = split
+        with self._lock:
+            rollup = self._rollups.get(rollup_key(namespace, head))
+            if rollup is None or not self.is_fresh(rollup):
+                return pipeline, None
+            rollup.hits += 1
+        rewritten = [
+            # Matches nothing through the _id index, so the source collection isn't scanned
+            {'$match': {'_id': {'$in': []}}},
+            {'$unionWith': {'coll': rollup.collection, 'pipeline': [{'$project': finalize_partials(rollup.group)}]}},
+        ] + tail
+        age = time.time() - rollup.refreshed_at
+        lag = f", without the last {self.safety_lag:.0f}s of inserts" \
+            if isinstance(rollup.high_water, ObjectId) and self.safety_lag > 0 else ""
+        return rewritten, f"Read the grouped result from rollup {rollup.collection} (refreshed {age:.0f}s ago{lag})"
+
+    # Materialization
+
+    def _database(self, namespace: str):
+        with self._lock:
+            return self._databases.get(namespace.split(".", 1)[0])
+
+    def materialize(self, namespace: str, head: List[Dict[str, Any]]) -> Optional[Rollup]:
+        """Create a rollup for a pipeline head and build it in full"""
+        db = self._database(namespace)
+        if db is None:
+            return None
+        key = rollup_key(namespace, head)
+        source = namespace.split(".", 1)[1]
+        rollup = Rollup(key, namespace, head, collection=f"rollup_{source}_{key}")
+        self.refresh(rollup, full=True)
+        with self._lock:
+            self._rollups[key] = rollup
+            self._candidates.pop(key, None)
+            self._runs.pop(key, None)
+        self._watch(rollup)
+        return rollup
+
+    def refresh(self, rollup: Rollup, full: bool = False):
+        """Bring a rollup up to date: incrementally past its high-water mark, or rebuilt in full"""
+        db = self._database(rollup.namespace)
+        if db is None:
+            return
+        source = db[rollup.source]
+        latest = source.find_one({}, projection={"_id": 1}, sort=[("_id", -1)])
+        started = time.time()
+        # Stop short of the last few seconds, where other clients' ObjectIds may still arrive
+        high_water = safe_high_water(latest["_id"], self.safety_lag, started) if latest else None
+
+        incremental = (
+            not full and rollup.high_water is not None and _ordered_id(rollup.high_water)
+            and high_water is not None and type(high_water) is type(rollup.high_water)
+        )
+        if incremental:
+            # The mark never moves back, so no window is aggregated twice
+            if high_water > rollup.high_water:
+                window = {'$match': {'_id': {'$gt': rollup.high_water, '$lte': high_water}}}
+                source.aggregate([window] + rollup.head[:-1] + [
+                    {'$group': partial_group(rollup.group)},
+                    {'$merge': {
+                        'into': rollup.collection, 'on': '_id',
+                        'whenMatched': [{'$set': combine_partials(rollup.group)}],
+                        'whenNotMatched': 'insert',
+                    }},
+                ])
+        else:
+            # Replace every group, then drop the ones that no longer have documents. Documents
+            # inserted while this runs are left to the next incremental pass.
+            bound = [{'$match': {'_id': {'$lte': high_water}}}] if _ordered_id(high_water) else []
+            source.aggregate(bound + rollup.head[:-1] + [
+                {'$group': partial_group(rollup.group)},
+                {'$set': {'_refreshed_at': started}},
+                {'$merge': {'into': rollup.collection, 'on': '_id', 'whenMatched': 'replace',
+                            'whenNotMatched': 'insert'}},
+            ], allowDiskUse=True)
+            db[rollup.collection].delete_many({'_refreshed_at': {'$ne': started}})
+            rollup.full_refreshed_at = started
+
+        if not incremental or high_water > rollup.high_water:
+            rollup.high_water = high_water
+        rollup.refreshed_at = started
+        rollup.pending = None
+        db[self.meta_collection].replace_one({'_id': rollup.key}, rollup.to_document(), upsert=True)
+
+    def drop(self, key: str):
+        """Remove a rollup and its collection"""
+        with self._lock:
+            rollup = self._rollups.pop(key, None)
+        if rollup is None:
+            return
+        db = self._database(rollup.namespace)
+        if db is not None:
+            db[rollup.collection].drop()
+            db[self.meta_collection].delete_one({'_id': key})
+
+    def _watch(self, rollup: Rollup):
+        """Schedule refreshes from the source's change stream (replica sets only)"""
+        if not self.change_streams:
+            return
+        with self._lock:
+            thread = self._watchers.get(rollup.namespace)
+            if thread is not None and thread.is_alive():
+                return
+        db = self._database(rollup.namespace)
+        try:
+            stream = db[rollup.source].watch(
+                [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+            )
+        except Exception:
+            # Standalone servers: the scheduled refresh still applies
+            return
+
+        def run():
+            try:
+                with stream:
+                    for change in stream:
+                        kind = "incremental" if change["operationType"] == "insert" else "full"
+                        with self._lock:
+                            for other in self._rollups.values():
+                                if other.namespace == rollup.namespace and other.pending != "full":
+                                    other.pending = kind
+                        self._wake.set()
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._watchers.pop(rollup.namespace, None)
+
+        thread = threading.Thread(target=run, name=f"rollup-watch-{rollup.namespace}", daemon=True)
+        with self._lock:
+            self._watchers[rollup.namespace] = thread
+        thread.start()
+
+    def _due(self, rollup: Rollup, now: float) -> Optional[str]:
+        """Refresh a rollup needs now: "full", "incremental" or None"""
+        if rollup.full_refreshed_at is None or now - rollup.full_refreshed_at >= self.full_refresh_interval \
+                or rollup.pending == "full":
+            return "full"
+        if rollup.pending == "incremental" or now - (rollup.refreshed_at or 0) >= self.refresh_interval:
+            return "incremental"
+        return None
+
+    def run_once(self):
+        """Materialize new candidates and refresh the rollups that are due"""
+        with self._lock:
+            candidates = list(self._candidates.values())
+            databases = list(self._databases.items())
+        for database, db in databases:
+            self._load_definitions(database, db)
+        for namespace, head in candidates:
+            try:
+                self.materialize(namespace, head)
+            except Exception:
+                logger.exception("Could not materialize a rollup for %s", namespace)
+                with self._lock:
+                    self._candidates.pop(rollup_key(namespace, head), None)
+
+        now = time.time()
+        with self._lock:
+            rollups = list(self._rollups.values())
+        for rollup in rollups:
+            due = self._due(rollup, now)
+            if due is None:
+                continue
+            try:
+                self.refresh(rollup, full=due == "full")
+                self._watch(rollup)
+            except Exception:
+                logger.exception("Could not refresh rollup %s", rollup.collection)
+
+    def _loop(self):
+        while True:
+            self._wake.wait(timeout=self.refresh_interval)
+            self._wake.clear()
+            self.run_once()
+
+    def report(self, namespace_prefix: str = "") -> List[Dict[str, Any]]:
+        """Rollups with their age and how often they've been used"""
+        now = time.time()
+        with self._lock:
+            rollups = list(self._rollups.values())
+        return [
+            {
+                "collection": rollup.source,
+                "rollup": rollup.collection,
+                "age_s": round(now - rollup.refreshed_at) if rollup.refreshed_at else None,
+                "fresh": self.is_fresh(rollup),
+                "hits": rollup.hits,
+            }
+            for rollup in rollups if rollup.namespace.startswith(namespace_prefix)
+        ]
+
+# Create singleton instance
+rollup_manager = RollupManager(
+    enabled=os.getenv("ROLLUPS", "0") == "1",
+    min_runs=int(os.getenv("ROLLUP_MIN_RUNS", "5")),
+    window=float(os.getenv("ROLLUP_WINDOW", "3600")),
+    max_staleness=float(os.getenv("ROLLUP_MAX_STALENESS", "300")),
+    refresh_interval=float(os.getenv("ROLLUP_REFRESH_INTERVAL", "60")),
+    full_refresh_interval=float(os.getenv("ROLLUP_FULL_REFRESH_INTERVAL", "3600")),
+    max_rollups=int(os.getenv("ROLLUP_MAX", "20")),
+    change_streams=os.getenv("ROLLUP_CHANGE_STREAMS", "0") == "1",
+    safety_lag=float(os.getenv("ROLLUP_SAFETY_LAG", "5"))
+)
@@ -1,73 +1,369 @@
-from typing import Dict, List, Set, Any
+import os
+import time
+import sqlite3
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from collections import Counter
+from typing import Dict, Set, Any, Optional, Callable
+
 import streamlit as st
+from bson import ObjectId, json_util
+from dotenv import load_dotenv
+
 from .mongo_connection import mongo_connection
+from .hyperloglog import HyperLogLog
+
+# Load environment variables
+load_dotenv()
+
+# Nested documents deeper than this are reported as plain objects
+MAX_NESTING_DEPTH = 5
+# Array elements inspected for nested document fields
+MAX_ARRAY_ELEMENTS = 10
 
-def detect_field_type(values: List[Any]) -> str:
-    """Detect the type of field based on its values"""
-    # Remove None values
-    values = [v for v in values if v is not None]
-    if not values:
-        return "unknown"
-    
-    if all(isinstance(v, int) for v in values):
+def value_type(value: Any) -> str:
+    """Type name of a single BSON value"""
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
         return "integer"
-    elif all(isinstance(v, float) for v in values):
+    if isinstance(value, float):
         return "float"
-    elif all(isinstance(v, (int, float)) for v in values):
-        return "number"
-    elif all(isinstance(v, str) for v in values):
+    if isinstance(value, str):
         return "string"
-    elif all(isinstance(v, bool) for v in values):
-        return "boolean"
-    elif all(isinstance(v, list) for v in values):
+    if isinstance(value, list):
         return "array"
-    elif all(isinstance(v, dict) for v in values):
+    if isinstance(value, dict):
         return "object"
-    else:
+    if isinstance(value, datetime.datetime):
+        return "date"
+    if isinstance(value, ObjectId):
+        return "objectId"
+    return type(value).__name__
+
+class FieldStats:
+    """Running statistics for one (possibly dotted) field path"""
+
+    def __init__(self):
+        self.present = 0
+        self.nulls = 0
+        self.types = Counter()
+        self.distinct = HyperLogLog()
+
+    def add(self, value: Any, new_document: bool = True):
+        """Record one value; `new_document` is False for further values from the same document's arrays"""
+        if new_document:
+            self.present += 1
+        kind = value_type(value)
+        self.types[kind] += 1
+        if value is None:
+            self.nulls += 1
+        elif not isinstance(value, (dict, list)):
+            self.distinct.add(value)
+
+    def merge(self, other: "FieldStats"):
+        self.present += other.present
+        self.nulls += other.nulls
+        self.types.update(other.types)
+        self.distinct.merge(other.distinct)
+
+    def field_type(self) -> str:
+        """Collapse the type histogram into a single type name"""
+        kinds = {k for k in self.types if k != "null"}
+        if not kinds:
+            return "unknown"
+        if len(kinds) == 1:
+            return next(iter(kinds))
+        if kinds == {"integer", "float"}:
+            return "number"
         return "mixed"
 
-def detect_collection_schema(collection_name: str, sample_size: int = 100) -> Dict[str, str]:
-    """Detect schema for a collection based on sampling documents"""
-    # Get a sample of documents
-    collection = mongo_connection.get_collection(collection_name)
+    def summary(self, documents: int) -> Dict[str, Any]:
+        return {
+            "type": self.field_type(),
+            "types": dict(self.types),
+            "presence": self.present / documents if documents else 0.0,
+            "null_rate": self.nulls / sum(self.types.values()) if self.types else 0.0,
+            "cardinality": self.distinct.count(),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "present": self.present,
+            "nulls": self.nulls,
+            "types": dict(self.types),
+            "distinct": self.distinct.to_str(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "FieldStats":
+        stats = cls()
+        stats.present = data["present"]
+        stats.nulls = data["nulls"]
+        stats.types = Counter(data["types"])
+        stats.distinct = HyperLogLog.from_str(data["distinct"])
+        return stats
+
+def collect_field_stats(doc: Dict[str, Any], fields: Dict[str, FieldStats], prefix: str = "", depth: int = 0,
+                        seen: Optional[Set[str]] = None):
+    """Record every (dotted) field path of a document, counting each path present once per document"""
+    if seen is None:
+        seen = set()
+    for key, value in doc.items():
+        if not prefix and key == '_id':
+            continue
+        path = f"{prefix}{key}"
+        stats = fields.get(path)
+        if stats is None:
+            stats = fields[path] = FieldStats()
+        stats.add(value, new_document=path not in seen)
+        seen.add(path)
+
+        if depth >= MAX_NESTING_DEPTH:
+            continue
+        if isinstance(value, dict):
+            collect_field_stats(value, fields, f"{path}.", depth + 1, seen)
+        elif isinstance(value, list):
+            # Dotted paths traverse arrays of documents ("items.sku")
+            for element in value[:MAX_ARRAY_ELEMENTS]:
+                if isinstance(element, dict):
+                    collect_field_stats(element, fields, f"{path}.", depth + 1, seen)
+
+class SchemaProfile:
+    """Per-field statistics for a sampled collection, with the fingerprint it was built at"""
+
+    def __init__(self, fields: Optional[Dict[str, FieldStats]] = None, documents: int = 0,
+                 fingerprint: Optional[str] = None, max_id: Any = None, updated_at: Optional[float] = None):
+        self.fields = fields or {}
+        self.documents = documents
+        self.fingerprint = fingerprint
+        self.max_id = max_id
+        self.updated_at = updated_at or time.time()
+
+    def add_documents(self, docs):
+        """Fold a stream of documents into the profile"""
+        for doc in docs:
+            self.documents += 1
+            collect_field_stats(doc, self.fields)
+
+    def schema(self) -> Dict[str, str]:
+        """Flat field -> type mapping used for prompts"""
+        return {path: stats.field_type() for path, stats in sorted(self.fields.items())}
+
+    def field_summaries(self) -> Dict[str, Dict[str, Any]]:
+        return {path: stats.summary(self.documents) for path, stats in sorted(self.fields.items())}
+
+    def to_json(self) -> str:
+        return json_util.dumps({
+            "fields": {path: stats.to_dict() for path, stats in self.fields.items()},
+            "documents": self.documents,
+            "fingerprint": self.fingerprint,
+            "max_id": self.max_id,
+            "updated_at": self.updated_at,
+        })
+
+    @classmethod
+    def from_json(cls, data: str) -> "SchemaProfile":
+        raw = json_util.loads(data)
+        return cls(
+            fields={path: FieldStats.from_dict(stats) for path, stats in raw["fields"].items()},
+            documents=raw["documents"],
+            fingerprint=raw["fingerprint"],
+            max_id=raw["max_id"],
+            updated_at=raw["updated_at"],
+        )
+
+class SchemaStore:
+    """SQLite persistence for schema profiles, keyed on the cluster-qualified namespace
+    (see MongoDBConnection.cluster_namespace), so same-named databases on different
+    clusters keep separate profiles"""
+
+    def __init__(self, db_path: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._conn = None
+        if db_path:
+            try:
+                directory = os.path.dirname(db_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._conn = sqlite3.connect(db_path, check_same_thread=False)
+                # Replaces the schema_profiles table, which was keyed on (db, collection) only
+                self._conn.execute(
+                    """CREATE TABLE IF NOT EXISTS collection_profiles (
+                        namespace TEXT PRIMARY KEY,
+                        profile TEXT NOT NULL
+                    )"""
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                self._conn = None
+
+    def load(self, namespace: str) -> Optional[SchemaProfile]:
+        if self._conn is None:
+            return None
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT profile FROM collection_profiles WHERE namespace = ?", (namespace,)
+                ).fetchone()
+                return SchemaProfile.from_json(row[0]) if row else None
+            except (sqlite3.Error, ValueError, KeyError):
+                return None
+
+    def save(self, namespace: str, profile: SchemaProfile):
+        if self._conn is None:
+            return
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO collection_profiles VALUES (?, ?)", (namespace, profile.to_json())
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                pass
+
+schema_store = SchemaStore(os.getenv("SCHEMA_CACHE_PATH", ".cache/schema_cache.sqlite3") or None)
+
+DEFAULT_SAMPLE_SIZE = int(os.getenv("SCHEMA_SAMPLE_SIZE", "500"))
+# Profiles older than this are rebuilt from a fresh sample even if only appended to
+SCHEMA_MAX_AGE = float(os.getenv("SCHEMA_MAX_AGE", str(7 * 86400)))
+
+def build_collection_profile(collection_name: str, sample_size: Optional[int] = None,
+                             max_time_ms: Optional[int] = None, connection=None) -> Optional[SchemaProfile]:
+    """Build or incrementally refresh a collection's schema profile.
+
+    Raises on database errors so callers decide how to report them.
+    """
+    connection = connection or mongo_connection
+    sample_size = sample_size or DEFAULT_SAMPLE_SIZE
+    collection = connection.get_collection(collection_name)
     if collection is None:
-        return {}
-    
+        return None
+
+    cache_key = (connection.db.name, collection_name)
+    namespace = connection.cluster_namespace(collection_name)
+    state = connection.get_collection_state(collection_name)
+    fingerprint = f"{state[0]}:{state[1]}" if state else None
+
+    profile = connection.collection_schemas.get(cache_key) or schema_store.load(namespace)
+    if profile is not None and fingerprint is not None and profile.fingerprint == fingerprint:
+        connection.collection_schemas[cache_key] = profile
+        return profile
+
+    options = {"batchSize": min(sample_size, 1000)}
+    if max_time_ms:
+        options["maxTimeMS"] = max_time_ms
+
+    fresh_enough = profile is not None and time.time() - profile.updated_at < SCHEMA_MAX_AGE
+    appended = (
+        fresh_enough and state is not None and profile.max_id is not None and state[1] is not None
+        and type(state[1]) is type(profile.max_id) and state[1] > profile.max_id
+    )
+    if appended:
+        # Only documents inserted since the last profile need to be sampled
+        pipeline = [{"$match": {"_id": {"$gt": profile.max_id}}}, {"$sample": {"size": sample_size}}]
+        profile.add_documents(collection.aggregate(pipeline, **options))
+    else:
+        profile = SchemaProfile(updated_at=time.time())
+        profile.add_documents(collection.aggregate([{"$sample": {"size": sample_size}}], **options))
+
+    profile.fingerprint = fingerprint
+    profile.max_id = state[1] if state else None
+    connection.collection_schemas[cache_key] = profile
+    schema_store.save(namespace, profile)
+    return profile
+
+def get_collection_profile(collection_name: str, sample_size: Optional[int] = None,
+                           connection=None) -> Optional[SchemaProfile]:
+    """Schema profile for a collection, reporting failures in the UI"""
     try:
-        sample_docs = list(collection.find().limit(sample_size))
-        if not sample_docs:
-            return {}
-        
-        # Collect all fields
-        all_fields = set()
-        for doc in sample_docs:
-            all_fields.update(doc.keys())
-        
-        # Remove _id field
-        if '_id' in all_fields:
-            all_fields.remove('_id')
-        
-        # Determine types for each field
-        schema = {}
-        for field in all_fields:
-            values = [doc.get(field) for doc in sample_docs if field in doc]
-            field_type = detect_field_type(values)
-            schema[field] = field_type
-            
-        return schema
-    
+        return build_collection_profile(collection_name, sample_size, connection=connection)
     except Exception as e:
         st.error(f"Failed to detect schema for {collection_name}: {str(e)}")
+        return None
+
+def detect_collection_schema(collection_name: str, sample_size: Optional[int] = None,
+                             connection=None) -> Dict[str, str]:
+    """Detect schema for a collection based on sampling documents"""
+    profile = get_collection_profile(collection_name, sample_size, connection)
+    if profile is None or not profile.documents:
         return {}
+    return profile.schema()
+
+class SchemaCatalog:
+    """Database-wide collection schemas, with the collections that failed to profile"""
+
+    def __init__(self, schemas: Optional[Dict[str, Dict[str, str]]] = None, errors: Optional[Dict[str, str]] = None):
+        self.schemas = schemas or {}
+        self.errors = errors or {}
+
+    def format_for_prompt(self, exclude: Optional[str] = None, max_collections: int = 50,
+                          max_fields: int = 30) -> str:
+        """Compact listing of other collections for cross-collection ($lookup) prompts"""
+        lines = []
+        for name in sorted(self.schemas)[:max_collections]:
+            if name == exclude:
+                continue
+            fields = list(self.schemas[name].items())[:max_fields]
+            lines.append(f"{name}: " + ", ".join(f"{field} ({kind})" for field, kind in fields))
+        return "\n".join(lines)
+
+DISCOVERY_WORKERS = int(os.getenv("SCHEMA_DISCOVERY_WORKERS", "8"))
+DISCOVERY_TIMEOUT = float(os.getenv("SCHEMA_DISCOVERY_TIMEOUT", "30"))
+
+def discover_schema_catalog(max_workers: Optional[int] = None, timeout: Optional[float] = None,
+                            sample_size: Optional[int] = None,
+                            progress_callback: Optional[Callable[[int, int, str], None]] = None,
+                            connection=None) -> SchemaCatalog:
+    """Profile every collection concurrently with bounded parallelism.
+
+    Each collection's sample is limited server-side by maxTimeMS; collections
+    that fail or don't finish in time are recorded in `errors` and the rest
+    are still returned. `progress_callback(done, total, name)` runs on the
+    calling thread, so it may safely update Streamlit elements.
+    """
+    connection = connection or mongo_connection
+    max_workers = max_workers or DISCOVERY_WORKERS
+    timeout = timeout or DISCOVERY_TIMEOUT
+    collections = connection.get_collections()
+    catalog = SchemaCatalog()
+    if not collections:
+        return catalog
+
+    # Enough wall-clock time for every wave of workers to use its full timeout
+    waves = -(-len(collections) // max_workers)
+    overall_timeout = timeout * waves + 5
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="schema-discovery")
+    futures = {
+        executor.submit(build_collection_profile, name, sample_size, int(timeout * 1000), connection): name
+        for name in collections
+    }
+    done = 0
+    try:
+        for future in as_completed(futures, timeout=overall_timeout):
+            name = futures[future]
+            try:
+                profile = future.result()
+                if profile is not None and profile.documents:
+                    catalog.schemas[name] = profile.schema()
+            except Exception as e:
+                catalog.errors[name] = str(e)
+            done += 1
+            if progress_callback:
+                progress_callback(done, len(collections), name)
+    except FutureTimeoutError:
+        for future, name in futures.items():
+            if not future.done():
+                catalog.errors[name] = "timed out"
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return catalog
 
 def get_schema_for_all_collections() -> Dict[str, Dict[str, str]]:
     """Get schema for all collections in the database"""
-    collections = mongo_connection.get_collections()
-    all_schemas = {}
-    
-    for collection_name in collections:
-        schema = detect_collection_schema(collection_name)
-        if schema:
-            all_schemas[collection_name] = schema
-    
-    return all_schemas 
\ No newline at end of file
+    return discover_schema_catalog().schemas
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Any, Callable
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("mongochart_span", default=None)
+
+class Span:
+    """One timed operation within a request trace"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.duration_ms: Optional[float] = None
+        self.status = "ok"
+        self._start = time.perf_counter()
+
+    def set(self, **attributes):
+        """Attach attributes such as row counts, payload bytes or cache hits"""
+        self.attributes.update(attributes)
+
+    def _finish(self, duration_s: Optional[float] = None):
+        self.duration_ms = (time.perf_counter() - self._start if duration_s is None else duration_s) * 1000
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+class Tracer:
+    """Records nested spans per request and keeps the last `history` traces of each kind.
+
+    A trace's kind is the name of its first top-level span, so background
+    work that starts its own traces (live refreshes, approximate refinement,
+    charts rebuilt outside a request) can't push request traces out.
+    Finished traces are appended to a JSONL file when `jsonl_path` is set and
+    re-emitted through OpenTelemetry when `otel` is enabled and the
+    opentelemetry API is installed.
+    """
+
+    def __init__(self, history: int = 50, jsonl_path: Optional[str] = None, otel: bool = False):
+        self.history = history
+        self.jsonl_path = jsonl_path
+        self._traces: "OrderedDict[str, List[Span]]" = OrderedDict()
+        # trace_id -> name of its first finished top-level span, in the order they finished
+        self._roots: Dict[str, str] = {}
+        self._exported: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._otel_tracer = None
+        if otel:
+            try:
+                from opentelemetry import trace as otel_trace
+                self._otel_tracer = otel_trace.get_tracer("mongochart")
+            except ImportError:
+                self._otel_tracer = None
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    def _new_span(self, name: str, trace_id: Optional[str], attributes: Dict[str, Any]) -> Span:
+        parent = _current_span.get()
+        if trace_id is None and parent is not None:
+            return Span(name, parent.trace_id, parent.span_id, attributes)
+        return Span(name, trace_id or uuid.uuid4().hex, None, attributes)
+
+    @contextmanager
+    def span(self, name: str, trace_id: Optional[str] = None, **attributes):
+        """Time a block as a child of the current span (or as a new trace).
+
+        Pass `trace_id` to add a top-level span to an existing trace, e.g. for
+        rendering that happens after the request itself finished.
+        """
+        span = self._new_span(name, trace_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            span._finish()
+            self._store(span)
+
+    def record_span(self, name: str, duration_s: float, **attributes) -> Span:
+        """Add an already-measured span under the current span (e.g. time spent inside a generator)"""
+        span = self._new_span(name, None, attributes)
+        span._finish(duration_s)
+        span.start_time = time.time() - duration_s
+        self._store(span)
+        return span
+
+    def _store(self, span: Span):
+        pending = None
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                # Traces still waiting for their top-level span have their own limit
+                unfinished = [trace_id for trace_id in self._traces if trace_id not in self._roots]
+                for evicted in unfinished[:max(len(unfinished) - self.history, 0)]:
+                    self._evict(evicted)
+            spans.append(span)
+            if span.parent_id is None:
+                # A finished top-level span flushes everything recorded since the last flush
+                done = self._exported.get(span.trace_id, 0)
+                pending = spans[done:]
+                self._exported[span.trace_id] = len(spans)
+                if span.trace_id not in self._roots:
+                    self._roots[span.trace_id] = span.name
+                    same_kind = [trace_id for trace_id, name in self._roots.items() if name == span.name]
+                    for evicted in same_kind[:max(len(same_kind) - self.history, 0)]:
+                        self._evict(evicted)
+        if pending:
+            self._export(pending)
+
+    def _evict(self, trace_id: str):
+        self._traces.pop(trace_id, None)
+        self._roots.pop(trace_id, None)
+        self._exported.pop(trace_id, None)
+
+    def _export(self, spans: List[Span]):
+        if self.jsonl_path:
+            try:
+                directory = os.path.dirname(self.jsonl_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.jsonl_path, "a") as f:
+                    for span in spans:
+                        f.write(json.dumps(span.to_dict(), default=str) + "\n")
+            except OSError:
+                pass
+        if self._otel_tracer is not None:
+            self._export_otel(spans)
+
+    def _export_otel(self, spans: List[Span]):
+        from opentelemetry import trace as otel_trace
+        started = {}
+        # Parents start before their children
+        for span in sorted(spans, key=lambda s: s.start_time):
+            parent = started.get(span.parent_id)
+            context = otel_trace.set_span_in_context(parent) if parent is not None else None
+            attributes = {
+                k: v for k, v in span.attributes.items() if isinstance(v, (str, bool, int, float))
+            }
+            start_ns = int(span.start_time * 1e9)
+            otel_span = self._otel_tracer.start_span(
+                span.name, context=context, start_time=start_ns, attributes=attributes
+            )
+            otel_span.end(end_time=start_ns + int((span.duration_ms or 0) * 1e6))
+            started[span.span_id] = otel_span
+
+    def traces(self, limit: Optional[int] = None, root: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Most recent complete traces, newest first (optionally only those whose root span is `root`)"""
+        with self._lock:
+            items = [(trace_id, list(spans)) for trace_id, spans in self._traces.items()]
+        result = []
+        for trace_id, spans in reversed(items):
+            roots = [s for s in spans if s.parent_id is None]
+            if not roots:
+                continue
+            first = roots[0]
+            if root is not None and first.name != root:
+                continue
+            result.append({
+                "trace_id": trace_id,
+                "name": first.name,
+                "start_time": first.start_time,
+                "duration_ms": sum(r.duration_ms or 0 for r in roots),
+                "attributes": first.attributes,
+                "spans": [s.to_dict() for s in spans],
+            })
+            if limit and len(result) >= limit:
+                break
+        return result
+
+    def stage_breakdown(self, limit: int = 20, root: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Self time (ms) per span name for each of the last `limit` traces"""
+        rows = []
+        for trace in self.traces(limit, root):
+            child_time: Dict[str, float] = {}
+            for span in trace["spans"]:
+                if span["parent_id"]:
+                    child_time[span["parent_id"]] = child_time.get(span["parent_id"], 0.0) + span["duration_ms"]
+            row: Dict[str, Any] = {"query": trace["attributes"].get("query", trace["name"]),
+                                   "total_ms": round(trace["duration_ms"], 1)}
+            for span in trace["spans"]:
+                self_ms = max(span["duration_ms"] - child_time.get(span["span_id"], 0.0), 0.0)
+                row[span["name"]] = round(row.get(span["name"], 0.0) + self_ms, 1)
+            rows.append(row)
+        return rows
+
+    def percentiles(self, limit: int = 20, root: Optional[str] = None) -> List[Dict[str, Any]]:
+        """p50/p95 self time per span name across the last `limit` traces"""
+        import numpy as np
+        
+        samples: Dict[str, List[float]] = {}
+        for row in self.stage_breakdown(limit, root):
+            for name, value in row.items():
+                if name != "query":
+                    samples.setdefault(name, []).append(value)
+        return [
+            {
+                "stage": name,
+                "count": len(values),
+                "p50_ms": round(float(np.percentile(values, 50)), 1),
+                "p95_ms": round(float(np.percentile(values, 95)), 1),
+            }
+            for name, values in samples.items()
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+            self._roots.clear()
+            self._exported.clear()
+
+# Create singleton instance
+tracer = Tracer(
+    history=int(os.getenv("TRACE_HISTORY", "50")),
+    jsonl_path=os.getenv("TRACE_JSONL_PATH", "") or None,
+    otel=os.getenv("TRACE_OTEL", "0") == "1"
+)
+
+def traced(name: str) -> Callable:
+    """Decorator recording each call as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def set_attributes(**attributes):
+    """Attach attributes to the current span, if there is one"""
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attributes)
+
+def run_in_context(func: Callable, *args) -> Callable[[], Any]:
+    """Bind a call to the current context so spans opened in a worker thread nest correctly"""
+    return functools.partial(contextvars.copy_context().run, func, *args)
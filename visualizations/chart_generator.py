@@ -1,9 +1,22 @@
-from typing import Dict, List, Optional, Any
+import os
+from typing import Dict, List, Optional, Any, Iterable, Union
 import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from models.query_parser import MongoQueryIntent
+from utils.tracing import traced, set_attributes
+from .downsampling import reduce_points, point_budget
+from .chart_selector import ChartSelector
+from .figure_encoding import compact_figure, render_mode
+from .figure_cache import figure_cache, figure_key
+
+# Chart types generate_chart can draw; anything else is chosen by ChartSelector
+CHART_TYPES = ('bar', 'line', 'scatter', 'pie', 'histogram')
+# Encode figure data compactly (typed arrays, dictionary-encoded labels) before it's sent to the browser
+COMPACT_CHARTS = os.getenv("CHART_COMPACT", "1") == "1"
+# A column named <column>__error holds the confidence interval half-width of an estimated <column>
+ERROR_SUFFIX = "__error"
 
 class ChartGenerator:
     """Generate visualizations based on MongoDB query results and intent"""
@@ -14,30 +27,89 @@ class ChartGenerator:
         if not data:
             return pd.DataFrame()
             
-        # Handle _id field from aggregation results
-        for item in data:
-            if '_id' in item and isinstance(item['_id'], (dict, list)):
-                # Flatten the _id field if it's a complex object
-                for key, value in item['_id'].items() if isinstance(item['_id'], dict) else enumerate(item['_id']):
-                    item[f"_id_{key}"] = value
-                del item['_id']
-            
-        return pd.DataFrame(data)
+        # Handle _id field from aggregation results. The frame is built first
+        # so rows shared with the result cache are never modified.
+        return ChartGenerator.flatten_id_columns(pd.DataFrame(data))
     
     @staticmethod
-    def generate_chart(data: List[Dict[str, Any]], intent: MongoQueryIntent) -> Optional[go.Figure]:
-        """Generate a chart based on the data and intent"""
-        if not data:
-            st.warning("No data available to visualize.")
-            return None
-            
-        # Convert to DataFrame
-        df = ChartGenerator.convert_to_dataframe(data)
+    def flatten_id_columns(df: pd.DataFrame) -> pd.DataFrame:
+        """Expand a compound `_id` column into `_id_<key>` columns"""
+        if '_id' not in df.columns or df['_id'].dtype != object:
+            return df
+        
+        ids = df['_id']
+        is_complex = ids.map(lambda v: isinstance(v, (dict, list))).to_numpy(dtype=bool)
+        if not is_complex.any():
+            return df
+        
+        complex_ids = ids[is_complex]
+        expanded = pd.DataFrame(
+            [v if isinstance(v, dict) else dict(enumerate(v)) for v in complex_ids],
+            index=complex_ids.index
+        )
+        expanded.columns = [f"_id_{key}" for key in expanded.columns]
         
+        flattened = df.drop(columns='_id')
+        if not is_complex.all():
+            # Keep scalar ids for rows that weren't compound
+            flattened['_id'] = ids.where(~is_complex)
+        return pd.concat([flattened, expanded.reindex(ids.index)], axis=1)
+    
+    @staticmethod
+    def batches_to_dataframe(batches: Iterable[List[Dict[str, Any]]]) -> pd.DataFrame:
+        """Build a DataFrame column by column from streamed cursor batches"""
+        columns: Dict[str, List[Any]] = {}
+        rows = 0
+        
+        for batch in batches:
+            for item in batch:
+                for key, value in item.items():
+                    column = columns.get(key)
+                    if column is None:
+                        # New field: back-fill earlier rows
+                        column = columns[key] = [None] * rows
+                    column.append(value)
+                rows += 1
+                
+                # Pad fields this document didn't have
+                if len(item) < len(columns):
+                    for column in columns.values():
+                        if len(column) < rows:
+                            column.append(None)
+        
+        return ChartGenerator.flatten_id_columns(pd.DataFrame(columns))
+    
+    @staticmethod
+    def columnar_to_dataframe(table: Any) -> pd.DataFrame:
+        """Convert an Arrow table from the columnar fetch path to a DataFrame"""
+        if table is None or table.num_rows == 0:
+            return pd.DataFrame()
+        
+        import pyarrow as pa
+        
+        # Struct-typed _id columns are flattened inside Arrow ("_id.key" -> "_id_key")
+        if '_id' in table.column_names and pa.types.is_struct(table.schema.field('_id').type):
+            table = table.flatten()
+            table = table.rename_columns([
+                f"_id_{name[4:]}" if name.startswith('_id.') else name for name in table.column_names
+            ])
+        
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
+        return ChartGenerator.flatten_id_columns(df)
+    
+    @staticmethod
+    def resolve_axes(df: pd.DataFrame, intent: MongoQueryIntent):
+        """Result columns for the intent's x and y axes"""
         # Determine x and y axis fields
         x_field = intent.x_axis
         y_field = intent.y_axis
         
+        # Dotted paths come back under flat names from binned/sampled pipelines
+        if x_field and x_field not in df.columns and x_field.replace('.', '_') in df.columns:
+            x_field = x_field.replace('.', '_')
+        if y_field and y_field not in df.columns and y_field.replace('.', '_') in df.columns:
+            y_field = y_field.replace('.', '_')
+        
         # Handle _id renaming from aggregation
         if x_field == '_id' and '_id' not in df.columns:
             # Look for _id_0, _id_field, etc.
@@ -48,6 +120,35 @@ class ChartGenerator:
         # If no y_field is specified but there's a 'count', use that
         if (not y_field or y_field not in df.columns) and 'count' in df.columns:
             y_field = 'count'
+        return x_field, y_field
+    
+    @staticmethod
+    @traced("chart.build")
+    def generate_chart(data: Union[List[Dict[str, Any]], pd.DataFrame], intent: MongoQueryIntent,
+                       exact: bool = False,
+                       field_stats: Optional[Dict[str, Dict[str, Any]]] = None,
+                       compact: bool = COMPACT_CHARTS, use_cache: bool = True) -> Optional[go.Figure]:
+        """Generate a chart based on the data (raw results or a prepared DataFrame) and intent.
+        
+        Line and scatter charts above their point budget are downsampled unless `exact` is set,
+        and drawn with WebGL above WEBGL_POINT_THRESHOLD points.
+        When the intent's chart type isn't one we can draw, ChartSelector picks one, using
+        `field_stats` (schema statistics per result column) where available.
+        Estimated y values with an error column (see ERROR_SUFFIX) get error bars.
+        With `compact`, the figure's data is re-encoded to serialize compactly (see
+        figure_encoding). Figures are cached by result content and chart options.
+        """
+        if data is None or len(data) == 0:
+            st.warning("No data available to visualize.")
+            return None
+            
+        # Convert to DataFrame
+        if isinstance(data, pd.DataFrame):
+            df = data
+        else:
+            df = ChartGenerator.convert_to_dataframe(data)
+        
+        x_field, y_field = ChartGenerator.resolve_axes(df, intent)
         
         # Ensure we have the necessary fields
         if x_field not in df.columns:
@@ -58,24 +159,51 @@ class ChartGenerator:
             st.error(f"Y-axis field '{y_field}' not found in the results.")
             return None
         
+        chart_type = intent.chart_type
+        if chart_type not in CHART_TYPES:
+            chart_type = ChartSelector.suggest_chart_type(df, x_field, y_field, field_stats)
+        
+        # Same results drawn the same way: reuse the serialized figure
+        title = intent.title or f"{y_field or 'Value'} by {x_field}"
+        use_cache = use_cache and figure_cache.enabled
+        if use_cache:
+            cache_key = figure_key(df, chart_type=chart_type, x=x_field, y=y_field, title=title,
+                                   exact=exact, compact=compact)
+            cached = figure_cache.get(cache_key)
+            set_attributes(cache_hit=cached is not None)
+            if cached is not None:
+                set_attributes(chart_type=chart_type, rows=len(df))
+                return cached
+        
+        # Keep browser payloads bounded for large line/scatter results
+        total_points = len(df)
+        budget = point_budget(chart_type)
+        if not exact and budget and total_points > budget:
+            df = reduce_points(df, x_field, y_field, chart_type, budget)
+        set_attributes(chart_type=chart_type, rows=total_points, points=len(df))
+        
+        # Confidence intervals of approximate results
+        error_field = f"{y_field}{ERROR_SUFFIX}" if y_field and f"{y_field}{ERROR_SUFFIX}" in df.columns else None
+        
         # Generate the appropriate chart
         fig = None
-        title = intent.title or f"{y_field or 'Value'} by {x_field}"
         
         try:
-            if intent.chart_type == 'bar':
-                fig = px.bar(df, x=x_field, y=y_field, title=title)
-            elif intent.chart_type == 'line':
-                fig = px.line(df, x=x_field, y=y_field, title=title)
-            elif intent.chart_type == 'scatter':
-                fig = px.scatter(df, x=x_field, y=y_field, title=title)
-            elif intent.chart_type == 'pie':
+            if chart_type == 'bar':
+                fig = px.bar(df, x=x_field, y=y_field, title=title, error_y=error_field)
+            elif chart_type == 'line':
+                fig = px.line(df, x=x_field, y=y_field, title=title, render_mode=render_mode(len(df)),
+                              error_y=error_field)
+            elif chart_type == 'scatter':
+                fig = px.scatter(df, x=x_field, y=y_field, title=title, render_mode=render_mode(len(df)),
+                                 error_y=error_field)
+            elif chart_type == 'pie':
                 fig = px.pie(df, names=x_field, values=y_field, title=title)
-            elif intent.chart_type == 'histogram':
+            elif chart_type == 'histogram':
                 fig = px.histogram(df, x=x_field, title=title)
             else:
                 # Default to bar chart
-                fig = px.bar(df, x=x_field, y=y_field, title=title)
+                fig = px.bar(df, x=x_field, y=y_field, title=title, error_y=error_field)
                 
             # Customize layout
             fig.update_layout(
@@ -83,9 +211,21 @@ class ChartGenerator:
                 yaxis_title=y_field or "Count",
                 template="plotly_white"
             )
+            
+            if len(df) < total_points:
+                fig.add_annotation(
+                    text=f"Downsampled to {len(df):,} of {total_points:,} points",
+                    xref="paper", yref="paper", x=1, y=1.05,
+                    showarrow=False, font=dict(size=10)
+                )
+            
+            if compact:
+                fig = compact_figure(fig)
                 
         except Exception as e:
             st.error(f"Failed to generate chart: {str(e)}")
             return None
-            
+        
+        if use_cache:
+            set_attributes(payload_bytes=figure_cache.put(cache_key, fig))
         return fig 
\ No newline at end of file
@@ -1,72 +1,255 @@
-from typing import Dict, List, Optional, Any, Tuple
+import os
+import re
+import datetime
+from collections import Counter
+from typing import Dict, List, Optional, Any, Tuple, Union
+import numpy as np
 import pandas as pd
 
+# Values inspected per column; inference cost does not grow with the result size
+SAMPLE_SIZE = int(os.getenv("CHART_SELECTOR_SAMPLE", "1000"))
+# Numeric columns with at most this many distinct values are treated as categories
+MAX_NUMERIC_CATEGORIES = 20
+# Share of sampled strings that must parse for a column to count as dates
+DATE_MATCH_RATIO = 0.95
+
+# Recognised string date layouts, most specific first: (pattern, strptime format)
+_DATE_FORMATS = [
+    (r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?", "ISO8601"),
+    (r"\d{4}-\d{2}-\d{2}", "%Y-%m-%d"),
+    (r"\d{4}-\d{2}", "%Y-%m"),
+    (r"\d{4}/\d{2}/\d{2}", "%Y/%m/%d"),
+    (r"\d{1,2}/\d{1,2}/\d{4}", "%m/%d/%Y"),
+    (r"\d{1,2}/\d{1,2}/\d{4}", "%d/%m/%Y"),
+    (r"\d{1,2}\.\d{1,2}\.\d{4}", "%d.%m.%Y"),
+]
+_DATE_PATTERNS = [(re.compile(pattern), fmt) for pattern, fmt in _DATE_FORMATS]
+
+# Schema type names (utils.schema_detection) -> field kind
+_SCHEMA_KINDS = {
+    "integer": "numerical", "float": "numerical", "number": "numerical",
+    "date": "temporal",
+    "boolean": "categorical", "objectId": "categorical", "mixed": "categorical",
+}
+# Pipeline expressions whose output is a date bucket
+_DATE_OPERATORS = {"$dateTrunc", "$dateToString", "$dateFromParts", "$dateFromString", "$toDate"}
+
+Data = Union[List[Dict[str, Any]], pd.DataFrame]
+
 class ChartSelector:
-    """Utility to select appropriate chart types based on data structure"""
-    
+    """Utility to select appropriate chart types based on data structure.
+
+    Field types are inferred from a bounded, evenly spaced sample of the
+    results (or taken from schema profile statistics when the caller has
+    them), so ranking costs the same for ten rows or ten million.
+    """
+
     @staticmethod
-    def suggest_chart_type(data: List[Dict[str, Any]], x_field: str, y_field: Optional[str] = None) -> str:
-        """Suggest an appropriate chart type based on the data structure"""
-        if not data:
-            return 'bar'  # Default
-            
-        # Convert to DataFrame for easier analysis
-        df = pd.DataFrame(data)
-        
-        # Handle missing fields
-        if x_field not in df.columns:
-            return 'bar'
-            
-        if y_field and y_field not in df.columns:
-            y_field = None
-            
-        # Check x-axis cardinality
-        x_cardinality = len(df[x_field].unique())
-        
-        # Analyze x field type
-        x_type = ChartSelector.infer_field_type(df[x_field])
-        
-        # Analyze y field type if available
-        y_type = None
-        if y_field:
-            y_type = ChartSelector.infer_field_type(df[y_field])
-        
-        # Decision logic for chart type
-        if x_type == 'categorical':
-            if x_cardinality <= 10:
-                return 'pie' if y_field else 'bar'
-            else:
-                return 'bar'
-                
-        elif x_type == 'temporal':
-            return 'line'
-            
-        elif x_type == 'numerical':
-            if y_field and y_type == 'numerical':
-                return 'scatter'
-            else:
-                return 'histogram'
-                
-        # Default
-        return 'bar'
-    
+    def _positions(total: int, size: int = SAMPLE_SIZE) -> np.ndarray:
+        """Evenly spaced row positions: one per stratum of the result, first and last rows included"""
+        if total <= size:
+            return np.arange(total)
+        return np.unique(np.linspace(0, total - 1, size).round().astype(np.int64))
+
+    @staticmethod
+    def sample_column(data: Data, field: str, size: int = SAMPLE_SIZE) -> Optional[pd.Series]:
+        """A stratified sample of one column, or None if the field isn't in the results"""
+        if isinstance(data, pd.DataFrame):
+            if field not in data.columns:
+                return None
+            column = data[field]
+            return column.iloc[ChartSelector._positions(len(column), size)]
+
+        rows = [data[i] for i in ChartSelector._positions(len(data), size)]
+        if not any(field in row for row in rows):
+            return None
+        return pd.Series([row.get(field) for row in rows])
+
+    @staticmethod
+    def estimate_distinct(sample: pd.Series, total: int) -> int:
+        """Distinct values in the full column, estimated from the sample (GEE estimator)"""
+        values = sample.dropna()
+        if values.empty:
+            return 0
+        try:
+            frequencies = values.value_counts(sort=False).to_numpy()
+        except TypeError:
+            # Unhashable values (documents, arrays)
+            frequencies = np.array(list(Counter(map(repr, values)).values()))
+        if total <= len(sample):
+            return int(len(frequencies))
+        singletons = int((frequencies == 1).sum())
+        repeated = int((frequencies > 1).sum())
+        # Values seen once stand in for the unseen ones, scaled by sqrt(N / n)
+        return int(min(round(np.sqrt(total / len(sample)) * singletons + repeated), total))
+
+    @staticmethod
+    def sniff_date_format(strings: pd.Series) -> Optional[str]:
+        """The date layout (strptime format or "ISO8601") most of the strings follow, if any"""
+        strings = strings.dropna()
+        if strings.empty:
+            return None
+        first = strings.iloc[0]
+        for pattern, fmt in _DATE_PATTERNS:
+            # Cheap check on one value before the vectorized pass over the sample
+            if not pattern.fullmatch(first):
+                continue
+            if strings.str.fullmatch(pattern).mean() < DATE_MATCH_RATIO:
+                continue
+            parsed = pd.to_datetime(strings, format=fmt, errors="coerce")
+            if parsed.notna().mean() >= DATE_MATCH_RATIO:
+                return fmt
+        return None
+
     @staticmethod
     def infer_field_type(series: pd.Series) -> str:
         """Infer the type of a field (numerical, categorical, temporal)"""
+        if len(series) > SAMPLE_SIZE:
+            series = series.iloc[ChartSelector._positions(len(series))]
+
+        if pd.api.types.is_bool_dtype(series):
+            return 'categorical'
+
         if pd.api.types.is_numeric_dtype(series):
             # Check if it appears to be categorical despite being numeric
-            if len(series.unique()) <= 20:
+            if series.nunique() <= MAX_NUMERIC_CATEGORIES:
                 return 'categorical'
             return 'numerical'
-            
-        elif pd.api.types.is_datetime64_dtype(series):
+
+        if pd.api.types.is_datetime64_any_dtype(series):
             return 'temporal'
-            
-        # Try to convert to datetime
-        try:
-            pd.to_datetime(series)
+
+        values = series.dropna()
+        if values.empty:
+            return 'categorical'
+        kinds = set(values.map(type))
+        if all(issubclass(kind, (datetime.date, pd.Timestamp, np.datetime64)) for kind in kinds):
             return 'temporal'
-        except:
-            pass
-            
-        return 'categorical' 
\ No newline at end of file
+        if kinds <= {str}:
+            return 'temporal' if ChartSelector.sniff_date_format(values.astype(str)) else 'categorical'
+        if all(issubclass(kind, (int, float, np.number)) and not issubclass(kind, bool) for kind in kinds):
+            return 'numerical' if values.nunique() > MAX_NUMERIC_CATEGORIES else 'categorical'
+        return 'categorical'
+
+    @staticmethod
+    def result_field_stats(pipeline: List[Dict[str, Any]], summaries: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Map schema profile field summaries onto a pipeline's output columns.
+
+        `summaries` is SchemaProfile.field_summaries(). Only columns that are
+        a plain copy of a source field (or a date bucket of one) are mapped;
+        computed columns such as accumulators are left to sampling.
+        """
+        columns: Dict[str, Optional[Dict[str, Any]]] = {field: stats for field, stats in summaries.items()}
+
+        def source(expression: Any) -> Optional[Dict[str, Any]]:
+            if isinstance(expression, str) and expression.startswith("$") and not expression.startswith("$$"):
+                return columns.get(expression[1:])
+            if isinstance(expression, dict) and len(expression) == 1:
+                operator, argument = next(iter(expression.items()))
+                if operator in _DATE_OPERATORS:
+                    stats = source(argument.get("date") if isinstance(argument, dict) else argument)
+                    return {**(stats or {}), "type": "date"}
+            return None
+
+        for stage in pipeline:
+            if not isinstance(stage, dict) or len(stage) != 1:
+                return {}
+            operator, spec = next(iter(stage.items()))
+            if operator == "$group" and isinstance(spec, dict):
+                columns = {"_id": source(spec.get("_id"))}
+            elif operator in ("$project", "$addFields", "$set") and isinstance(spec, dict):
+                computed = {
+                    name: (columns.get(name) if value in (1, True) else source(value))
+                    for name, value in spec.items() if value not in (0, False)
+                }
+                inclusion = operator == "$project" and any(value not in (0, False) for value in spec.values())
+                if inclusion:
+                    if "_id" not in spec:
+                        computed["_id"] = columns.get("_id")
+                    columns = computed
+                else:
+                    columns = {name: stats for name, stats in columns.items() if spec.get(name) not in (0, False)}
+                    columns.update(computed)
+            elif operator in ("$match", "$sort", "$limit", "$skip", "$sample", "$unwind"):
+                continue
+            else:
+                # Reshaping stages ($lookup, $facet, $bucket, ...) aren't tracked
+                return {}
+        return {name: stats for name, stats in columns.items() if stats}
+
+    @staticmethod
+    def describe_field(data: Data, field: str, stats: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Kind and (approximate) distinct count of a result column, or None if it's missing.
+
+        Schema statistics answer without touching the data; string columns
+        still get a sampled date-format check since the schema can't tell
+        "2024-01-31" from "north".
+        """
+        total = len(data)
+        if stats and stats.get("type") in _SCHEMA_KINDS:
+            kind = _SCHEMA_KINDS[stats["type"]]
+            distinct = min(int(stats.get("cardinality") or total), total)
+            if kind == "numerical" and distinct <= MAX_NUMERIC_CATEGORIES:
+                kind = "categorical"
+            return {"kind": kind, "distinct": distinct}
+
+        sample = ChartSelector.sample_column(data, field)
+        if sample is None:
+            return None
+        if stats and stats.get("type") == "string" and stats.get("cardinality"):
+            kind = 'temporal' if ChartSelector.sniff_date_format(sample.dropna().astype(str)) else 'categorical'
+            return {"kind": kind, "distinct": min(int(stats["cardinality"]), total)}
+        return {
+            "kind": ChartSelector.infer_field_type(sample),
+            "distinct": ChartSelector.estimate_distinct(sample, total),
+        }
+
+    @staticmethod
+    def rank_chart_types(data: Data, x_field: str, y_field: Optional[str] = None,
+                         field_stats: Optional[Dict[str, Dict[str, Any]]] = None) -> List[Tuple[str, float]]:
+        """Plausible chart types with scores between 0 and 1, best first.
+
+        `field_stats` maps result columns to schema profile summaries (see
+        `result_field_stats`); columns found there need no pass over the data.
+        """
+        if data is None or len(data) == 0:
+            return [('bar', 0.5)]
+        field_stats = field_stats or {}
+
+        x = ChartSelector.describe_field(data, x_field, field_stats.get(x_field))
+        if x is None:
+            return [('bar', 0.5)]
+        y = ChartSelector.describe_field(data, y_field, field_stats.get(y_field)) if y_field else None
+        y_numeric = y is not None and y["kind"] == 'numerical'
+        has_y = y is not None
+
+        scores: Dict[str, float] = {}
+        if x["kind"] == 'temporal':
+            scores['line'] = 1.0
+            if x["distinct"] <= 60:
+                scores['bar'] = 0.6
+            if y_numeric:
+                scores['scatter'] = 0.4
+        elif x["kind"] == 'numerical':
+            if y_numeric:
+                scores['scatter'] = 0.9
+                scores['line'] = 0.5
+            else:
+                scores['histogram'] = 0.9
+            scores['bar'] = 0.3
+        else:
+            if x["distinct"] <= 10:
+                scores['pie'] = 0.9 if has_y else 0.5
+                scores['bar'] = 0.85 if has_y else 0.9
+            else:
+                scores['bar'] = 0.9
+                # Wide pies are hard to read; rank them lower the more slices there are
+                if has_y and x["distinct"] <= 20:
+                    scores['pie'] = 0.3
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    @staticmethod
+    def suggest_chart_type(data: Data, x_field: str, y_field: Optional[str] = None,
+                           field_stats: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+        """Suggest an appropriate chart type based on the data structure"""
+        return ChartSelector.rank_chart_types(data, x_field, y_field, field_stats)[0][0]
@@ -0,0 +1,105 @@
+import os
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+# Maximum points sent to the browser per chart type
+POINT_BUDGETS = {
+    'line': int(os.getenv("LINE_POINT_BUDGET", "2000")),
+    'scatter': int(os.getenv("SCATTER_POINT_BUDGET", "5000")),
+}
+
+def point_budget(chart_type: str) -> Optional[int]:
+    """Target number of points for a chart type, or None if it isn't reduced"""
+    return POINT_BUDGETS.get(chart_type)
+
+def _as_numeric(series: pd.Series) -> Optional[np.ndarray]:
+    """Numeric view of a column (datetimes as int64), or None if not numeric"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(np.float64)
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return None
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: indices of the points that best preserve the line shape"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Bucket boundaries for the interior points (first and last are always kept)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+
+    # Average point of every bucket, computed in one pass
+    counts = ends - starts
+    if np.any(counts == 0):
+        # Too few points per bucket for LTTB to matter
+        return np.unique(np.linspace(0, n - 1, threshold).astype(np.int64))
+    x_means = np.add.reduceat(x[1:n - 1], starts - 1) / counts
+    y_means = np.add.reduceat(y[1:n - 1], starts - 1) / counts
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = starts[i], ends[i]
+        # The next bucket's average (or the last point for the final bucket)
+        if i + 1 < threshold - 2:
+            cx, cy = x_means[i + 1], y_means[i + 1]
+        else:
+            cx, cy = x[n - 1], y[n - 1]
+        ax, ay = x[a], y[a]
+        bx, by = x[start:end], y[start:end]
+        areas = np.abs((ax - cx) * (by - ay) - (ax - bx) * (cy - ay))
+        a = start + int(np.nanargmax(areas)) if not np.all(np.isnan(areas)) else start
+        selected[i + 1] = a
+
+    return selected
+
+def minmax_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Keep the min and max y of each x bucket, preserving the envelope of the data"""
+    n = len(x)
+    if threshold >= n or threshold < 2:
+        return np.arange(n)
+
+    # Points without a y value aren't drawn, so they can't be a bucket's min or max
+    valid = np.flatnonzero(~np.isnan(y))
+    n = len(valid)
+    if n == 0:
+        return valid
+
+    buckets = max(threshold // 2, 1)
+    order = valid[np.argsort(x[valid], kind='stable')]
+    bucket_ids = np.minimum((np.arange(n) * buckets) // n, buckets - 1)
+
+    # Sort by (bucket, y) so each bucket's min is first and max is last
+    by_bucket = order[np.lexsort((y[order], bucket_ids))]
+    boundaries = np.flatnonzero(np.diff(bucket_ids)) + 1
+    firsts = np.concatenate(([0], boundaries))
+    lasts = np.concatenate((boundaries - 1, [n - 1]))
+
+    return np.unique(np.concatenate((by_bucket[firsts], by_bucket[lasts])))
+
+def reduce_points(df: pd.DataFrame, x_field: str, y_field: Optional[str], chart_type: str,
+                  budget: Optional[int] = None) -> pd.DataFrame:
+    """Downsample a frame for line (LTTB) or scatter (min/max) rendering"""
+    budget = budget or point_budget(chart_type)
+    if not budget or len(df) <= budget:
+        return df
+
+    x = _as_numeric(df[x_field])
+    y = _as_numeric(df[y_field]) if y_field else None
+    if x is None or y is None:
+        # Non-numeric axes: evenly spaced stride keeps the overall shape
+        stride = int(np.ceil(len(df) / budget))
+        return df.iloc[::stride]
+
+    if chart_type == 'line':
+        order = np.argsort(x, kind='stable')
+        picked = order[lttb_indices(x[order], y[order], budget)]
+    else:
+        picked = minmax_indices(x, y, budget)
+
+    return df.iloc[np.sort(picked)]
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Any
+
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+def result_hash(df: pd.DataFrame) -> str:
+    """Content hash of a result DataFrame (values, column names and order)"""
+    digest = hashlib.sha256("\x00".join(map(str, df.columns)).encode("utf-8"))
+    try:
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    except TypeError:
+        # Unhashable cells (documents, arrays) hash by their text
+        digest.update(pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def figure_key(df: pd.DataFrame, **options: Any) -> str:
+    """Cache key for the figure drawn from `df` with these options (chart type, axes, title, ...)"""
+    raw = f"{result_hash(df)}\x00{json.dumps(options, sort_keys=True, default=str)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class FigureCache:
+    """Byte-bounded LRU cache of serialized figures.
+
+    Figures are stored as their JSON spec, so a hit skips both building the
+    figure and encoding its data. Every hit returns a new Figure object;
+    callers may modify it without affecting other sessions.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[go.Figure]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # The spec came from a validated figure; skip re-validating every point
+        return go.Figure(json.loads(payload), _validate=False)
+
+    def put(self, key: str, fig: go.Figure) -> int:
+        """Store a figure; returns its serialized size in bytes"""
+        payload = pio.to_json(fig, validate=False)
+        size = len(payload)
+        if size > self.max_bytes:
+            return size
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous)
+            self._entries[key] = payload
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+        return size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and memory usage for display"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+# Create singleton instance
+figure_cache = FigureCache(max_bytes=int(os.getenv("FIGURE_CACHE_MAX_MB", "32")) * 1024 * 1024)
@@ -0,0 +1,162 @@
+import os
+import base64
+from typing import Dict, List, Optional, Any, Tuple
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# Line and scatter charts with more points than this are drawn with WebGL (scattergl)
+WEBGL_POINT_THRESHOLD = int(os.getenv("WEBGL_POINT_THRESHOLD", "1000"))
+# Label arrays with at most this many distinct values are dictionary encoded (every label becomes a tick)
+MAX_DICTIONARY_LABELS = int(os.getenv("CHART_MAX_DICTIONARY_LABELS", "50"))
+# Arrays shorter than this stay plain JSON; the encoding overhead isn't worth it
+MIN_ENCODED_LENGTH = 32
+
+# plotly.js typed array dtypes, smallest first; there are no 64-bit integers
+_INTEGER_DTYPES = [("i1", np.int8), ("u1", np.uint8), ("i2", np.int16), ("u2", np.uint16),
+                   ("i4", np.int32), ("u4", np.uint32)]
+# Array attributes that hold one value per point, by trace type
+_POINT_ATTRIBUTES = ("x", "y", "z", "values", "customdata")
+_MAX_SAFE_INTEGER = 2 ** 53
+
+def render_mode(points: int) -> str:
+    """plotly express render_mode for a line/scatter chart with this many points"""
+    return "webgl" if points > WEBGL_POINT_THRESHOLD else "svg"
+
+def _typed(array: np.ndarray, dtype: str) -> Dict[str, str]:
+    data = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {"dtype": dtype, "bdata": base64.b64encode(data.tobytes()).decode("ascii")}
+
+def typed_array(values: Any) -> Optional[Dict[str, str]]:
+    """Base64 typed array spec ({"dtype", "bdata"}) for numeric values, or None if they aren't numeric.
+
+    Integers are stored in the narrowest dtype that holds them and floats
+    keep their precision; `None`s in object arrays become NaN.
+    """
+    array = np.asarray(values)
+    if array.dtype == object:
+        # Numeric-looking strings are labels, not numbers
+        if pd.api.types.infer_dtype(array, skipna=True) not in ("integer", "floating", "mixed-integer-float", "decimal"):
+            return None
+        try:
+            array = pd.to_numeric(pd.Series(array), errors="raise").to_numpy(dtype=np.float64, na_value=np.nan)
+        except (TypeError, ValueError):
+            return None
+        finite = array[~np.isnan(array)]
+        if len(finite) == len(array) and np.array_equal(finite, np.round(finite)) and \
+                (not len(finite) or np.abs(finite).max() < _MAX_SAFE_INTEGER):
+            array = array.astype(np.int64)
+    if array.dtype.kind == "b" or array.dtype.kind not in "iuf" or array.ndim != 1:
+        return None
+
+    if array.dtype.kind in "iu":
+        if not len(array):
+            return _typed(array, "i1")
+        low, high = int(array.min()), int(array.max())
+        for code, dtype in _INTEGER_DTYPES:
+            info = np.iinfo(dtype)
+            if info.min <= low and high <= info.max:
+                return _typed(array, code)
+        if max(abs(low), abs(high)) >= _MAX_SAFE_INTEGER:
+            return None
+        return _typed(array, "f8")
+    return _typed(array, "f4" if array.dtype == np.float32 else "f8")
+
+def epoch_millis(values: Any) -> Optional[np.ndarray]:
+    """Milliseconds since the epoch for datetime values (wall time, as plotly shows date strings)"""
+    array = np.asarray(values)
+    if array.dtype.kind != "M":
+        if array.dtype != object or not len(array) or not isinstance(array[0], pd.Timestamp):
+            return None
+        try:
+            array = pd.to_datetime(pd.Series(array)).dt.tz_localize(None).to_numpy()
+        except (TypeError, ValueError):
+            return None
+    millis = array.astype("datetime64[ms]").astype(np.float64)
+    millis[np.isnat(array)] = np.nan
+    return millis
+
+def _labels(values: Any) -> Optional[np.ndarray]:
+    """The values as an array if they're all strings"""
+    if values is None or isinstance(values, (dict, str)):
+        return None
+    array = np.asarray(values)
+    if array.dtype.kind == "U" or (array.dtype == object and pd.api.types.infer_dtype(array, skipna=False) == "string"):
+        return array
+    return None
+
+def _axis_name(trace: Dict[str, Any], attribute: str) -> str:
+    """Layout key of the axis a trace's x or y values are plotted on ('x2' -> 'xaxis2')"""
+    ref = trace.get(f"{attribute}axis", attribute)
+    return f"{attribute}axis{ref[1:]}"
+
+def _dictionary_encode(traces: List[Dict[str, Any]], attribute: str) -> Optional[List[str]]:
+    """Replace repeated string labels with integer codes shared by the traces; returns the labels"""
+    arrays = [_labels(trace.get(attribute)) for trace in traces]
+    if any(array is None for array in arrays):
+        return None
+    total = sum(len(array) for array in arrays)
+    # Codes in order of first appearance, the order plotly gives categories by default
+    codes, labels = pd.factorize(np.concatenate(arrays), sort=False)
+    if total < MIN_ENCODED_LENGTH or len(labels) > MAX_DICTIONARY_LABELS or len(labels) * 2 > total or (codes < 0).any():
+        return None
+    start = 0
+    for trace, array in zip(traces, arrays):
+        trace[attribute] = typed_array(codes[start:start + len(array)])
+        start += len(array)
+        if trace.get("type") == "histogram":
+            # One bin per code, centred on its tick
+            trace[f"{attribute}bins"] = {"start": -0.5, "end": len(labels) - 0.5, "size": 1}
+    return [str(label) for label in labels]
+
+def compact_figure_dict(figure: Dict[str, Any]) -> Dict[str, Any]:
+    """Re-encode a figure dict's per-point arrays compactly (modified in place and returned).
+
+    Numeric arrays become base64 typed arrays, datetimes become epoch
+    milliseconds on an explicit date axis, and string labels repeated across
+    many points (e.g. raw rows for a categorical histogram) are dictionary
+    encoded as integer codes with the labels moved into the axis tick text,
+    which is also what hover labels show.
+    """
+    traces = figure.get("data", [])
+    layout = figure.setdefault("layout", {})
+
+    # Labels on a shared axis need one dictionary across its traces
+    by_axis: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for trace in traces:
+        if trace.get("type", "scatter") in ("pie", "table"):
+            continue
+        for attribute in ("x", "y"):
+            if trace.get(attribute) is not None:
+                by_axis.setdefault((attribute, _axis_name(trace, attribute)), []).append(trace)
+    for (attribute, axis_name), axis_traces in by_axis.items():
+        axis = layout.setdefault(axis_name, {})
+        if axis.get("type") not in (None, "-", "category") or axis.get("categoryarray") is not None:
+            continue
+        labels = _dictionary_encode(axis_traces, attribute)
+        if labels is not None:
+            axis.update(type="linear", tickmode="array", tickvals=list(range(len(labels))), ticktext=labels,
+                        showgrid=False, zeroline=False)
+            axis.pop("categoryorder", None)
+
+    for trace in traces:
+        for attribute in _POINT_ATTRIBUTES:
+            values = trace.get(attribute)
+            if values is None or isinstance(values, dict) or isinstance(values, str) or len(values) < MIN_ENCODED_LENGTH:
+                continue
+            millis = epoch_millis(values)
+            if millis is not None:
+                trace[attribute] = _typed(millis, "f8")
+                if attribute in ("x", "y"):
+                    layout.setdefault(_axis_name(trace, attribute), {})["type"] = "date"
+                continue
+            encoded = typed_array(values)
+            if encoded is not None:
+                trace[attribute] = encoded
+    return figure
+
+def compact_figure(fig: go.Figure) -> go.Figure:
+    """Copy of a figure whose data serializes compactly (see compact_figure_dict)"""
+    compact = compact_figure_dict(fig.to_dict())
+    # The encoded arrays are already valid plotly.js input; skip re-validating every point
+    return go.Figure(compact, _validate=False)